@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the app with synthetic event folders
+Author: Carlos Herrero
+
+Usage:
+    python Benchmark.py --sizes 1000 10000 100000 --density 2 --output results.json
+    python Benchmark.py --sizes 1000 --label my-change --output after.json
+"""
+
+import os
+
+# The app runs without a screen, it must be set before Qt is imported
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage, QColor
+from PyQt5.QtCore import QT_VERSION_STR
+
+import sys
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+from Journal import writeAtomic
+from LabelStore import Person
+from Main import Main, Photo
+
+SIZES = (1000, 10000, 100000)
+DENSITY = 2.0       # mean number of persons of a labelled photo
+UNLABELED = 0.3     # fraction of photos without labels
+REPEAT = 50
+WIDTH = 1600
+HEIGHT = 1200
+
+def generate(directory, count, density=DENSITY, unlabeled=UNLABELED, seed=0):
+    """
+    Function to create a synthetic event folder: count photos and a labels' file.
+    Every photo is a hard link to the same JPEG (a copy if links are not supported), so a big
+    folder is created in seconds and all the photos have the same decode cost.
+
+    return:
+        - path of the labels' file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+
+    template = directory + ".jpg"
+    image = QImage(WIDTH, HEIGHT, QImage.Format_RGB32)
+    image.fill(QColor(90, 120, 90))
+    image.save(template, 'JPEG', 90)
+
+    data = {}
+    for i in range(0, count) :
+        name = "photo%06d.jpg" % i
+        path = os.path.join(directory, name)
+
+        try:
+            os.link(template, path)
+        except OSError:
+            shutil.copyfile(template, path)
+
+        people = []
+        if rng.random() >= unlabeled :
+            for j in range(0, max(1, int(round(rng.gauss(density, density / 2))))) :
+                x = rng.uniform(0, WIDTH - 200)
+                y = rng.uniform(0, HEIGHT - 400)
+                people.append({ 'position': [x, y, x + 200, y + 400],
+                                'number': { 'position': [x + 60, y + 120, x + 140, y + 170], 'number': rng.randint(1, 9999) } })
+
+        data[name] = people
+
+    os.remove(template)
+    fileLabels = os.path.join(directory, "labels.json")
+    writeAtomic(fileLabels, data)
+    return fileLabels
+
+def stats(samples):
+    """
+    Function to obtain the summary of the times of an operation in ms.
+    """
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'total': sum(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+def measure(app, function, repeat=1):
+    """
+    Function to time an operation, the pending events (background decodes) are processed
+    between the repetitions and are not timed.
+    """
+    samples = []
+
+    for i in range(0, repeat) :
+        app.processEvents()
+        start = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    app.processEvents()
+    return stats(samples)
+
+def run(app, fileLabels, repeat=REPEAT):
+    """
+    Function to time the main operations of the app on a labels' file.
+
+    return:
+        - dict with the stats of every operation.
+    """
+    results = {}
+    main = Main()
+    main.openLabels(fileLabels)
+
+    # The first load builds the sidecar indexes (metadata, folder), the next ones use them
+    results['loadData (cold)'] = measure(app, main.loadData)
+    results['loadData (warm)'] = measure(app, main.loadData, max(1, repeat // 10))
+
+    store = main.store
+    names = store.photos[0:repeat]
+    scenes = []
+
+    def scene():
+        scenes.append(Photo(names[len(scenes) % len(names)], parent=main))
+
+    results['Photo.__init__'] = measure(app, scene, repeat)
+    for photo in scenes :
+        photo.close()
+
+    results['nextPhoto'] = measure(app, main.nextPhoto, repeat)
+    results['noLabeled'] = measure(app, main.noLabeled)
+    results['nextPhoto (no labeled)'] = measure(app, main.nextPhoto, repeat)
+    main.allPhotos()
+
+    # Some edits so the journal has changes to compact
+    for name in names :
+        store.addPerson(Person([10, 10, 210, 410], [70, 130, 150, 180], 1), name)
+
+    # The file is written by the writer thread of the journal, the time includes the wait for it
+    def save():
+        main.saveData()
+        store.storage.journal.flush(wait=True)
+
+    results['saveData'] = measure(app, save)
+
+    main.closeStorage()
+    main.close()
+    main.deleteLater()
+    app.processEvents()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the app with synthetic event folders, without a screen.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help="number of photos of every folder")
+    parser.add_argument('--density', type=float, default=DENSITY, help="mean number of persons of a labelled photo")
+    parser.add_argument('--unlabeled', type=float, default=UNLABELED, help="fraction of photos without labels")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="repetitions of the photo operations")
+    parser.add_argument('--label', default=None, help="name of the version being measured")
+    parser.add_argument('--keep', default=None, help="folder to create the event folders and keep them")
+    parser.add_argument('--output', default="benchmark.json", help="JSON file with the results")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    base = args.keep if args.keep else tempfile.mkdtemp(prefix="labeler")
+    report = {
+        'label': args.label,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'qt': QT_VERSION_STR,
+        'platform': platform.platform(),
+        'density': args.density,
+        'unlabeled': args.unlabeled,
+        'runs': [],
+    }
+
+    try:
+        for size in args.sizes :
+            print("Generating %d photos..." % size)
+            fileLabels = generate(os.path.join(base, "event%d" % size), size, args.density, args.unlabeled)
+
+            print("Running %d photos..." % size)
+            results = run(app, fileLabels, min(args.repeat, size))
+            report['runs'].append({ 'size': size, 'results': results })
+
+            for operation, result in results.items() :
+                print("    %-24s mean %9.2fms p95 %9.2fms" % (operation, result['mean'], result['p95']))
+
+    finally:
+        if not args.keep :
+            shutil.rmtree(base, ignore_errors=True)
+
+    writeAtomic(args.output, report)
+    print("Results written to " + args.output)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate photos of the bursts of the cameras
+Author: Carlos Herrero
+
+Usage:
+    python Bursts.py labels.json [--threshold 10] [--workers 8]
+
+Needs Pillow and numpy.
+"""
+
+import os
+import json
+import bisect
+import argparse
+import multiprocessing
+
+import numpy
+from PIL import Image
+
+from Journal import writeAtomic
+from DirectoryIndex import DirectoryIndex
+
+HASHES = ".hashes"
+HASH_SIZE = 8           # the hash is HASH_SIZE x HASH_SIZE bits
+THRESHOLD = 10          # maximum different bits of two consecutive photos of a burst
+
+def dhash(path):
+    """
+    Function to obtain the difference hash of a photo: the photo is reduced to 9x8 grays and every
+    bit tells if a pixel is brighter than the next one. Near-duplicate photos have hashes with few
+    different bits. JPEG photos are decoded at 1/8 of their size (draft mode), enough for the hash.
+
+    return:
+        - hash as an int of 64 bits.
+    """
+    with Image.open(path) as image :
+        image.draft('L', ((HASH_SIZE + 1) * 8, HASH_SIZE * 8))
+        pixels = numpy.asarray(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=numpy.int16)
+
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+
+def hashTask(task):
+    """
+    Function to obtain the hash of a photo, it runs in the workers of the pool.
+
+    params:
+        - task: (directory, name).
+
+    return:
+        - (name, hash), hash is None if the photo can not be read.
+    """
+    directory, name = task
+
+    try:
+        return name, dhash(os.path.join(directory, name))
+    except (OSError, ValueError):
+        return name, None
+
+def hamming(a, b):
+    """
+    Function to obtain the number of different bits of two arrays of hashes (numpy.uint64).
+    """
+    different = numpy.bitwise_xor(a, b)
+    return numpy.unpackbits(different.view(numpy.uint8)).reshape(-1, 64).sum(axis=1)
+
+class BurstIndex():
+    """
+    Class to group the photos of the bursts of the cameras.
+    The hash of every photo (see dhash) is kept in a sidecar file next to the labels' file with the
+    mtime of the photo, so only the new or modified photos are hashed again. The photos are grouped
+    in the order of the names (the order of the shots): a photo is in the burst of the previous one
+    if their hashes have at most threshold different bits.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - directory: folder of the photos.
+        - threshold: maximum different bits of two photos of a burst.
+    """
+
+    def __init__(self, fileLabels, directory, threshold=THRESHOLD):
+        self.path = fileLabels + HASHES
+        self.directory = directory
+        self.threshold = threshold
+        self.hashes = {}
+        self.names = []
+        self.groups = numpy.zeros(0, dtype=numpy.int64)
+
+        try:
+            with open(self.path, 'r') as file :
+                index = json.load(file)
+
+            if index['directory'] == directory :
+                self.hashes = index['hashes']
+
+        except (FileNotFoundError, ValueError, KeyError):
+            self.hashes = {}
+
+    def update(self, files, workers=None):
+        """
+        Function to hash the new and modified photos in a pool of processes.
+        The processes are spawned, not forked: the app calls it from a thread while the Qt thread
+        pools and the journal writer are running, and a fork would copy their locks.
+
+        params:
+            - files: dict with [mtime, size] of every photo (see DirectoryIndex).
+            - workers: number of processes, the number of cores by default.
+
+        return:
+            - number of photos hashed.
+        """
+        mtimes = { name: info[0] for name, info in files.items() }
+        tasks = [(self.directory, name) for name in sorted(mtimes.keys())
+                 if name not in self.hashes or self.hashes[name][0] != mtimes[name]]
+
+        hashes = { name: self.hashes[name] for name in mtimes.keys() if name in self.hashes }
+
+        if tasks :
+            with multiprocessing.get_context('spawn').Pool(workers) as pool :
+                for name, value in pool.imap_unordered(hashTask, tasks, chunksize=16) :
+                    if value is not None :
+                        hashes[name] = [mtimes[name], value]
+
+        changed = len(tasks) > 0 or len(hashes) != len(self.hashes)
+        self.hashes = hashes
+
+        if changed :
+            writeAtomic(self.path, { 'directory': self.directory, 'hashes': self.hashes })
+
+        return len(tasks)
+
+    def group(self, names):
+        """
+        Function to group the photos in bursts, the distances of all the consecutive photos are
+        obtained at once. A photo without hash is a burst by itself.
+        The photos are grouped in the order of the names, not in the navigation order: the photos of a
+        camera are consecutive (folder/photo in a project) and a lazy list (see Project.Timeline) is not read.
+
+        params:
+            - names: sorted names of the photos.
+
+        return:
+            - numpy array with the burst of every photo of the list.
+        """
+        found = numpy.array([name in self.hashes for name in names], dtype=bool)
+        hashes = numpy.array([self.hashes[name][1] if name in self.hashes else 0 for name in names], dtype=numpy.uint64)
+
+        same = numpy.zeros(len(names), dtype=bool)
+        if len(names) > 1 :
+            # The photos of different cameras are never a burst
+            cameras = numpy.array([os.path.dirname(names[k]) == os.path.dirname(names[k - 1]) for k in range(1, len(names))], dtype=bool)
+            same[1:] = (hamming(hashes[1:], hashes[:-1]) <= self.threshold) & found[1:] & found[:-1] & cameras
+
+        self.names = names
+        self.groups = numpy.cumsum(~same)
+        return self.groups
+
+    def same(self, name, other):
+        """
+        Function to know if two photos of the grouped list are in the same burst.
+        """
+        k = self.find(name)
+        j = self.find(other)
+
+        if k is None or j is None :
+            return False
+
+        return self.groups[k] == self.groups[j]
+
+    def find(self, name):
+        """
+        Function to obtain the position of a photo in the grouped list, None if it is not in it.
+        """
+        if name is None :
+            return None
+
+        k = bisect.bisect_left(self.names, name)
+        return k if k < len(self.names) and self.names[k] == name else None
+
+    def bursts(self):
+        """
+        Function to obtain the bursts of the grouped list with more than one photo.
+
+        return:
+            - list of (first position, last position) in the grouped list.
+        """
+        starts = numpy.flatnonzero(numpy.diff(self.groups, prepend=0))
+        ends = numpy.append(starts[1:], len(self.groups)) - 1
+        return [(int(first), int(last)) for first, last in zip(starts, ends) if last > first]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hash the photos of a labels' file and show the bursts of near-duplicate photos.")
+    parser.add_argument('labels', help="labels' file, the photos are in its folder")
+    parser.add_argument('--threshold', type=int, default=THRESHOLD, help="maximum different bits of two photos of a burst")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, the number of cores by default")
+    args = parser.parse_args()
+
+    directory = os.path.dirname(os.path.abspath(args.labels))
+    folder = DirectoryIndex(args.labels, directory)
+    folder.scan()
+
+    index = BurstIndex(args.labels, directory, args.threshold)
+    hashed = index.update(folder.files, args.workers)
+    photos = folder.names()
+    index.group(photos)
+    bursts = index.bursts()
+
+    print("Hashed %d photos, %d bursts with %d photos" % (hashed, len(bursts), sum(last - first + 1 for first, last in bursts)))
+    for first, last in bursts :
+        print("    %s - %s (%d)" % (photos[first], photos[last], last - first + 1))
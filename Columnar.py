@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar export of the labels for the training data loaders
+Author: Carlos Herrero
+
+Usage:
+    python Columnar.py labels.json columns/
+    python Columnar.py labels.db columns/ --segment 8192
+
+Needs numpy.
+"""
+
+import os
+import json
+import shutil
+import bisect
+import hashlib
+import argparse
+
+import numpy
+
+from Storage import iterLabels
+from Journal import writeAtomic
+
+META = "meta.json"
+SEGMENT = 4096          # photos of a segment, a segment is split when it has twice as many
+VERSION = 1
+
+def writeSegment(path, photos):
+    """
+    Function to write the columns of a list of photos in a folder, one .npy file per column:
+
+        - names.npy: UTF-8 bytes of the names one after another (uint8), nameOffsets.npy: start of every
+          name and the end of the last one (int64, photos + 1).
+        - offsets.npy: first person of every photo and the end of the last one (int64, photos + 1).
+        - photo.npy: photo of every person in the segment (int32).
+        - person.npy, dorsal.npy: (x1, y1, x2, y2) of every person and its dorsal, NaN without dorsal (float32, n x 4).
+        - number.npy: dorsal number of every person, -1 without number (int32).
+
+    params:
+        - photos: list of (name, labels) with the JSON structure, in the order of the names.
+    """
+    names = [name.encode('utf-8') for name, labels in photos]
+    counts = [len(labels) for name, labels in photos]
+    persons = [person for name, labels in photos for person in labels]
+    none = [numpy.nan] * 4
+
+    columns = {
+        'names': numpy.frombuffer(b"".join(names), dtype=numpy.uint8),
+        'nameOffsets': numpy.cumsum([0] + [len(name) for name in names], dtype=numpy.int64),
+        'offsets': numpy.cumsum([0] + counts, dtype=numpy.int64),
+        'photo': numpy.repeat(numpy.arange(len(photos), dtype=numpy.int32), counts),
+        'person': numpy.array([person['position'] for person in persons], dtype=numpy.float32).reshape(-1, 4),
+        'dorsal': numpy.array([person['number']['position'] if person.get('number', None) else none for person in persons],
+                              dtype=numpy.float32).reshape(-1, 4),
+        'number': numpy.array([person['number'].get('number', None) if person.get('number', None) else None for person in persons],
+                              dtype=numpy.float64).reshape(-1),
+    }
+    columns['number'] = numpy.nan_to_num(columns['number'], nan=-1).astype(numpy.int32)
+
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    for column, values in columns.items() :
+        numpy.save(os.path.join(tmp, column + ".npy"), values)
+
+    os.replace(tmp, path)
+    return len(persons)
+
+def digest(photos):
+    """
+    Function to obtain the digest of the labels of a list of photos, to know if a segment changed.
+    """
+    sha = hashlib.sha1()
+    for name, labels in photos :
+        sha.update(name.encode('utf-8') + b"\x00" + json.dumps(labels, sort_keys=True).encode('utf-8') + b"\x00")
+
+    return sha.hexdigest()
+
+def readMeta(output):
+    try:
+        with open(os.path.join(output, META), 'r') as file :
+            meta = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return meta if meta.get('version', None) == VERSION else None
+
+def export(fileLabels, output, segment=SEGMENT):
+    """
+    Function to export the labels of a labels' file (JSON or SQLite) to columns of numpy arrays.
+    The photos are split in segments by ranges of names, every segment is a folder with its columns
+    (see writeSegment). The labels' file is streamed, and the segments of the previous export whose
+    labels did not change are kept, so an export after some changes only rewrites their segments.
+    The segments are listed in meta.json, written at the end: a loader reading the columns during
+    an export sees the previous export or the new one.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - output: folder of the columns.
+        - segment: photos of a segment.
+
+    return:
+        - photos: number of photos exported.
+        - written: number of segments written.
+        - kept: number of segments kept from the previous export.
+    """
+    os.makedirs(output, exist_ok=True)
+    meta = readMeta(output)
+    old = meta['segments'] if meta else []
+    firsts = [entry['first'] for entry in old]
+
+    # An interrupted export leaves segment folders not listed in meta.json, their serials are not used again
+    orphans = [name for name in os.listdir(output) if name.isdigit() and name not in { entry['id'] for entry in old }]
+    serial = max([meta['serial'] if meta else 0] + [int(name) for name in orphans])
+
+    segments = []
+    counts = { 'photos': 0, 'written': 0, 'kept': 0 }
+
+    def close(k, photos):
+        nonlocal serial
+
+        # The photos of an old segment which did not change keep its folder
+        if k is not None and len(photos) <= 2 * segment and digest(photos) == old[k]['digest'] :
+            segments.append(old[k])
+            counts['kept'] += 1
+            return
+
+        for i in range(0, len(photos), segment) :
+            chunk = photos[i:i + segment]
+            serial += 1
+            name = "%08d" % serial
+            persons = writeSegment(os.path.join(output, name), chunk)
+            segments.append({ 'id': name, 'first': chunk[0][0], 'last': chunk[-1][0], 'photos': len(chunk),
+                              'persons': persons, 'digest': digest(chunk) })
+            counts['written'] += 1
+
+    actual = None
+    photos = []
+
+    for name, labels in iterLabels(fileLabels) :
+        # The photos go to the old segment of their name, or in chunks if there was no export
+        k = max(0, bisect.bisect_right(firsts, name) - 1) if old else None
+
+        if photos and (k != actual or (k is None and len(photos) == segment)) :
+            close(actual, photos)
+            photos = []
+
+        actual = k
+        photos.append((name, labels))
+        counts['photos'] += 1
+
+    if photos :
+        close(actual, photos)
+
+    writeAtomic(os.path.join(output, META), { 'version': VERSION, 'serial': serial, 'labels': os.path.abspath(fileLabels),
+                                               'photos': counts['photos'], 'segments': segments })
+
+    # The folders of the segments replaced, the loaders which have them open keep reading them
+    used = { entry['id'] for entry in segments }
+    for name in [entry['id'] for entry in old] + orphans :
+        if name not in used :
+            shutil.rmtree(os.path.join(output, name), ignore_errors=True)
+
+    return counts['photos'], counts['written'], counts['kept']
+
+class Segment():
+    """
+    Class with the columns of a segment, memory mapped: the pages are read when they are used and
+    shared by all the processes which map the same files.
+    """
+
+    def __init__(self, path):
+        for column in ('names', 'nameOffsets', 'offsets', 'photo', 'person', 'dorsal', 'number') :
+            setattr(self, column, numpy.load(os.path.join(path, column + ".npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def name(self, i):
+        return self.names[self.nameOffsets[i]:self.nameOffsets[i + 1]].tobytes().decode('utf-8')
+
+class Columns():
+    """
+    Class to read the columns exported by export, for the data loaders of the trainings.
+    The arrays are memory mapped, every worker of a loader opens it without parsing or copying
+    the labels. The photos are in the order of their names, with a global position.
+
+        columns = Columnar.Columns("columns/")
+        name, person, dorsal, number = columns[i]
+
+    params:
+        - output: folder of the columns.
+    """
+
+    def __init__(self, output):
+        meta = readMeta(output)
+        if meta is None :
+            raise FileNotFoundError("No columns in " + output)
+
+        self.segments = [Segment(os.path.join(output, entry['id'])) for entry in meta['segments']]
+        self.firsts = [entry['first'] for entry in meta['segments']]
+        self.starts = numpy.cumsum([0] + [entry['photos'] for entry in meta['segments']], dtype=numpy.int64)
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def locate(self, i):
+        """
+        Function to obtain the segment of a photo and its position in the segment.
+        """
+        if i < 0 :
+            i += len(self)
+        if i < 0 or i >= len(self) :
+            raise IndexError(i)
+
+        k = int(numpy.searchsorted(self.starts, i, side='right')) - 1
+        return self.segments[k], i - int(self.starts[k])
+
+    def __getitem__(self, i):
+        """
+        Function to obtain the labels of a photo, the arrays are views of the mapped columns.
+
+        return:
+            - (name, person boxes (n x 4), dorsal boxes (n x 4), numbers (n)).
+        """
+        segment, j = self.locate(i)
+        start, end = segment.offsets[j], segment.offsets[j + 1]
+        return segment.name(j), segment.person[start:end], segment.dorsal[start:end], segment.number[start:end]
+
+    def name(self, i):
+        segment, j = self.locate(i)
+        return segment.name(j)
+
+    def index(self, name):
+        """
+        Function to obtain the position of a photo by its name, None if it is not exported.
+        """
+        k = bisect.bisect_right(self.firsts, name) - 1
+        if k < 0 :
+            return None
+
+        segment = self.segments[k]
+        low, high = 0, len(segment)
+
+        while low < high :
+            middle = (low + high) // 2
+            if segment.name(middle) < name :
+                low = middle + 1
+            else :
+                high = middle
+
+        return int(self.starts[k]) + low if low < len(segment) and segment.name(low) == name else None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the labels to memory mappable numpy columns, only the changed segments are written again.")
+    parser.add_argument('labels', help="labels' file (JSON or SQLite)")
+    parser.add_argument('output', help="folder of the columns")
+    parser.add_argument('--segment', type=int, default=SEGMENT, help="photos of a segment")
+    args = parser.parse_args()
+
+    photos, written, kept = export(args.labels, args.output, args.segment)
+    print("Exported %d photos: %d segments written, %d unchanged" % (photos, written, kept))
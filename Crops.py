@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch extraction of the person and dorsal crops
+Author: Carlos Herrero
+
+Usage:
+    python Crops.py labels.json crops/
+    python Crops.py labels.db crops/ --only dorsal --images photos/ --workers 8
+
+Needs Pillow and numpy.
+"""
+
+import os
+import json
+import math
+import argparse
+import itertools
+import multiprocessing
+
+import numpy
+from PIL import Image, ImageOps
+
+from Storage import iterLabels
+from Export import CLASSES
+from Journal import openAppend
+
+MANIFEST = "manifest.jsonl"
+BATCH = 256         # photos read from the labels' file while the workers crop the previous ones
+QUALITY = 95
+
+def cropName(name, i, cls):
+    """
+    Function to obtain the file of a crop: photo name, person index and class.
+    """
+    return "%s_%d_%s.jpg" % (os.path.splitext(name)[0], i, CLASSES[cls])
+
+def photoCrops(name, labels, only=None):
+    """
+    Function to obtain the crops of a photo, all the boxes of a photo are cropped with one decode.
+
+    return:
+        - list of manifest entries { crop, photo, person, class, box[, number] }.
+    """
+    crops = []
+
+    for i in range(0, len(labels)) :
+        person = labels[i]
+        dorsal = person.get('number', None)
+        found = [(0, person['position'], None)]
+
+        if dorsal :
+            found.append((1, dorsal['position'], dorsal.get('number', None)))
+
+        for cls, box, number in found :
+            if only is not None and CLASSES[cls] != only :
+                continue
+
+            crop = { 'crop': cropName(name, i, cls), 'photo': name, 'person': i, 'class': CLASSES[cls],
+                     'box': [min(box[0], box[2]), min(box[1], box[3]), max(box[0], box[2]), max(box[1], box[3])] }
+            if number is not None :
+                crop['number'] = number
+
+            crops.append(crop)
+
+    return crops
+
+def crop(task):
+    """
+    Function to decode a photo once and write all its crops, it runs in the workers of the pool.
+    The crops are slices of the decoded array (no copy), only the encoder copies the pixels.
+    Every crop is written to a temporary file and renamed, a stopped run never leaves half a crop.
+
+    params:
+        - task: (directory, output, name, boxes, quality), boxes is a list of (crop file, box).
+
+    return:
+        - (name, list with the crop files written).
+    """
+    directory, output, name, boxes, quality = task
+
+    try:
+        with Image.open(os.path.join(directory, name)) as image :
+            # The labels are in the coordinates of the photo with its EXIF orientation applied
+            pixels = numpy.asarray(ImageOps.exif_transpose(image).convert('RGB'))
+    except (OSError, ValueError):
+        return name, []
+
+    height, width = pixels.shape[0:2]
+    written = []
+
+    for file, box in boxes :
+        x1 = max(0, int(box[0]))
+        y1 = max(0, int(box[1]))
+        x2 = min(width, int(math.ceil(box[2])))
+        y2 = min(height, int(math.ceil(box[3])))
+
+        if x2 <= x1 or y2 <= y1 :
+            continue
+
+        # The photos of a project are named folder/photo, their crops keep the folder
+        path = os.path.join(output, file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Image.fromarray(pixels[y1:y2, x1:x2]).save(path + ".tmp", 'JPEG', quality=quality)
+        os.replace(path + ".tmp", path)
+        written.append(file)
+
+    return name, written
+
+def readManifest(output):
+    """
+    Function to read the crops written by a previous run.
+    A broken line (run stopped in the middle of an append) is ignored.
+
+    return:
+        - dict with the box of every crop file which is still in the output folder.
+    """
+    done = {}
+
+    try:
+        with open(os.path.join(output, MANIFEST), 'r') as file :
+            for line in file :
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                if os.path.exists(os.path.join(output, entry['crop'])) :
+                    done[entry['crop']] = entry['box']
+
+    except FileNotFoundError:
+        pass
+
+    return done
+
+def extract(fileLabels, output, directory=None, only=None, workers=None, quality=QUALITY):
+    """
+    Function to crop the persons and dorsals of a labels' file (JSON or SQLite).
+    The labels' file is streamed, the photos are cropped in a pool of processes and every crop is
+    appended to the manifest of the output folder. Crops in the manifest with the same box are
+    skipped, so a stopped run continues where it stopped.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - output: folder of the crops and the manifest.
+        - directory: folder of the photos, the folder of the labels' file by default.
+        - only: 'person' or 'dorsal' to crop only one class.
+        - workers: number of processes, the number of cores by default.
+
+    return:
+        - written: number of crops written.
+        - skipped: number of crops already done.
+    """
+    directory = directory if directory else os.path.dirname(fileLabels)
+    os.makedirs(output, exist_ok=True)
+
+    done = readManifest(output)
+    written = 0
+    skipped = 0
+    labels = iterLabels(fileLabels)
+
+    with openAppend(os.path.join(output, MANIFEST)) as manifest, multiprocessing.Pool(workers) as pool :
+        while True :
+            batch = list(itertools.islice(labels, BATCH))
+            if not batch :
+                break
+
+            entries = {}
+            tasks = []
+
+            for name, people in batch :
+                pending = []
+
+                for entry in photoCrops(name, people, only) :
+                    if done.get(entry['crop'], None) == entry['box'] :
+                        skipped += 1
+                    else :
+                        entries[entry['crop']] = entry
+                        pending.append((entry['crop'], entry['box']))
+
+                if pending :
+                    tasks.append((directory, output, name, pending, quality))
+
+            for name, files in pool.imap_unordered(crop, tasks) :
+                for file in files :
+                    manifest.write(json.dumps(entries[file]) + "\n")
+                written += len(files)
+
+            manifest.flush()
+
+    return written, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Crop the persons and dorsals of the labels to JPEG files with a manifest.")
+    parser.add_argument('labels', help="labels' file (JSON or SQLite)")
+    parser.add_argument('output', help="folder of the crops")
+    parser.add_argument('--images', default=None, help="folder of the photos, the folder of the labels' file by default")
+    parser.add_argument('--only', choices=CLASSES, default=None, help="crop only the persons or the dorsals")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, the number of cores by default")
+    parser.add_argument('--quality', type=int, default=QUALITY, help="JPEG quality of the crops")
+    args = parser.parse_args()
+
+    written, skipped = extract(args.labels, args.output, args.images, args.only, args.workers, args.quality)
+    print("Written %d crops, %d already done" % (written, skipped))
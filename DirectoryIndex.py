@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent index of the photos of a folder
+Author: Carlos Herrero
+"""
+
+import os
+import re
+import json
+
+from Journal import writeAtomic
+
+INDEX = ".index"
+IMAGES = re.compile('(.jpg|.jpeg|.png|.webp)$')
+
+def modified(entry, info):
+    """
+    Function to know if a photo of the index may have changed, without a stat when it costs a system call.
+    On Windows the stat of the folder listing is free and it is compared, elsewhere the inode of the
+    listing is compared: the apps and the cameras write a new file and rename it over the photo.
+
+    params:
+        - entry: os.DirEntry of the photo.
+        - info: [mtime, size, inode] of the photo in the index.
+    """
+    if os.name == 'nt' :
+        stat = entry.stat()
+        return [stat.st_mtime, stat.st_size] != info[0:2]
+
+    return len(info) < 3 or entry.inode() != info[2]
+
+class DirectoryIndex():
+    """
+    Class to keep the list of photos of a folder without listing it completely every time.
+    The index is stored in a sidecar file next to the labels' file with the mtime of the folder
+    and the mtime, size and inode of every photo. If the mtime of the folder has not changed since the
+    last scan nothing was added or removed and the folder is not read at all. The photos modified
+    in the last scan are in changed.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - directory: folder of the photos.
+    """
+
+    def __init__(self, fileLabels, directory):
+        self.path = fileLabels + INDEX
+        self.directory = directory
+        self.mtime = None
+        self.files = {}
+        self.changed = set()
+        self.dirty = False
+
+        try:
+            with open(self.path, 'r') as file :
+                index = json.load(file)
+
+            if index['directory'] == directory :
+                self.mtime = index['mtime']
+                self.files = index['files']
+
+        except (FileNotFoundError, ValueError, KeyError):
+            self.mtime = None
+            self.files = {}
+
+    def names(self):
+        """
+        Function to obtain the sorted names of the photos in the index.
+        """
+        return sorted(self.files.keys())
+
+    def directories(self):
+        """
+        Function to obtain the folders of the photos.
+        """
+        return [self.directory]
+
+    def scan(self, full=False):
+        """
+        Function to update the index with the changes of the folder since the last scan.
+        The folder is only read if its mtime changed, and then only the new photos and the ones
+        replaced since the last scan are stat'ed (see modified), so a photo written again (a new
+        file renamed over it) gets its new mtime and size. A photo overwritten in place does not
+        change the folder, it is only seen with full, which stats every photo.
+
+        params:
+            - full: read the folder and stat every photo even if the mtime of the folder has not changed.
+
+        return:
+            - added: set with the names of the new photos.
+            - removed: set with the names of the deleted photos.
+        """
+        mtime = os.stat(self.directory).st_mtime
+        self.changed = set()
+
+        if mtime == self.mtime and not full :
+            return set(), set()
+
+        found = {}
+        with os.scandir(self.directory) as entries :
+            for entry in entries :
+                if IMAGES.search(entry.name) :
+                    info = self.files.get(entry.name, None)
+
+                    try:
+                        if info is None or full or modified(entry, info) :
+                            if not entry.is_file() :
+                                continue
+                            stat = entry.stat()
+                            info = [stat.st_mtime, stat.st_size, entry.inode()]
+                    except OSError:
+                        continue
+
+                    found[entry.name] = info
+
+        added = set(found.keys()) - set(self.files.keys())
+        removed = set(self.files.keys()) - set(found.keys())
+        self.changed = set(name for name, info in found.items() if name in self.files and self.files[name][0:2] != info[0:2])
+
+        if added or removed or self.changed or found != self.files or mtime != self.mtime :
+            self.files = found
+            self.mtime = mtime
+            self.dirty = True
+
+        return added, removed
+
+    def save(self):
+        """
+        Function to write the index in its sidecar file if there are changes.
+        """
+        if self.dirty :
+            writeAtomic(self.path, { 'directory': self.directory, 'mtime': self.mtime, 'files': self.files })
+            self.dirty = False
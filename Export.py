@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch exporter of the labels to COCO, YOLO and Pascal VOC
+Author: Carlos Herrero
+
+Usage:
+    python Export.py coco labels.json labels.coco.json
+    python Export.py yolo labels.json yolo/
+    python Export.py voc labels.db voc/ --images photos/ --workers 8
+"""
+
+import os
+import json
+import shutil
+import argparse
+import itertools
+import multiprocessing
+from xml.etree import ElementTree
+
+from Storage import iterLabels
+from ImageHeader import readSize
+
+FORMATS = ('coco', 'yolo', 'voc')
+CLASSES = ('person', 'dorsal')
+BATCH = 4096        # photos read from the labels' file while the workers convert the previous ones
+
+def boxes(labels):
+    """
+    Function to obtain the boxes of the labels of a photo, persons and dorsals are separate classes.
+
+    yields:
+        - (class, x1, y1, x2, y2, number), number is None for persons and dorsals without number.
+    """
+    for person in labels :
+        p = person['position']
+        yield 0, min(p[0], p[2]), min(p[1], p[3]), max(p[0], p[2]), max(p[1], p[3]), None
+
+        dorsal = person.get('number', None)
+        if dorsal :
+            d = dorsal['position']
+            yield 1, min(d[0], d[2]), min(d[1], d[3]), max(d[0], d[2]), max(d[1], d[3]), dorsal.get('number', None)
+
+def imageSize(path, info):
+    """
+    Function to obtain the dimensions of a photo from the metadata index of the app if it is
+    up to date, or from the header of the file.
+    """
+    stat = os.stat(path)
+
+    if info and info['mtime'] == stat.st_mtime and info['size'] == stat.st_size :
+        return info['width'], info['height']
+
+    return readSize(path)
+
+def writeYolo(path, width, height, labels):
+    """
+    Function to write the labels of a photo as a YOLO txt file (class and normalized center and size).
+    """
+    with open(path, 'w') as file :
+        for cls, x1, y1, x2, y2, number in boxes(labels) :
+            file.write("%d %.6f %.6f %.6f %.6f\n" % (cls, (x1 + x2) / 2 / width, (y1 + y2) / 2 / height,
+                                                     (x2 - x1) / width, (y2 - y1) / height))
+
+def writeVoc(path, name, width, height, labels):
+    """
+    Function to write the labels of a photo as a Pascal VOC XML file.
+    """
+    annotation = ElementTree.Element('annotation')
+    ElementTree.SubElement(annotation, 'filename').text = name
+    size = ElementTree.SubElement(annotation, 'size')
+    ElementTree.SubElement(size, 'width').text = str(width)
+    ElementTree.SubElement(size, 'height').text = str(height)
+    ElementTree.SubElement(size, 'depth').text = "3"
+    ElementTree.SubElement(annotation, 'segmented').text = "0"
+
+    for cls, x1, y1, x2, y2, number in boxes(labels) :
+        obj = ElementTree.SubElement(annotation, 'object')
+        ElementTree.SubElement(obj, 'name').text = CLASSES[cls]
+        ElementTree.SubElement(obj, 'pose').text = "Unspecified"
+        ElementTree.SubElement(obj, 'truncated').text = "0"
+        ElementTree.SubElement(obj, 'difficult').text = "0"
+        if number is not None :
+            ElementTree.SubElement(obj, 'number').text = str(number)
+
+        box = ElementTree.SubElement(obj, 'bndbox')
+        for tag, value in zip(('xmin', 'ymin', 'xmax', 'ymax'), (x1, y1, x2, y2)) :
+            ElementTree.SubElement(box, tag).text = str(int(round(value)))
+
+    ElementTree.ElementTree(annotation).write(path, encoding='utf-8')
+
+def convert(task):
+    """
+    Function to convert the labels of a photo, it runs in the workers of the pool.
+    YOLO and VOC files are written by the worker, COCO boxes are returned to be written in one file.
+
+    params:
+        - task: (format, directory, output, name, labels, info), info is the entry of the metadata index.
+
+    return:
+        - (name, width, height, boxes) or (name, None, None, None) if the photo can not be read.
+    """
+    format, directory, output, name, labels, info = task
+
+    try:
+        size = imageSize(os.path.join(directory, name), info)
+    except OSError:
+        size = None
+
+    if size is None :
+        return name, None, None, None
+
+    width, height = size
+    base = os.path.join(output, os.path.splitext(name)[0])
+
+    # The photos of a project are named folder/photo, their files keep the folder
+    if format != 'coco' :
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+
+    if format == 'yolo' :
+        writeYolo(base + ".txt", width, height, labels)
+    elif format == 'voc' :
+        writeVoc(base + ".xml", name, width, height, labels)
+    else :
+        return name, width, height, list(boxes(labels))
+
+    return name, width, height, None
+
+class CocoWriter():
+    """
+    Class to write a COCO file without keeping it in memory.
+    The images are written as they arrive and the annotations go to a temporary file which is
+    appended at the end, the file is renamed over the destination when it is complete.
+
+    params:
+        - path: destination file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + ".tmp", 'w')
+        self.annotations = open(path + ".annotations", 'w+')
+        self.images = 0
+        self.boxes = 0
+
+        categories = [{ 'id': i + 1, 'name': CLASSES[i], 'supercategory': 'person' } for i in range(0, len(CLASSES))]
+        self.file.write('{"categories": ' + json.dumps(categories) + ', "images": [')
+
+    def add(self, name, width, height, boxes):
+        """
+        Function to add a photo and its boxes.
+        """
+        self.images += 1
+        image = { 'id': self.images, 'file_name': name, 'width': width, 'height': height }
+        self.file.write((", " if self.images > 1 else "") + json.dumps(image))
+
+        for cls, x1, y1, x2, y2, number in boxes :
+            self.boxes += 1
+            box = { 'id': self.boxes, 'image_id': self.images, 'category_id': cls + 1,
+                    'bbox': [x1, y1, x2 - x1, y2 - y1], 'area': (x2 - x1) * (y2 - y1), 'iscrowd': 0 }
+            if number is not None :
+                box['number'] = number
+
+            self.annotations.write((", " if self.boxes > 1 else "") + json.dumps(box))
+
+    def close(self):
+        """
+        Function to join the images and the annotations and write the file.
+        """
+        self.file.write('], "annotations": [')
+        self.annotations.seek(0)
+        shutil.copyfileobj(self.annotations, self.file)
+        self.file.write(']}')
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.annotations.close()
+
+        os.replace(self.path + ".tmp", self.path)
+        os.remove(self.path + ".annotations")
+
+def readMetadata(fileLabels):
+    """
+    Function to read the metadata index of the app (see Metadata.MetadataIndex) if there is one.
+    It is read directly, the index module needs Qt.
+    """
+    try:
+        with open(fileLabels + ".meta", 'r') as file :
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def export(fileLabels, format, output, directory=None, workers=None):
+    """
+    Function to export the labels of a labels' file (JSON or SQLite).
+    The labels' file is streamed and the photos are converted in a pool of processes.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - format: 'coco' (output is a file), 'yolo' or 'voc' (output is a folder).
+        - directory: folder of the photos, the folder of the labels' file by default.
+        - workers: number of processes, the number of cores by default.
+
+    return:
+        - exported: number of photos exported.
+        - skipped: photos missing in the folder or with an unknown format.
+    """
+    directory = directory if directory else os.path.dirname(fileLabels)
+    metadata = readMetadata(fileLabels)
+    writer = None
+
+    if format == 'coco' :
+        writer = CocoWriter(output)
+    else :
+        os.makedirs(output, exist_ok=True)
+
+    if format == 'yolo' :
+        with open(os.path.join(output, "classes.txt"), 'w') as file :
+            file.write("\n".join(CLASSES) + "\n")
+
+    exported = 0
+    skipped = 0
+    labels = iterLabels(fileLabels)
+
+    def collect(results):
+        nonlocal exported, skipped
+
+        for name, width, height, found in results :
+            if width is None :
+                skipped += 1
+                continue
+
+            exported += 1
+            if writer :
+                writer.add(name, width, height, found)
+
+    # A batch is given to the workers before the results of the previous one are collected, so the
+    # next batch is read while they convert, and only two batches are in memory
+    with multiprocessing.Pool(workers) as pool :
+        previous = None
+
+        while True :
+            batch = [(format, directory, output, name, people, metadata.get(name, None))
+                     for name, people in itertools.islice(labels, BATCH)]
+            current = pool.imap(convert, batch, chunksize=64) if batch else None
+
+            if previous is not None :
+                collect(previous)
+            if current is None :
+                break
+
+            previous = current
+
+    if writer :
+        writer.close()
+
+    return exported, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the labels to COCO, YOLO or Pascal VOC, persons and dorsals as separate classes.")
+    parser.add_argument('format', choices=FORMATS)
+    parser.add_argument('labels', help="labels' file (JSON or SQLite)")
+    parser.add_argument('output', help="COCO file or folder for the YOLO and VOC files")
+    parser.add_argument('--images', default=None, help="folder of the photos, the folder of the labels' file by default")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, the number of cores by default")
+    args = parser.parse_args()
+
+    exported, skipped = export(args.labels, args.format, args.output, args.images, args.workers)
+    print("Exported %d photos, %d skipped (missing or unknown format)" % (exported, skipped))
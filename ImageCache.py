@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+Background image loader and decode cache
+Author: Carlos Herrero
+"""
+
+from PyQt5.QtGui import QImage, QImageReader, QPixmap
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QRect, pyqtSignal
+
+from collections import OrderedDict
+
+import Trace
+
+CACHE_SIZE = 512        # MB of decoded images kept in memory
+PREFETCH_DEPTH = 3      # photos decoded ahead and behind the actual one
+
+def readImage(path, maxSide=0):
+    """
+    Function to decode an image applying its EXIF orientation.
+    If maxSide is given, the image is decoded directly at a reduced size with its longest side
+    equal to maxSide, JPEG decoders skip most of the work in this case.
+    """
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+
+    if maxSide > 0 :
+        size = reader.size()
+        longest = max(size.width(), size.height())
+
+        if longest > maxSide :
+            reader.setScaledSize(size * (maxSide / longest))
+
+    return reader.read()
+
+class LoaderSignals(QObject):
+    """
+    Class with the signals of the image loaders, QRunnable can not emit signals by itself.
+    """
+    loaded = pyqtSignal(str, int, QImage)
+    tile = pyqtSignal(str, QRect, QImage)
+
+class ImageLoader(QRunnable):
+    """
+    Class to decode an image in a worker thread of the pool.
+
+    params:
+        - path: image path.
+        - maxSide: longest side of the decoded image, 0 for full resolution.
+        - signals: LoaderSignals where the decoded image is emitted.
+    """
+
+    def __init__(self, path, maxSide, signals):
+        super(ImageLoader, self).__init__()
+        self.path = path
+        self.maxSide = maxSide
+        self.signals = signals
+
+    def run(self):
+        with Trace.span('prefetch decode') :
+            image = readImage(self.path, self.maxSide)
+
+        self.signals.loaded.emit(self.path, self.maxSide, image)
+
+class TileLoader(QRunnable):
+    """
+    Class to decode a region of an image at full resolution in a worker thread of the pool.
+
+    params:
+        - path: image path.
+        - rect: region of the image in original pixels. (QRect)
+        - signals: LoaderSignals where the decoded tile is emitted.
+    """
+
+    def __init__(self, path, rect, signals):
+        super(TileLoader, self).__init__()
+        self.path = path
+        self.rect = rect
+        self.signals = signals
+
+    def run(self):
+        with Trace.span('tile decode') :
+            reader = QImageReader(self.path)
+            reader.setClipRect(self.rect)
+            image = reader.read()
+
+        self.signals.tile.emit(self.path, self.rect, image)
+
+class ImageCache(QObject):
+    """
+    Class to keep the decoded photos in memory and prefetch the neighbours of the actual photo.
+    The photos are decoded in a QThreadPool as QImage and kept in a LRU cache bounded by memory,
+    so going to the next or previous photo shows the image right away.
+
+    params:
+        - size: maximum memory of the cache in MB.
+        - depth: number of photos prefetched before and after the actual one.
+        - maxSide: longest side of the decoded photos, 0 for full resolution.
+        - parent: QObject parent.
+    """
+
+    def __init__(self, size=CACHE_SIZE, depth=PREFETCH_DEPTH, maxSide=0, parent=None):
+        super(ImageCache, self).__init__(parent)
+        self.size = size * 1024 * 1024
+        self.depth = depth
+        self.maxSide = maxSide
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.images = OrderedDict()
+        self.pending = set()
+
+        # The signals are a child created after the pool, they are deleted once the pool has waited for its workers
+        self.pool = QThreadPool(self)
+        self.signals = LoaderSignals(self)
+        self.signals.loaded.connect(self.onLoaded)
+
+    def pixmap(self, path):
+        """
+        Function to obtain the pixmap of a photo.
+        The photo is taken from the cache, if it is not there it is decoded right now.
+        """
+        image = self.images.get(path, None)
+
+        if image is not None :
+            self.hits += 1
+            self.images.move_to_end(path)
+        else :
+            self.misses += 1
+            with Trace.span('decode') :
+                image = readImage(path, self.maxSide)
+            self.insert(path, image)
+
+        with Trace.span('pixmap') :
+            return QPixmap.fromImage(image)
+
+    def prefetch(self, directory, photos, pos):
+        """
+        Function to decode in background the photos around the actual position.
+
+        params:
+            - directory: folder of the photos.
+            - photos: list with the name of every photo in navigation order.
+            - pos: actual position in the list.
+        """
+        if len(photos) == 0 :
+            return
+
+        # A lazy list (see Project.Timeline) does not go round, the other end would be read
+        ends = not isinstance(photos, list)
+        names = []
+
+        for i in range(1, self.depth + 1) :
+            for j in (pos + i, pos - i) :
+                if ends and (j < 0 or j >= len(photos)) :
+                    continue
+
+                names.append(photos[j % len(photos)])
+
+        self.prefetchNames(directory, names)
+
+    def prefetchNames(self, directory, names):
+        """
+        Function to decode in background some photos, used when the navigation skips photos
+        (no labeled, search and batch modes).
+
+        params:
+            - directory: folder of the photos.
+            - names: names of the photos, the first ones are decoded first.
+        """
+        for name in names :
+            path = directory + "/" + name
+            if path not in self.images and path not in self.pending :
+                self.pending.add(path)
+                self.pool.start(ImageLoader(path, self.maxSide, self.signals))
+
+    def loadTile(self, path, rect):
+        """
+        Function to decode in background a region of a photo at full resolution.
+        The tile is emitted by the tile signal of self.signals.
+        """
+        self.pool.start(TileLoader(path, rect, self.signals))
+
+    def onLoaded(self, path, maxSide, image):
+        """
+        Function to capture the images decoded by the workers.
+        Images decoded before a change of the display size are discarded.
+        """
+        self.pending.discard(path)
+
+        if not image.isNull() and path not in self.images and maxSide == self.maxSide :
+            self.insert(path, image)
+
+    def insert(self, path, image):
+        """
+        Function to add an image to the cache removing the least recently used ones.
+        """
+        cost = image.sizeInBytes()
+
+        # Images bigger than the whole cache are not kept
+        if cost > self.size :
+            return
+
+        self.images[path] = image
+        self.used += cost
+
+        while self.used > self.size :
+            _, old = self.images.popitem(last=False)
+            self.used -= old.sizeInBytes()
+
+    def discard(self, path):
+        """
+        Function to remove a photo from the cache, used when the photo is modified.
+        """
+        image = self.images.pop(path, None)
+        if image is not None :
+            self.used -= image.sizeInBytes()
+
+    def resize(self, size=None, depth=None):
+        """
+        Function to change the memory of the cache (MB) or the prefetch depth.
+        """
+        if size is not None :
+            self.size = size * 1024 * 1024
+
+            while self.used > self.size and len(self.images) > 0 :
+                _, old = self.images.popitem(last=False)
+                self.used -= old.sizeInBytes()
+
+        if depth is not None :
+            self.depth = depth
+
+    def setMaxSide(self, maxSide):
+        """
+        Function to change the size of the decoded photos, the cached photos are discarded.
+        """
+        if maxSide != self.maxSide :
+            self.maxSide = maxSide
+            self.clear()
+
+    def clear(self):
+        """
+        Function to empty the cache, used when we open another folder.
+        """
+        self.pool.clear()
+        self.images.clear()
+        self.pending.clear()
+        self.used = 0
+
+    def shutdown(self):
+        """
+        Function to stop the loaders before the app is closed: the photos not started are discarded
+        and the running ones are waited, so no worker emits on deleted signals.
+        """
+        self.clear()
+        self.pool.waitForDone()
+
+    def stats(self):
+        """
+        Function to obtain the counters of the cache.
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'ratio': self.hits / total if total > 0 else 0.0,
+            'images': len(self.images),
+            'memory': self.used,
+        }
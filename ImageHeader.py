@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Image dimensions and capture time from the file headers, without Qt
+Author: Carlos Herrero
+"""
+
+import time
+import struct
+import calendar
+
+# JPEG start of frame markers (the ones with the dimensions of the image)
+SOF = { 0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF }
+
+def readSize(path):
+    """
+    Function to read the dimensions of a JPEG, PNG or WEBP image from its header.
+    Only a few KB of the file are read, the image is not decoded. The EXIF orientation of JPEG
+    images is applied, as the decoder of the app does, so the dimensions match the labels.
+
+    return:
+        - (width, height) or None if the format is not known or the header is broken.
+    """
+    with open(path, 'rb') as file :
+        head = file.read(32)
+
+        try:
+            if head[0:8] == b'\x89PNG\r\n\x1a\n' :
+                return pngSize(head)
+            if head[0:2] == b'\xff\xd8' :
+                return jpegSize(file)
+            if head[0:4] == b'RIFF' and head[8:12] == b'WEBP' :
+                return webpSize(head)
+        except (struct.error, IndexError):
+            return None
+
+    return None
+
+def pngSize(head):
+    """
+    Function to read the dimensions of the IHDR chunk, always the first one.
+    """
+    if head[12:16] != b'IHDR' :
+        return None
+
+    return struct.unpack('>II', head[16:24])
+
+def webpSize(head):
+    """
+    Function to read the dimensions of the first chunk of a WEBP image (lossy, lossless or extended).
+    """
+    chunk = head[12:16]
+
+    if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a' :
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+
+    if chunk == b'VP8L' and head[20] == 0x2F :
+        bits = struct.unpack('<I', head[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+
+    if chunk == b'VP8X' :
+        return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+
+    return None
+
+def readTime(path):
+    """
+    Function to read the capture time of a JPEG image from its EXIF segment (DateTimeOriginal with
+    SubSecTimeOriginal, or DateTime), only the segments before the image data are read.
+
+    return:
+        - seconds since the epoch of the clock of the camera (taken as UTC), None if the image has no date.
+    """
+    with open(path, 'rb') as file :
+        if file.read(2) != b'\xff\xd8' :
+            return None
+
+        try:
+            for marker, length in segments(file) :
+                if marker == 0xE1 :
+                    found = exifTime(file.read(length - 2))
+                    if found is not None :
+                        return found
+                elif marker in SOF :
+                    return None
+        except (struct.error, IndexError, ValueError):
+            return None
+
+    return None
+
+def segments(file):
+    """
+    Function to walk the segments of a JPEG image until the image data.
+    The file is after the length of the segment, it can be read or not.
+
+    yields:
+        - (marker, length) of every segment.
+    """
+    file.seek(2)
+
+    while True :
+        byte = file.read(1)
+        while byte and byte != b'\xff' :
+            byte = file.read(1)
+        while byte == b'\xff' :
+            byte = file.read(1)
+
+        if not byte :
+            return
+
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7 :
+            continue
+        if marker in (0xD9, 0xDA) :
+            return
+
+        length = struct.unpack('>H', file.read(2))[0]
+        start = file.tell()
+        yield marker, length
+        file.seek(start + length - 2)
+
+def jpegSize(file):
+    """
+    Function to walk the segments of a JPEG image until the start of frame.
+    The EXIF segment is before it, orientations 5 to 8 rotate the image 90 degrees.
+    """
+    rotated = False
+
+    for marker, length in segments(file) :
+        if marker in SOF :
+            height, width = struct.unpack('>xHH', file.read(5))
+            return (height, width) if rotated else (width, height)
+
+        if marker == 0xE1 :
+            rotated = exifOrientation(file.read(length - 2)) in (5, 6, 7, 8)
+
+    return None
+
+def exifOrientation(segment):
+    """
+    Function to read the orientation tag (0x0112) of the first IFD of an EXIF segment.
+    """
+    if segment[0:6] != b'Exif\x00\x00' :
+        return None
+
+    tiff = segment[6:]
+    order = '<' if tiff[0:2] == b'II' else '>'
+    offset = struct.unpack(order + 'I', tiff[4:8])[0]
+    entries = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+
+    for i in range(0, entries) :
+        entry = offset + 2 + i * 12
+        tag, kind = struct.unpack(order + 'HH', tiff[entry:entry + 4])
+
+        if tag == 0x0112 :
+            return struct.unpack(order + 'H', tiff[entry + 8:entry + 10])[0]
+
+    return None
+
+def ifd(tiff, order, offset):
+    """
+    Function to read the entries of an IFD of an EXIF segment.
+
+    return:
+        - dict with (type, count, value or offset bytes) of every tag.
+    """
+    entries = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    tags = {}
+
+    for i in range(0, entries) :
+        entry = offset + 2 + i * 12
+        tag, kind, count = struct.unpack(order + 'HHI', tiff[entry:entry + 8])
+        tags[tag] = (kind, count, tiff[entry + 8:entry + 12])
+
+    return tags
+
+def ifdText(tiff, order, value):
+    """
+    Function to read an ASCII value of an IFD, in the entry if it has 4 bytes or less.
+    """
+    kind, count, data = value
+    if count > 4 :
+        start = struct.unpack(order + 'I', data)[0]
+        data = tiff[start:start + count]
+
+    return data[0:count].split(b'\x00')[0].decode('ascii', 'replace').strip()
+
+def exifTime(segment):
+    """
+    Function to read the capture time of an EXIF segment, in seconds since the epoch.
+    """
+    if segment[0:6] != b'Exif\x00\x00' :
+        return None
+
+    tiff = segment[6:]
+    order = '<' if tiff[0:2] == b'II' else '>'
+    first = ifd(tiff, order, struct.unpack(order + 'I', tiff[4:8])[0])
+    exif = ifd(tiff, order, struct.unpack(order + 'I', first[0x8769][2])[0]) if 0x8769 in first else {}
+
+    if 0x9003 in exif :
+        date = ifdText(tiff, order, exif[0x9003])
+        subsec = ifdText(tiff, order, exif[0x9291]) if 0x9291 in exif else ""
+    elif 0x0132 in first :
+        date = ifdText(tiff, order, first[0x0132])
+        subsec = ""
+    else :
+        return None
+
+    seconds = calendar.timegm(time.strptime(date, "%Y:%m:%d %H:%M:%S"))
+    return seconds + (float("0." + subsec) if subsec.isdigit() else 0.0)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-memory indexes over the labels
+Author: Carlos Herrero
+"""
+
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SCAN = 256          # photos scanned at once looking for the next photo without labels
+
+class UnlabeledIndex():
+    """
+    Class to keep the positions of the photos without labels in the photos list.
+    The positions are kept in a sorted list, updated every time the labels of a photo change,
+    so the next photo without labels and the progress are obtained without scanning the labels.
+
+    The photos list is scanned as the positions are needed. A lazy list (see Project.Timeline)
+    is not scanned, it finds the next photo without labels itself (see Timeline.following).
+    """
+
+    def __init__(self):
+        self.photos = []
+        self.empty = set()
+        self.positions = []
+        self.position = {}
+        self.scanned = 0
+        self.total = 0
+
+    def build(self, photos, data):
+        """
+        Function to create the index for a photos list.
+
+        params:
+            - photos: list with the name of every photo in navigation order.
+            - data: dict with the labels of every photo.
+        """
+        self.photos = photos
+        self.empty = { name for name, labels in data.items() if len(labels) == 0 }
+        self.positions = []
+        self.position = {}
+        self.scanned = 0
+        self.total = len(photos)
+
+    def scan(self, count):
+        """
+        Function to find the photos without labels in the first count photos of the list.
+        """
+        count = min(count, self.total)
+
+        for i in range(self.scanned, count) :
+            name = self.photos[i]
+            self.position[name] = i
+
+            if name in self.empty :
+                self.positions.append(i)
+
+        self.scanned = max(self.scanned, count)
+
+    def update(self, name, labels):
+        """
+        Function to update the index when the labels of a photo change.
+        """
+        if len(labels) == 0 :
+            self.empty.add(name)
+        else :
+            self.empty.discard(name)
+
+        i = self.position.get(name, None)
+        if i is None :
+            return
+
+        j = bisect.bisect_left(self.positions, i)
+        present = j < len(self.positions) and self.positions[j] == i
+
+        if len(labels) == 0 and not present :
+            self.positions.insert(j, i)
+        elif len(labels) > 0 and present :
+            del self.positions[j]
+
+    def first(self):
+        """
+        Function to obtain the position of the first photo without labels, None if all are labelled.
+        """
+        return self.next(-1)
+
+    def next(self, pos):
+        """
+        Function to obtain the position of the next photo without labels after pos, going back to
+        the beginning at the end of the list. None if all are labelled.
+        """
+        if not self.empty :
+            return None
+
+        if not isinstance(self.photos, list) :
+            return self.photos.following(pos if pos >= 0 else None, self.empty)
+
+        j = bisect.bisect_right(self.positions, pos)
+
+        while j == len(self.positions) and self.scanned < self.total :
+            self.scan(self.scanned + SCAN)
+            j = bisect.bisect_right(self.positions, pos)
+
+        if j < len(self.positions) :
+            return self.positions[j]
+
+        return self.positions[0] if self.positions else None
+
+    def previous(self, pos):
+        """
+        Function to obtain the position of the previous photo without labels before pos, going to
+        the end at the beginning of the list. None if all are labelled.
+        """
+        if not self.empty :
+            return None
+
+        if not isinstance(self.photos, list) :
+            return self.photos.following(pos, self.empty, forward=False)
+
+        self.scan(pos + 1)
+        j = bisect.bisect_left(self.positions, pos)
+        if j > 0 :
+            return self.positions[j - 1]
+
+        self.scan(self.total)
+        return self.positions[-1] if self.positions else None
+
+    def labelled(self):
+        """
+        Function to obtain the number of photos with labels.
+        """
+        return self.total - len(self.empty)
+
+class NumberIndex():
+    """
+    Class to find the photos where a dorsal number appears.
+    It is an inverted index from the dorsal number to the photos and the persons of the photo
+    with that number. It is built in bulk when the labels are loaded: the numbers of all the
+    persons are read in one pass and grouped by number with a sort (numpy), and every change of
+    the labels of a photo is applied over it (the photo is marked stale in the bulk arrays).
+    Without numpy the photos are added one by one.
+    """
+
+    def __init__(self):
+        self.numbers = {}
+        self.photos = {}
+        self.clearBulk()
+
+    def clearBulk(self):
+        self.names = []
+        self.groups = {}
+        self.photo = None
+        self.person = None
+        self.bulk = {}
+        self.stale = set()
+
+    def build(self, data):
+        """
+        Function to create the index from the labels of every photo (lists of LabelStore.Person).
+        """
+        self.numbers = {}
+        self.photos = {}
+        self.clearBulk()
+
+        if numpy is None :
+            for name, labels in data.items() :
+                self.add(name, labels)
+            return
+
+        # One pass over the persons: the number of every person (NaN without number) and the persons of every photo
+        names = list(data.keys())
+        labels = list(data.values())
+        counts = numpy.array([len(people) if isinstance(people, list) else 0 for people in labels], dtype=numpy.int64)
+        number = numpy.array([person.number for people in labels if isinstance(people, list) for person in people], dtype=numpy.float64)
+        photo = numpy.repeat(numpy.arange(len(names), dtype=numpy.int64), counts)
+        person = numpy.arange(len(number), dtype=numpy.int64) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+
+        # The labels not read of a lazy store know their numbers
+        lazy = [(k, pair) for k in range(0, len(labels)) if not isinstance(labels[k], list) for pair in labels[k].numbers()]
+        if lazy :
+            number = numpy.concatenate([number, numpy.array([pair[0] for k, pair in lazy], dtype=numpy.float64)])
+            photo = numpy.concatenate([photo, numpy.array([k for k, pair in lazy], dtype=numpy.int64)])
+            person = numpy.concatenate([person, numpy.array([pair[1] for k, pair in lazy], dtype=numpy.int64)])
+
+        valid = ~numpy.isnan(number)
+        number, photo, person = number[valid].astype(numpy.int64), photo[valid], person[valid]
+
+        # Grouped by number, the persons of a number keep the order of the photos
+        order = numpy.lexsort((person, photo, number))
+        values, starts = numpy.unique(number[order], return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+
+        self.names = names
+        self.bulk = dict(zip(names, range(0, len(names))))
+        self.groups = dict(zip(values.tolist(), zip(starts.tolist(), ends.tolist())))
+        self.photo = photo[order]
+        self.person = person[order]
+
+    def add(self, name, labels):
+        """
+        Function to add the dorsal numbers of a photo to the index.
+        The labels not read of a lazy store (LazyLabels.Lazy) know their numbers.
+        """
+        if name in self.bulk :
+            self.stale.add(name)
+
+        numbers = numbersOf(labels)
+        if not numbers :
+            return
+
+        self.photos[name] = numbers
+        for number, i in numbers :
+            self.numbers.setdefault(number, {}).setdefault(name, []).append(i)
+
+    def remove(self, name):
+        """
+        Function to remove the dorsal numbers of a photo from the index.
+        """
+        if name in self.bulk :
+            self.stale.add(name)
+
+        for number in set(number for number, i in self.photos.pop(name, [])) :
+            photos = self.numbers[number]
+            del photos[name]
+
+            if not photos :
+                del self.numbers[number]
+
+    def update(self, name, labels):
+        """
+        Function to update the index when the labels of a photo change.
+        The persons of a photo are renumbered when one is removed, so the photo is indexed again.
+        """
+        self.remove(name)
+        self.add(name, labels)
+
+    def find(self, number):
+        """
+        Function to obtain the photos where a dorsal number appears.
+
+        return:
+            - dict with the name of every photo and the list of persons with that number.
+        """
+        found = {}
+
+        if number in self.groups :
+            start, end = self.groups[number]
+            for k, i in zip(self.photo[start:end].tolist(), self.person[start:end].tolist()) :
+                name = self.names[k]
+                if name not in self.stale :
+                    found.setdefault(name, []).append(i)
+
+        found.update(self.numbers.get(number, {}))
+        return found
+
+def numbersOf(labels):
+    """
+    Function to obtain the dorsal numbers of the labels of a photo as (number, person index).
+    The labels not read of a lazy store (LazyLabels.Lazy) know their numbers.
+    """
+    if isinstance(labels, list) :
+        return [(person.number, i) for i, person in enumerate(labels) if person.number is not None]
+
+    return labels.numbers()
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append-only change journal for the labels' file
+Author: Carlos Herrero
+"""
+
+import os
+import json
+import time
+import threading
+
+import Trace
+
+JOURNAL = ".journal"
+COMPACTING = ".compacting"
+DELAY = 1.0         # seconds without changes before they are written
+
+PENDING = "pending"
+SAVING = "saving"
+SAVED = "saved"
+FAILED = "failed"
+
+def encode(obj):
+    """
+    Function to serialize the labels kept as objects (see LabelStore.Person).
+    """
+    return obj.toDict()
+
+def writeAtomic(path, obj):
+    """
+    Function to write a JSON object to a file atomically.
+    The object is written to a temporary file next to the destination, flushed to disk and
+    renamed over the original, so a crash in the middle of a save never truncates the file.
+    The keys are sorted, a labels' file is in the order of the photos and can be merged streaming.
+
+    params:
+        - path: destination file.
+        - obj: JSON serializable object, labels can be LabelStore.Person objects.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as file :
+        json.dump(obj, file, default=encode, sort_keys=True)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(tmp, path)
+
+def openAppend(path):
+    """
+    Function to open a file of JSON lines to append lines to it.
+    If its last line is broken (crash in the middle of an append) a newline is written first,
+    so the next line is not glued to it.
+    """
+    try:
+        with open(path, 'rb') as file :
+            file.seek(-1, os.SEEK_END)
+            broken = file.read(1) != b"\n"
+    except OSError:
+        broken = False
+
+    file = open(path, 'a')
+    if broken :
+        file.write("\n")
+
+    return file
+
+class Journal():
+    """
+    Class to manage the change journal of a labels' file.
+    Every change to the labels of a photo is appended as one JSON line with the new labels
+    of that photo, so saving a change costs a few bytes instead of rewriting the whole file.
+    The journal is compacted into the labels' file when it grows or on exit.
+
+    Entries are idempotent ({"photo": name, "labels": [...]}), replaying an entry twice
+    gives the same result, so a crash at any point of the compaction is safe.
+
+    Nothing is written in the thread of the caller: the changes are kept by photo and written
+    by a writer thread once there are no new changes for a while (quick navigation is one write),
+    the compactions are written by the same thread in order. The state of the writer is
+    PENDING, SAVING, SAVED or FAILED (the changes are kept and written with the next ones).
+
+    params:
+        - fileLabels: path of the labels' file.
+        - limit: number of entries after which a compaction is started.
+        - delay: seconds without changes before they are written.
+
+    The labels' file is written with writer(path, snapshot), writeAtomic by default.
+    """
+
+    def __init__(self, fileLabels, limit=500, delay=DELAY):
+        self.fileLabels = fileLabels
+        self.path = fileLabels + JOURNAL
+        self.compacting = fileLabels + COMPACTING
+        self.limit = limit
+        self.delay = delay
+        self.entries = 0
+        self.file = None
+        self.writer = writeAtomic
+
+        # Work of the writer thread, guarded by the condition
+        self.changes = {}
+        self.snapshot = None
+        self.changed = 0
+        self.flushing = False
+        self.closing = False
+        self.busy = False
+        self.state = SAVED
+        self.error = None
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def replay(self, data):
+        """
+        Function to apply the pending entries of the journal to the labels loaded from the file.
+        The entries of an interrupted compaction are applied first.
+        A broken line (crash in the middle of an append) is ignored.
+        """
+        self.idle()
+        # The entries are counted again, the journal may have been replayed before
+        self.entries = 0
+
+        for path in (self.compacting, self.path) :
+            if not os.path.exists(path) :
+                continue
+
+            with open(path, 'r') as file :
+                for line in file :
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    data[entry['photo']] = entry['labels']
+                    if path == self.path :
+                        self.entries += 1
+
+        return data
+
+    def record(self, name, labels):
+        """
+        Function to add the new labels of a photo to the changes to write.
+        """
+        with self.condition :
+            self.changes[name] = labels
+            self.changed = time.monotonic()
+            self.state = PENDING
+            self.start()
+            self.condition.notify_all()
+
+    def pending(self):
+        """
+        Function to know if there are changes not compacted in the labels' file.
+        """
+        with self.condition :
+            return self.entries > 0 or len(self.changes) > 0
+
+    def status(self):
+        """
+        Function to obtain the state of the writer and the error of the last write.
+        """
+        with self.condition :
+            return self.state, self.error
+
+    def compactIfNeeded(self, data):
+        """
+        Function to start a compaction when the journal is bigger than the limit.
+        """
+        with self.condition :
+            needed = self.entries + len(self.changes) >= self.limit
+
+        if needed :
+            self.compact(data)
+
+    def compact(self, data):
+        """
+        Function to write all the labels in the labels' file and clear the journal.
+        Only the snapshot is taken here, the writer thread rotates the journal and writes the file.
+
+        params:
+            - data: dict with the labels of every photo.
+        """
+        # Labels are never modified once they are stored, a shallow copy is a snapshot
+        # (the labels not read of a lazy store are not lists and never change)
+        snapshot = { name: list(labels) if isinstance(labels, list) else labels for name, labels in data.items() }
+
+        with self.condition :
+            # The changes not written yet are in the snapshot
+            self.snapshot = snapshot
+            self.changes = {}
+            self.entries = 0
+            self.state = PENDING
+            self.start()
+            self.condition.notify_all()
+
+    def flush(self, wait=False):
+        """
+        Function to write the changes now, without waiting for the delay.
+
+        params:
+            - wait: wait until everything is written, the error of the write is raised.
+        """
+        with self.condition :
+            if self.work() :
+                self.flushing = True
+                self.state = PENDING
+                self.start()
+                self.condition.notify_all()
+
+            if wait :
+                while (self.busy or self.work()) and self.state != FAILED :
+                    self.condition.wait()
+
+                if self.state == FAILED :
+                    raise self.error
+
+    def start(self):
+        """
+        Function to start the writer thread, used with the condition acquired.
+        """
+        if self.thread is None :
+            self.closing = False
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def work(self):
+        """
+        Function to know if there is something to write, used with the condition acquired.
+        """
+        return len(self.changes) > 0 or self.snapshot is not None
+
+    def run(self):
+        """
+        Function of the writer thread.
+        """
+        while True :
+            batch = self.take()
+            if batch is None :
+                return
+
+            changes, snapshot = batch
+            try:
+                self.write(changes, snapshot)
+                error = None
+            except OSError as e:
+                error = e
+
+            self.done(changes, snapshot, error)
+
+    def take(self):
+        """
+        Function to wait for work, and for the delay without changes, and take it.
+
+        return:
+            - (changes, snapshot) or None when the journal is closed.
+        """
+        with self.condition :
+            # The failed changes are not written again until there are new changes or a flush
+            while not self.closing and (not self.work() or self.state == FAILED) :
+                self.condition.wait()
+
+            if not self.work() or self.state == FAILED :
+                return None
+
+            while not self.flushing and not self.closing :
+                remaining = self.changed + self.delay - time.monotonic()
+                if remaining <= 0 :
+                    break
+                self.condition.wait(remaining)
+
+            batch = (self.changes, self.snapshot)
+            self.changes = {}
+            self.snapshot = None
+            self.flushing = False
+            self.busy = True
+            self.state = SAVING
+            return batch
+
+    def done(self, changes, snapshot, error):
+        """
+        Function to update the state after a write, the changes of a failed write are kept.
+        """
+        with self.condition :
+            self.busy = False
+
+            if error is None :
+                self.entries += len(changes)
+                self.state = PENDING if self.work() else SAVED
+                self.error = None
+            else :
+                for name, labels in changes.items() :
+                    self.changes.setdefault(name, labels)
+                if snapshot is not None and self.snapshot is None :
+                    self.snapshot = snapshot
+
+                self.state = FAILED
+                self.error = error
+
+            self.condition.notify_all()
+
+    def write(self, changes, snapshot):
+        """
+        Function to write a snapshot of the labels and then the changes made after it.
+        """
+        if snapshot is not None :
+            with Trace.span('compaction') :
+                self.rotate()
+                self.writer(self.fileLabels, snapshot)
+
+            if os.path.exists(self.compacting) :
+                os.remove(self.compacting)
+
+        if changes :
+            with Trace.span('journal') :
+                # A broken last line (crash in the middle of an append) is ended first
+                if self.file is None :
+                    self.file = openAppend(self.path)
+
+                self.file.write("".join(json.dumps({ 'photo': name, 'labels': labels }, default=encode) + "\n"
+                                        for name, labels in changes.items()))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def rotate(self):
+        """
+        Function to move the journal aside before a compaction, new changes go to a fresh journal.
+        If a previous compaction failed its entries are kept and the journal is appended to them.
+        """
+        if self.file :
+            self.file.close()
+            self.file = None
+
+        if not os.path.exists(self.path) :
+            return
+
+        if os.path.exists(self.compacting) :
+            with open(self.path, 'r') as source, open(self.compacting, 'a') as file :
+                file.write("\n" + source.read())
+                file.flush()
+                os.fsync(file.fileno())
+            os.remove(self.path)
+        else :
+            os.replace(self.path, self.compacting)
+
+    def idle(self):
+        """
+        Function to wait until the writer thread finishes the running write.
+        """
+        with self.condition :
+            while self.busy :
+                self.condition.wait()
+
+    def clear(self):
+        """
+        Function to discard the journal, used when a new labels' file is created.
+        """
+        with self.condition :
+            self.changes = {}
+            self.snapshot = None
+
+            while self.busy :
+                self.condition.wait()
+
+            if self.file :
+                self.file.close()
+                self.file = None
+
+            for path in (self.path, self.compacting) :
+                if os.path.exists(path) :
+                    os.remove(path)
+
+            self.entries = 0
+            self.state = SAVED
+            self.error = None
+
+    def close(self, data):
+        """
+        Function to compact the pending changes and close the journal, used on exit.
+        The error of the write is raised and the journal is kept open.
+        """
+        if self.pending() or os.path.exists(self.compacting) :
+            self.compact(data)
+
+        self.flush(wait=True)
+
+        with self.condition :
+            self.closing = True
+            self.condition.notify_all()
+            thread = self.thread
+            self.thread = None
+
+        if thread :
+            thread.join()
+
+        if self.file :
+            self.file.close()
+            self.file = None
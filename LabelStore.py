@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless store of the labels
+Author: Carlos Herrero
+"""
+
+import os
+import math
+import bisect
+from array import array
+
+from Storage import openStorage
+from Indexes import UnlabeledIndex, NumberIndex
+from LazyLabels import Lazy
+
+NAN = float('nan')
+LAZY_SIZE = 64 * 1024 * 1024     # JSON files bigger than this are loaded lazily
+
+class Person():
+    """
+    Class with the label of a person: the box of the person and the box and number of the dorsal.
+    The 8 coordinates are kept in one array of doubles (person x1, y1, x2, y2 and dorsal x1, y1, x2, y2,
+    NaN when there is no dorsal) instead of nested dicts and lists of floats.
+    A Person is not modified once it is in the store, so a shallow copy of a labels list is a snapshot.
+
+    params:
+        - position: [x1, y1, x2, y2] of the person.
+        - numberPosition: [x1, y1, x2, y2] of the dorsal or None.
+        - number: dorsal number or None.
+    """
+    __slots__ = ('box', 'number')
+
+    def __init__(self, position, numberPosition=None, number=None):
+        self.box = array('d', list(position) + list(numberPosition if numberPosition else (NAN, NAN, NAN, NAN)))
+        self.number = number
+
+    @property
+    def position(self):
+        return tuple(self.box[0:4])
+
+    @property
+    def numberPosition(self):
+        return None if math.isnan(self.box[4]) else tuple(self.box[4:8])
+
+    @staticmethod
+    def fromDict(person):
+        """
+        Function to create a Person from the JSON structure of a label:
+        { 'position': [...], 'number': { 'position': [...], 'number': n } }
+        """
+        dorsal = person.get('number', None)
+
+        if dorsal :
+            return Person(person['position'], dorsal['position'], dorsal.get('number', None))
+
+        return Person(person['position'])
+
+    def toDict(self):
+        """
+        Function to obtain the JSON structure of the label.
+        """
+        person = { 'position': list(self.box[0:4]) }
+        numberPosition = self.numberPosition
+
+        if numberPosition :
+            person['number'] = { 'position': list(numberPosition) }
+            if self.number is not None :
+                person['number']['number'] = self.number
+
+        return person
+
+class LabelStore():
+    """
+    Class which owns the photos and the labels of the opened labels' file, without any GUI.
+    The GUI (Main and Photo), the command line tools and the benchmarks work through this API.
+
+    params:
+        - fileLabels: path of the labels' file (JSON or SQLite), None to open it later.
+    """
+
+    def __init__(self, fileLabels=None):
+        self.fileLabels = None
+        self.directory = None
+        self.storage = None
+
+        self.photos = []
+        self.labels = {}
+        self.pos = None
+        self.order = None
+
+        self.unlabeled = UnlabeledIndex()
+        self.numbers = NumberIndex()
+
+        if fileLabels :
+            self.open(fileLabels)
+
+    def open(self, fileLabels, storage=None, lazy=None):
+        """
+        Function to open a labels' file, the photos are in the same folder.
+
+        params:
+            - lazy: read the labels of every photo only when they are needed, by default
+              when the file is bigger than LAZY_SIZE.
+        """
+        if lazy is None :
+            lazy = os.path.exists(fileLabels) and os.path.getsize(fileLabels) > LAZY_SIZE
+
+        self.close()
+        self.fileLabels = fileLabels
+        self.directory = os.path.dirname(fileLabels)
+        self.storage = storage if storage else openStorage(fileLabels, lazy)
+        self.order = None
+
+    def create(self):
+        """
+        Function to empty the labels' file.
+        """
+        self.storage.create()
+
+    def load(self):
+        """
+        Function to read the labels of the file.
+        The photos are the ones of the file until sync is called with the photos of the folder.
+        """
+        self.loadDict(self.storage.load())
+
+    def loadDict(self, data):
+        """
+        Function to set the labels from a dict with the JSON structure, without storage (scripts, tests).
+        The labels not read yet of a lazy storage are kept until they are needed (see people).
+        """
+        self.labels = { name: people if isinstance(people, Lazy) else [Person.fromDict(person) for person in people]
+                        for name, people in data.items() }
+        self.numbers.build(self.labels)
+        self.arrange()
+        self.pos = None
+
+    def sync(self, names):
+        """
+        Function to apply the photos of the folder to the labels.
+        New photos are added without labels and the labels of deleted photos are removed.
+
+        params:
+            - names: set or keys view with the names of the photos in the folder.
+
+        return:
+            - added: set with the names of the new photos.
+            - removed: set with the names of the deleted photos.
+        """
+        added = names - self.labels.keys()
+        removed = self.labels.keys() - names
+
+        for name in added :
+            self.labels[name] = []
+
+        for name in removed :
+            self.labels.pop(name)
+            self.numbers.remove(name)
+
+        if self.storage :
+            self.storage.addPhotos(added)
+            self.storage.removePhotos(removed)
+
+        self.arrange()
+        return added, removed
+
+    def arrange(self):
+        """
+        Function to create the photos list in navigation order: the order of the names, or the
+        one given by order(names), which can return a lazy list (see Project.Timeline).
+        """
+        self.photos = self.order(self.labels.keys()) if self.order else sorted(self.labels.keys())
+        self.unlabeled.build(self.photos, self.labels)
+
+    def current(self):
+        """
+        Function to obtain the name of the actual photo.
+        """
+        return self.photos[self.pos]
+
+    def people(self, name=None):
+        """
+        Function to obtain the labels of a photo (the actual one by default).
+        The labels of a lazy storage are read the first time.
+        """
+        name = name if name is not None else self.current()
+        people = self.labels[name]
+
+        if isinstance(people, Lazy) :
+            people = [Person.fromDict(person) for person in people.read()]
+            self.labels[name] = people
+
+        return people
+
+    def positionOf(self, name):
+        """
+        Function to obtain the position of a photo in the photos list.
+        """
+        if not isinstance(self.photos, list) :
+            return self.photos.index(name)
+
+        i = bisect.bisect_left(self.photos, name)
+        return i if i < len(self.photos) and self.photos[i] == name else None
+
+    def names(self):
+        """
+        Function to obtain the sorted names of the photos, whatever the navigation order is.
+        """
+        return self.photos if self.order is None else sorted(self.labels.keys())
+
+    def addPerson(self, person, name=None):
+        """
+        Function to add the label of a person to a photo (the actual one by default).
+
+        return:
+            - index of the person in the photo.
+        """
+        name = name if name is not None else self.current()
+        self.people(name).append(person)
+        self.record(name)
+        return len(self.labels[name]) - 1
+
+    def removePerson(self, i, name=None):
+        """
+        Function to remove the label of a person from a photo (the actual one by default).
+        """
+        name = name if name is not None else self.current()
+        del self.people(name)[i]
+        self.record(name)
+
+    def setPeople(self, people, name=None):
+        """
+        Function to replace the labels of a photo (the actual one by default).
+        """
+        name = name if name is not None else self.current()
+        self.labels[name] = list(people)
+        self.record(name)
+
+    def record(self, name):
+        """
+        Function to save the changes in the labels of a photo in the storage and the indexes.
+        """
+        self.unlabeled.update(name, self.labels[name])
+        self.numbers.update(name, self.labels[name])
+
+        if self.storage :
+            self.storage.record(name, [person.toDict() for person in self.labels[name]])
+
+    def firstUnlabeled(self):
+        """
+        Function to obtain the position of the first photo without labels (0 if all are labelled).
+        """
+        first = self.unlabeled.first()
+        return first if first is not None else 0
+
+    def step(self, forward):
+        """
+        Function to obtain the position of the next or previous photo, going round at the ends.
+        """
+        if forward :
+            return self.pos + 1 if self.pos < len(self.photos) - 1 else 0
+
+        return self.pos - 1 if self.pos > 0 else len(self.photos) - 1
+
+    def toDict(self):
+        """
+        Function to obtain all the labels with the JSON structure.
+        """
+        return { name: [person.toDict() for person in self.people(name)] for name in self.labels.keys() }
+
+    def items(self):
+        """
+        Function to iterate the labels of every photo with the JSON structure, in the order of the names.
+        The labels not read yet of a lazy storage are read but not kept in the store.
+
+        yields:
+            - (name, labels) of every photo.
+        """
+        for name in self.names() :
+            people = self.labels[name]
+            yield name, people.read() if isinstance(people, Lazy) else [person.toDict() for person in people]
+
+    def autosave(self):
+        """
+        Function to save the labels when we change the photo.
+        """
+        if self.storage :
+            self.storage.autosave(self.labels)
+
+    def save(self):
+        """
+        Function to write all the labels in the labels' file.
+        """
+        if self.storage :
+            self.storage.save(self.labels)
+
+    def status(self):
+        """
+        Function to obtain the state of the writes of the storage and the error of the last one.
+        """
+        return self.storage.status() if self.storage else None
+
+    def close(self):
+        """
+        Function to write the pending changes and close the labels' file.
+        If the changes can not be written the error is raised and the file is kept open.
+        """
+        if self.storage :
+            self.storage.close(self.labels)
+            self.storage = None
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lazy loading of big JSON labels' files
+Author: Carlos Herrero
+"""
+
+import os
+import json
+import threading
+
+from Journal import encode
+
+OFFSETS = ".offsets"
+
+class Lazy():
+    """
+    Class in place of the labels of a photo which have not been read from the labels' file.
+    The number of persons and the dorsal numbers are known without reading them (see OffsetIndex),
+    so the indexes of the store are built without parsing the file.
+
+    params:
+        - index: OffsetIndex of the file.
+        - name: photo name.
+    """
+    __slots__ = ('index', 'name')
+
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+
+    def __len__(self):
+        return self.index.entries[self.name][2]
+
+    def numbers(self):
+        """
+        Function to obtain the dorsal numbers of the photo as (number, person index).
+        """
+        return [tuple(number) for number in self.index.entries[self.name][3]]
+
+    def read(self):
+        """
+        Function to read the labels of the photo with the JSON structure.
+        """
+        return self.index.read(self.name)
+
+    def toDict(self):
+        return self.read()
+
+class OffsetIndex():
+    """
+    Class with the position in bytes of the labels of every photo in a JSON labels' file.
+    The index is built streaming the file the first time and kept in a sidecar file next to it,
+    with the size and mtime of the file to know if it is up to date. With the index the labels
+    of a photo are read with a seek, without loading the file.
+
+    The compactions of a lazy store are written by this class (see write): the labels which
+    were not read are copied as bytes from the old file and the index of the new file is saved.
+
+    params:
+        - fileLabels: path of the labels' file.
+    """
+
+    def __init__(self, fileLabels):
+        self.fileLabels = fileLabels
+        self.path = fileLabels + OFFSETS
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        Function to read the index from its sidecar file, or build it if it is not up to date.
+        """
+        stat = os.stat(self.fileLabels)
+
+        try:
+            with open(self.path, 'r') as file :
+                index = json.load(file)
+
+            if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime :
+                self.entries = index['entries']
+                return self
+
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        self.build()
+        return self
+
+    def build(self):
+        """
+        Function to build the index streaming the labels' file.
+        Every entry is [start, end, number of persons, [[dorsal number, person index], ...]].
+        """
+        # Storage opens the lazy files, it is imported here
+        from Storage import iterJson
+
+        self.entries = { name: entry(start, end, labels) for name, labels, start, end in iterJson(self.fileLabels, offsets=True) }
+        self.save()
+
+    def save(self):
+        """
+        Function to write the index in its sidecar file.
+        """
+        stat = os.stat(self.fileLabels)
+        tmp = self.path + ".tmp"
+
+        with open(tmp, 'w') as file :
+            json.dump({ 'size': stat.st_size, 'mtime': stat.st_mtime, 'entries': self.entries }, file)
+
+        os.replace(tmp, self.path)
+
+    def read(self, name):
+        """
+        Function to read the labels of a photo.
+        """
+        with self.lock :
+            start, end = self.entries[name][0:2]
+
+            with open(self.fileLabels, 'rb') as file :
+                file.seek(start)
+                return json.loads(file.read(end - start).decode('utf-8'))
+
+    def write(self, path, data):
+        """
+        Function to write the labels' file with its index, used by the journal for the compactions.
+        The photos are written in the order of the names, the labels which were not read are copied
+        from the old file. The new file and its index replace the old ones at the same time.
+
+        params:
+            - path: labels' file.
+            - data: dict with the labels of every photo (lists, or Lazy if they were not read).
+        """
+        entries = {}
+        tmp = path + ".tmp"
+
+        with open(tmp, 'wb') as file, open(path, 'rb') as old :
+            file.write(b"{")
+            offset = 1
+
+            for name in sorted(data.keys()) :
+                labels = data[name]
+                key = ((", " if offset > 1 else "") + json.dumps(name) + ": ").encode('utf-8')
+
+                if isinstance(labels, Lazy) :
+                    start, end, count, numbers = self.entries[name]
+                    old.seek(start)
+                    value = old.read(end - start)
+                else :
+                    labels = [person if isinstance(person, dict) else encode(person) for person in labels]
+                    value = json.dumps(labels, sort_keys=True).encode('utf-8')
+                    count, numbers = entry(0, 0, labels)[2:4]
+
+                file.write(key)
+                file.write(value)
+                offset += len(key)
+                entries[name] = [offset, offset + len(value), count, numbers]
+                offset += len(value)
+
+            file.write(b"}")
+            file.flush()
+            os.fsync(file.fileno())
+
+        with self.lock :
+            os.replace(tmp, path)
+            self.entries = entries
+            self.save()
+
+def entry(start, end, labels):
+    """
+    Function to create the entry of the index of a photo.
+    """
+    numbers = [[person['number']['number'], i] for i, person in enumerate(labels)
+               if person.get('number', None) and person['number'].get('number', None) is not None]
+
+    return [start, end, len(labels), numbers]
@@ -7,32 +7,72 @@ Author: Carlos Herrero
 """
 
 from PyQt5.QtWidgets import QApplication, QMainWindow, QAction, QWidget, QHBoxLayout, QVBoxLayout
-from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem
-from PyQt5.QtWidgets import QListView, QMessageBox, QInputDialog, QFileDialog, QLabel
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QPixmap, QPen, QFont
-from PyQt5.QtCore import Qt, QModelIndex, QRectF
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsItem
+from PyQt5.QtWidgets import QListView, QMessageBox, QInputDialog, QFileDialog, QLabel, QLineEdit
+from PyQt5.QtGui import QStandardItemModel, QStandardItem, QPixmap, QPen, QFont, QImageReader, QImageIOHandler, QPainter
+from PyQt5.QtCore import Qt, QModelIndex, QRectF, QRect, QTimer, QFileSystemWatcher
 
 import os
-import re
-import json
+import time
+import bisect
+import threading
+import collections
+
+import Trace
+from Journal import writeAtomic, PENDING, SAVING, SAVED, FAILED
+from ImageCache import ImageCache
+from Thumbnails import ThumbnailCache, FilmstripModel, Filmstrip
+from Metadata import MetadataIndex
+from DirectoryIndex import DirectoryIndex
+from LabelStore import LabelStore, Person
+from Shards import Leases, shardPath, LEASE_TIME
+from Preannotate import Suggestions
+from Project import ProjectIndex, PROJECT
 
 PERSON = 0
 DORSAL = 1
 NUMBER = 2
 
-step = PERSON
-person = None
-graphic = None
+TILE = 512
 
-fileLabels = None
-directory = None
+# Operations shown in the timings of the status bar
+TIMINGS = ('scan', 'parse', 'decode', 'initPeople', 'save', 'applyMove')
 
-data = {}
-pos = None
-photos = []
+def labelPen(color):
+    """
+    Function to create the pen of the labels, it keeps its width at any zoom.
+    """
+    pen = QPen(color)
+    pen.setCosmetic(True)
+    return pen
+
+def suggestionPen():
+    """
+    Function to create the pen of the boxes suggested by the pre-annotation (see Preannotate).
+    """
+    pen = labelPen(Qt.cyan)
+    pen.setStyle(Qt.DashLine)
+    return pen
+
+def labelText(i, person):
+    """
+    Function to obtain the text of a person in the labels list.
+    """
+    if person.number is not None :
+        return str(i) + ") " + str(person.number)
+
+    return str(i) + ") No number"
+
+def cycle(positions, pos, forward):
+    """
+    Function to obtain the next or previous position of a sorted list of positions, going round at the ends.
+    """
+    if forward :
+        j = bisect.bisect_right(positions, pos)
+        return positions[j] if j < len(positions) else positions[0]
 
-listView = None
-listLabels = None
+    j = bisect.bisect_left(positions, pos)
+    return positions[j - 1] if j > 0 else positions[-1]
 
 class Photo(QGraphicsScene):
     """
@@ -47,47 +87,212 @@ class Photo(QGraphicsScene):
 
     def __init__(self, name, parent=None):
         super(Photo, self).__init__(parent)
-        global step, person, graphic, listView, listLabels
         self.parent = parent
+        self.store = parent.store
         self.name = name
 
-        step = PERSON
-        person = None
-        graphic = None
-
-        listLabels = QStandardItemModel()
-        listView.setModel(listLabels)
-
-        self.img = QPixmap(directory + "/" + self.name)
-        self.addItem(QGraphicsPixmapItem(self.img))
-        self.initPeople()
+        # Label being drawn: a dict with the JSON structure until it is added to the store
+        self.step = PERSON
+        self.person = None
+        self.graphic = None
+
+        self.labelsModel = QStandardItemModel()
+        self.parent.listView.setModel(self.labelsModel)
+
+        with Trace.span('metadata') :
+            info = self.parent.metadata.get(self.name)
+        self.imgWidth = info['width']
+        self.imgHeight = info['height']
+        self.setSceneRect(0, 0, self.imgWidth, self.imgHeight)
+
+        # The photo can be decoded at screen size, it is drawn scaled so the scene
+        # (and the labels) are always in pixels of the original image
+        self.path = self.store.directory + "/" + self.name
+        self.img = self.parent.cache.pixmap(self.path)
+        self.factor = self.imgWidth / self.img.width() if self.img.width() > 0 else 1
+        self.tiles = None
+
+        # Mouse moves are applied once per frame
+        self.movePos = None
+        self.moveTimer = QTimer(self)
+        self.moveTimer.setSingleShot(True)
+        self.moveTimer.setInterval(self.parent.viewPhoto.frameInterval())
+        self.moveTimer.timeout.connect(self.applyMove)
+
+        # Graphic items of every person, to update only the affected ones on changes
+        self.people = []
+        self.drawing = {}
+
+        with Trace.span('initPeople') :
+            self.initPeople()
+
+        # Boxes suggested by the pre-annotation, until they are accepted or rejected
+        self.suggested = []
+        self.initSuggestions()
 
     def initPeople(self):
         """
         This function is for load and draws the labels of a photo when is initialized
         """
-        people = data[self.name]
+        people = self.store.people(self.name)
         for i in range(0, len(people)) :
-            person = people[i]
-            position = person['position']
-
-            self.addRect(position[0], position[1], abs(position[0]-position[2]), abs(position[1]-position[3]), pen=QPen(Qt.red))
-            txt = self.addText(str(i))
-            txt.setPos(position[0], position[1])
-            txt.setDefaultTextColor(Qt.red)
-
-            if person.get('number', None) :
-                number = person['number']['number']
-                numberPosition = person['number']['position']
-
-                listLabels.appendRow(QStandardItem(str(i) + ") " + str(number)))
-                self.addRect(numberPosition[0], numberPosition[1], abs(numberPosition[0]-numberPosition[2]), abs(numberPosition[1]-numberPosition[3]), pen=QPen(Qt.yellow))
-                txt = self.addText(str(number))
-                txt.setPos(numberPosition[0], numberPosition[1])
-                txt.setDefaultTextColor(Qt.yellow)
-            
-            else :
-                listLabels.appendRow(QStandardItem(str(i) + ") No number"))
+            self.people.append(self.drawPerson(i, people[i]))
+            self.labelsModel.appendRow(QStandardItem(labelText(i, people[i])))
+
+    def initSuggestions(self):
+        """
+        Function to draw the boxes suggested for a photo without labels.
+        """
+        suggestions = self.parent.suggestions
+        if not suggestions or len(self.people) > 0 :
+            return
+
+        for box in suggestions.get(self.name) :
+            self.suggested.append(self.addRect(box[0], box[1], box[2] - box[0], box[3] - box[1], pen=suggestionPen()))
+            self.suggested.append(self.addLabel("%.2f" % box[4], box[0], box[1], Qt.cyan))
+
+    def removeSuggestions(self):
+        """
+        Function to remove the suggested boxes of the scene.
+        """
+        for item in self.suggested :
+            self.removeItem(item)
+
+        self.suggested = []
+
+    def drawPerson(self, i, person):
+        """
+        Function to draw the label of a person.
+
+        return:
+            - dict with the graphic items of the person.
+        """
+        items = {}
+        position = person.position
+        numberPosition = person.numberPosition
+
+        items['rect'] = self.addRect(position[0], position[1], abs(position[0]-position[2]), abs(position[1]-position[3]), pen=labelPen(Qt.red))
+        items['text'] = self.addLabel(str(i), position[0], position[1], Qt.red)
+
+        if numberPosition :
+            items['numberRect'] = self.addRect(numberPosition[0], numberPosition[1], abs(numberPosition[0]-numberPosition[2]), abs(numberPosition[1]-numberPosition[3]), pen=labelPen(Qt.yellow))
+
+            if person.number is not None :
+                items['numberText'] = self.addLabel(str(person.number), numberPosition[0], numberPosition[1], Qt.yellow)
+
+        return items
+
+    def commitPerson(self):
+        """
+        Function to add the person being drawn to the labels list and the store.
+        """
+        if not self.person :
+            return
+
+        with Trace.span('commitPerson') :
+            person = Person.fromDict(self.person)
+            self.labelsModel.appendRow(QStandardItem(labelText(len(self.people), person)))
+            self.people.append(self.drawing)
+            self.drawing = {}
+            self.store.addPerson(person, self.name)
+
+        self.parent.filmstrip.viewport().update()
+        self.step = PERSON
+        self.person = None
+        self.graphic = None
+
+    def removePerson(self, i):
+        """
+        Function to remove the label of a person, after it is removed from the store.
+        Only the items of the person are removed and the following persons are renumbered,
+        the photo is not loaded or drawn again.
+        """
+        for item in self.people.pop(i).values() :
+            self.removeItem(item)
+
+        self.labelsModel.removeRow(i)
+        people = self.store.people(self.name)
+
+        for j in range(i, len(self.people)) :
+            self.people[j]['text'].setPlainText(str(j))
+            self.labelsModel.item(j).setText(labelText(j, people[j]))
+
+        if 'text' in self.drawing :
+            self.drawing['text'].setPlainText(str(len(self.people)))
+
+    def drawBackground(self, painter, rect):
+        """
+        Function to draw the photo as the background of the scene.
+        The view caches the background, so drawing a label does not paint the photo again.
+        """
+        painter.drawPixmap(QRectF(0, 0, self.imgWidth, self.imgHeight), self.img, QRectF(self.img.rect()))
+
+    def addLabel(self, text, x, y, color):
+        """
+        Function to draw the text of a label, it keeps its size at any zoom.
+        """
+        txt = self.addText(text)
+        txt.setPos(x, y)
+        txt.setDefaultTextColor(color)
+        txt.setFlag(QGraphicsItem.ItemIgnoresTransformations)
+        return txt
+
+    def loadTiles(self, rect, zoom):
+        """
+        Function to load the full resolution tiles of the visible region when we zoom in
+        beyond the resolution of the decoded photo.
+        Photos with EXIF rotation are not tiled, their clip region is in the unrotated image.
+
+        params:
+            - rect: visible region of the scene. (QRectF)
+            - zoom: scale of the view.
+        """
+        if self.factor <= 1 or zoom * self.factor <= 1 :
+            return
+
+        if self.tiles is None :
+            if QImageReader(self.path).transformation() != QImageIOHandler.TransformationNone :
+                self.factor = 1
+                return
+
+            self.tiles = set()
+            self.parent.cache.signals.tile.connect(self.onTile)
+
+        left = max(0, int(rect.left()) // TILE)
+        top = max(0, int(rect.top()) // TILE)
+        right = min((self.imgWidth - 1) // TILE, int(rect.right()) // TILE)
+        bottom = min((self.imgHeight - 1) // TILE, int(rect.bottom()) // TILE)
+
+        for tx in range(left, right + 1) :
+            for ty in range(top, bottom + 1) :
+                if (tx, ty) not in self.tiles :
+                    self.tiles.add((tx, ty))
+                    x = tx * TILE
+                    y = ty * TILE
+                    tile = QRect(x, y, min(TILE, self.imgWidth - x), min(TILE, self.imgHeight - y))
+                    self.parent.cache.loadTile(self.path, tile)
+
+    def onTile(self, path, rect, image):
+        """
+        Function to capture a full resolution tile decoded in background and draw it over the photo.
+        """
+        if path != self.path or image.isNull() :
+            return
+
+        item = QGraphicsPixmapItem(QPixmap.fromImage(image))
+        item.setPos(rect.x(), rect.y())
+        item.setZValue(-1)
+        item.setCacheMode(QGraphicsItem.DeviceCoordinateCache)
+        self.addItem(item)
+
+    def close(self):
+        """
+        Function to release the scene when we change the photo.
+        """
+        if self.tiles is not None :
+            self.parent.cache.signals.tile.disconnect(self.onTile)
+
+        self.deleteLater()
 
     def keyPressEvent(self, event):
         super(Photo, self).keyPressEvent(event)
@@ -97,44 +302,73 @@ class Photo(QGraphicsScene):
         """
         Function to capture mouse press event and obtain the pixel.
         """
+        with Trace.span('mousePress') :
+            self.pressPerson(event)
+
+    def pressPerson(self, event):
+        """
+        Function to start the rectangle of a person or a dorsal.
+        """
         super(Photo, self).mousePressEvent(event)
-        global step, person, graphic
-        
+
         x = event.scenePos().x()
         y = event.scenePos().y()
 
         x = x if x >= 0 else 0
-        x = x if x < self.img.width() - 20 else self.img.width() - 20
+        x = x if x < self.imgWidth - 20 else self.imgWidth - 20
 
         y = y if y >= 0 else 0
-        y = y if y < self.img.height() - 20 else self.img.height() - 20
+        y = y if y < self.imgHeight - 20 else self.imgHeight - 20
 
-        if step == PERSON :
-            person = { 'position': [x, y, 0, 0] }
-            graphic = self.addRect(x, y, 0, 0, pen=QPen(Qt.gray))
+        if self.step == PERSON :
+            self.person = { 'position': [x, y, 0, 0] }
+            self.graphic = self.addRect(x, y, 0, 0, pen=labelPen(Qt.gray))
+            self.drawing = { 'rect': self.graphic }
         
-        elif step == DORSAL :
-            person['number'] = { 'position': [x, y, 0, 0] }
-            graphic = self.addRect(x, y, 0, 0, pen=QPen(Qt.gray))
-
-        self.update()
+        elif self.step == DORSAL :
+            self.person['number'] = { 'position': [x, y, 0, 0] }
+            self.graphic = self.addRect(x, y, 0, 0, pen=labelPen(Qt.gray))
+            self.drawing['numberRect'] = self.graphic
 
     def mouseMoveEvent(self, event):
         """
         Function to capture mouse movement event and obtain the pixel.
+        The rectangle is not updated on every event, the last position is applied once per frame.
         """
-        super(Photo, self).mouseMoveEvent(event)
-        global step, person, graphic
-        
-        if graphic and person :
-            x = event.scenePos().x()
-            y = event.scenePos().y()
+        with Trace.span('mouseMove') :
+            super(Photo, self).mouseMoveEvent(event)
+
+            if self.graphic and self.person :
+                self.movePos = event.scenePos()
+                self.parent.viewPhoto.markInput()
+
+                if not self.moveTimer.isActive() :
+                    self.moveTimer.start()
+
+    def applyMove(self):
+        """
+        Function to resize the rectangle being drawn to the last mouse position.
+        Only the region of the rectangle is repainted.
+        """
+        with Trace.span('applyMove') :
+            self.moveRect()
+
+    def moveRect(self):
+        """
+        Function to resize the rectangle being drawn.
+        """
+        step, person, graphic = self.step, self.person, self.graphic
+
+        if graphic and person and self.movePos is not None :
+            x = self.movePos.x()
+            y = self.movePos.y()
+            self.movePos = None
 
             x = x if x >= 0 else 0
-            x = x if x < self.img.width() else self.img.width() -1
+            x = x if x < self.imgWidth else self.imgWidth -1
 
             y = y if y >= 0 else 0
-            y = y if y < self.img.height() else self.img.height() -1
+            y = y if y < self.imgHeight else self.imgHeight -1
 
             if step == PERSON :
                 iniX = person['position'][0]
@@ -144,7 +378,6 @@ class Photo(QGraphicsScene):
                 y = y if y >= iniY else iniY
 
                 graphic.setRect(QRectF(iniX, iniY, abs(iniX - x), abs(iniY - y)))
-                graphic.update()
             
             elif person.get('number', None) and step == DORSAL :
                 iniX = person['number']['position'][0]
@@ -154,26 +387,26 @@ class Photo(QGraphicsScene):
                 y = y if y >= iniY else iniY
 
                 graphic.setRect(QRectF(iniX, iniY, abs(iniX - x), abs(iniY - y)))
-                graphic.update()
-
-        self.update()
 
     def mouseReleaseEvent(self, event):
         """
         Function to capture mouse release event and obtain the pixel.
         """
         super(Photo, self).mouseReleaseEvent(event)
-        global data, step, person, graphic
+        step, person, graphic = self.step, self.person, self.graphic
+
+        self.moveTimer.stop()
+        self.movePos = None
 
         if graphic and person :
             x = event.scenePos().x()
             y = event.scenePos().y()
 
             x = x if x >= 0 else 0
-            x = x if x < self.img.width() else self.img.width() -1
+            x = x if x < self.imgWidth else self.imgWidth -1
 
             y = y if y >= 0 else 0
-            y = y if y < self.img.height() else self.img.height() -1
+            y = y if y < self.imgHeight else self.imgHeight -1
 
             if step == PERSON :
                 iniX = person['position'][0]
@@ -183,17 +416,15 @@ class Photo(QGraphicsScene):
                 y = y if y >= iniY else iniY
 
                 graphic.setRect(QRectF(iniX, iniY, abs(iniX - x), abs(iniY - y)))
-                graphic.setPen(QPen(Qt.red))
+                graphic.setPen(labelPen(Qt.red))
                 graphic.update()
 
-                txt = self.addText(str(len(data[self.name])))
-                txt.setPos(iniX, iniY)
-                txt.setDefaultTextColor(Qt.red)
+                self.drawing['text'] = self.addLabel(str(len(self.people)), iniX, iniY, Qt.red)
 
                 person['position'][2] = x
                 person['position'][3] = y
-                step = DORSAL
-                graphic = None
+                self.step = DORSAL
+                self.graphic = None
             
             elif person.get('number', None) and step == DORSAL :
                 number, ok = QInputDialog.getInt(self.parent, "Number", "")
@@ -206,31 +437,137 @@ class Photo(QGraphicsScene):
                     y = y if y >= iniY else iniY
 
                     graphic.setRect(QRectF(iniX, iniY, abs(iniX - x), abs(iniY - y)))
-                    graphic.setPen(QPen(Qt.yellow))
+                    graphic.setPen(labelPen(Qt.yellow))
                     graphic.update()
 
-                    txt = self.addText(str(number))
-                    txt.setPos(iniX, iniY)
-                    txt.setDefaultTextColor(Qt.yellow)
-
-                    listLabels.appendRow(QStandardItem(str(len(data[self.name])) + ") " + str(number)))
+                    self.drawing['numberText'] = self.addLabel(str(number), iniX, iniY, Qt.yellow)
 
                     person['number']['number'] = number
                     person['number']['position'][2] = x
                     person['number']['position'][3] = y
-                    data[self.name].append(person)
-                    
-                    step = PERSON
-                    person = None
-                    graphic = None
+                    self.commitPerson()
 
                 else :
                     self.removeItem(graphic)
+                    del self.drawing['numberRect']
                     del person['number']
-                    step = DORSAL
-                    graphic = None
+                    self.step = DORSAL
+                    self.graphic = None
 
-        self.update()
+        self.parent.showLatency()
+
+class PhotoView(QGraphicsView):
+    """
+    Class to show the Photo scenes.
+    In scaled mode the photo is fitted in the view and the mouse wheel zooms in the region under
+    the pointer, loading the full resolution tiles of that region (to read a small number).
+    In full mode the photo is shown at its original size.
+
+    params:
+        - parent: GUI Widget where the view is placed.
+    """
+
+    def __init__(self, parent=None):
+        super(PhotoView, self).__init__(parent)
+        self.scaled = True
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+
+        # The photo is the cached background, a label only repaints its own region
+        self.setCacheMode(QGraphicsView.CacheBackground)
+        self.setViewportUpdateMode(QGraphicsView.MinimalViewportUpdate)
+        self.setOptimizationFlag(QGraphicsView.DontSavePainterState)
+        self.setRenderHint(QPainter.SmoothPixmapTransform)
+
+        # Time from the first mouse move not painted yet to its paint (ms)
+        self.inputTime = None
+        self.latency = collections.deque(maxlen=500)
+
+    def frameInterval(self):
+        """
+        Function to obtain the refresh interval of the screen in ms.
+        """
+        rate = QApplication.primaryScreen().refreshRate()
+        return max(1, int(1000 / (rate if rate > 0 else 60)))
+
+    def markInput(self):
+        """
+        Function to mark the time of a mouse move which has to be painted.
+        """
+        if self.inputTime is None :
+            self.inputTime = time.perf_counter()
+
+    def paintEvent(self, event):
+        super(PhotoView, self).paintEvent(event)
+
+        if self.inputTime is not None :
+            self.latency.append((time.perf_counter() - self.inputTime) * 1000)
+            self.inputTime = None
+
+    def latencyStats(self):
+        """
+        Function to obtain the median, 95 percentile and maximum drag-to-paint latency in ms.
+        """
+        if not self.latency :
+            return None
+
+        samples = sorted(self.latency)
+        return {
+            'p50': samples[len(samples) // 2],
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max': samples[-1],
+            'frame': self.frameInterval(),
+        }
+
+    def setScene(self, scene):
+        super(PhotoView, self).setScene(scene)
+        self.resetCachedContent()
+        self.fit()
+
+    def fitScale(self):
+        """
+        Function to obtain the scale which fits the whole photo in the view.
+        """
+        rect = self.scene().sceneRect()
+        if rect.width() == 0 or rect.height() == 0 :
+            return 1
+
+        return min(self.viewport().width() / rect.width(), self.viewport().height() / rect.height())
+
+    def fit(self):
+        """
+        Function to fit the photo in the view (scaled mode) or show it at its original size (full mode).
+        """
+        self.resetTransform()
+
+        if self.scene() and self.scaled :
+            self.fitInView(self.scene().sceneRect(), Qt.KeepAspectRatio)
+
+    def resizeEvent(self, event):
+        super(PhotoView, self).resizeEvent(event)
+        self.fit()
+
+    def wheelEvent(self, event):
+        """
+        Function to capture the mouse wheel event and zoom the photo in scaled mode.
+        """
+        if not self.scaled or not self.scene() :
+            super(PhotoView, self).wheelEvent(event)
+            return
+
+        factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+        self.scale(factor, factor)
+
+        if self.transform().m11() <= self.fitScale() :
+            self.fit()
+        else :
+            self.loadTiles()
+
+    def loadTiles(self):
+        """
+        Function to ask the scene for the full resolution tiles of the visible region.
+        """
+        visible = self.mapToScene(self.viewport().rect()).boundingRect()
+        self.scene().loadTiles(visible, self.transform().m11())
 
 class Main(QMainWindow):
     """
@@ -244,6 +581,53 @@ class Main(QMainWindow):
         self.setWindowTitle('Labeler')
         #self.setWindowIcon(QIcon('web.png'))
         self.statusBar().showMessage('Ready...')
+        self.latencyLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.latencyLabel)
+        self.timingsLabel = QLabel()
+        self.timingsLabel.hide()
+        self.statusBar().addPermanentWidget(self.timingsLabel)
+        self.saveLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.saveLabel)
+        self.saveTimer = QTimer(self)
+        self.saveTimer.setInterval(250)
+        self.saveTimer.timeout.connect(self.showSaveStatus)
+        self.saveTimer.start()
+        self.timingsTimer = QTimer(self)
+        self.timingsTimer.setInterval(500)
+        self.timingsTimer.timeout.connect(self.showTimings)
+
+        # Photos are decoded at the size of the screen, enough for labelling
+        screen = QApplication.primaryScreen()
+        self.displaySize = int(max(screen.size().width(), screen.size().height()) * screen.devicePixelRatio())
+        self.cache = ImageCache(maxSide=self.displaySize, parent=self)
+        self.thumbnails = ThumbnailCache(parent=self)
+        self.store = LabelStore()
+        self.suggestions = None
+        self.metadata = None
+        self.folderIndex = None
+        self.onlyUnlabeled = False
+        self.results = None
+        self.resultsTitle = None
+
+        # Bursts of near-duplicate photos, hashed in background (see Bursts)
+        self.bursts = None
+        self.burstThread = None
+        self.burstTimer = QTimer(self)
+        self.burstTimer.setInterval(500)
+        self.burstTimer.timeout.connect(self.onBurstsHashed)
+
+        # Annotator mode: labels' file of the annotator and batch of photos claimed
+        self.baseLabels = None
+        self.leases = None
+        self.lease = None
+        self.batch = None
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.onFolderChanged)
+        self.folderTimer = QTimer(self)
+        self.folderTimer.setSingleShot(True)
+        self.folderTimer.setInterval(1000)
+        self.folderTimer.timeout.connect(self.refreshFolder)
 
         self.initToolbar()
         self.setCentralWidget(self.initLayoutPhoto())
@@ -265,43 +649,103 @@ class Main(QMainWindow):
         loadData.triggered.connect(self.loadData)
         saveData = QAction('Save data', self)
         saveData.triggered.connect(self.saveData)
+        importJson = QAction('Import JSON', self)
+        importJson.triggered.connect(self.importJson)
+        exportJson = QAction('Export JSON', self)
+        exportJson.triggered.connect(self.exportJson)
         noLabeled = QAction('No labeled', self)
         noLabeled.triggered.connect(self.noLabeled)
         allPhotos = QAction('All photos', self)
         allPhotos.triggered.connect(self.allPhotos)
+        rescan = QAction('Rescan folder', self)
+        rescan.triggered.connect(self.rescanFolder)
+        self.watch = QAction('Watch folder', self)
+        self.watch.setCheckable(True)
+        self.watch.toggled.connect(self.watchFolder)
+        self.showFilmstrip = QAction('Filmstrip', self)
+        self.showFilmstrip.setCheckable(True)
+        self.showFilmstrip.setChecked(True)
+        self.showFilmstrip.toggled.connect(self.toggleFilmstrip)
 
         previusPhoto = QAction('Previus photo', self)
         previusPhoto.triggered.connect(self.previusPhoto)
         nextPhoto = QAction('Next photo', self)
         nextPhoto.triggered.connect(self.nextPhoto)
+        nextUnlabeled = QAction('Next no labeled', self)
+        nextUnlabeled.triggered.connect(self.nextUnlabeled)
+        validate = QAction('Validate', self)
+        validate.triggered.connect(self.validate)
+        self.findBursts = QAction('Bursts', self)
+        self.findBursts.setCheckable(True)
+        self.findBursts.toggled.connect(self.burstMode)
 
         newPerson = QAction('New person', self)
         newPerson.triggered.connect(self.newPerson)
 
+        annotator = QAction('Annotator', self)
+        annotator.triggered.connect(self.annotatorMode)
+        nextBatch = QAction('Next batch', self)
+        nextBatch.triggered.connect(self.nextBatch)
+
+        self.scaledView = QAction('Scaled view', self)
+        self.scaledView.setCheckable(True)
+        self.scaledView.setChecked(True)
+        self.scaledView.toggled.connect(self.toggleScaled)
+        cacheSettings = QAction('Cache', self)
+        cacheSettings.triggered.connect(self.cacheSettings)
+        self.timings = QAction('Timings', self)
+        self.timings.setCheckable(True)
+        self.timings.toggled.connect(self.toggleTimings)
+        exportTrace = QAction('Export trace', self)
+        exportTrace.triggered.connect(self.exportTrace)
+
         self.toolbar.addAction(newFile)
         self.toolbar.addAction(openFile)
         self.toolbar.insertSeparator(loadData)
         self.toolbar.addAction(loadData)
         self.toolbar.addAction(saveData)
+        self.toolbar.addAction(importJson)
+        self.toolbar.addAction(exportJson)
         self.toolbar.addAction(noLabeled)
         self.toolbar.addAction(allPhotos)
+        self.toolbar.addAction(rescan)
+        self.toolbar.addAction(self.watch)
         self.toolbar.insertSeparator(previusPhoto)
         self.toolbar.addAction(previusPhoto)
         self.toolbar.addAction(nextPhoto)
+        self.toolbar.addAction(nextUnlabeled)
+        self.toolbar.addAction(validate)
+        self.toolbar.addAction(self.showFilmstrip)
+        self.toolbar.addAction(self.findBursts)
         self.toolbar.insertSeparator(newPerson)
         self.toolbar.addAction(newPerson)
+        self.toolbar.insertSeparator(annotator)
+        self.toolbar.addAction(annotator)
+        self.toolbar.addAction(nextBatch)
+        self.toolbar.insertSeparator(self.scaledView)
+        self.toolbar.addAction(self.scaledView)
+        self.toolbar.addAction(cacheSettings)
+        self.toolbar.addAction(self.timings)
+        self.toolbar.addAction(exportTrace)
 
     def initLayoutPhoto(self):
         """
         Function to create the main layout with all the widgets for show the images and labels.
         """
-        global listView
         # Screen
         screen = QHBoxLayout()
 
+        # Thumbnails of the photos, coloured if they have labels
+        self.filmstripModel = FilmstripModel(self.thumbnails, self)
+        self.filmstrip = Filmstrip()
+        self.filmstrip.setModel(self.filmstripModel)
+        self.filmstrip.clicked[QModelIndex].connect(self.onFilmstripClicked)
+        self.filmstrip.keyPressEvent = self.keyPressEvent
+        screen.addWidget(self.filmstrip, 3)
+
         # Photo
         layoutPhotos = QVBoxLayout()
-        self.viewPhoto = QGraphicsView()
+        self.viewPhoto = PhotoView()
         self.viewPhoto.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.viewPhoto.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         layoutPhotos.addWidget(self.viewPhoto)
@@ -314,10 +758,26 @@ class Main(QMainWindow):
         labelPeople.setFont(QFont("Times", 20, QFont.Bold))
         tools.addWidget(labelPeople)
 
-        listView = QListView()
-        listView.clicked[QModelIndex].connect(self.onClicked)
-        listView.keyPressEvent = self.keyPressEvent
-        tools.addWidget(listView)
+        self.listView = QListView()
+        self.listView.clicked[QModelIndex].connect(self.onClicked)
+        self.listView.keyPressEvent = self.keyPressEvent
+        tools.addWidget(self.listView)
+
+        labelSearch = QLabel("Search number:")
+        labelSearch.setFont(QFont("Times", 14, QFont.Bold))
+        tools.addWidget(labelSearch)
+
+        self.search = QLineEdit()
+        self.search.setPlaceholderText("Dorsal number")
+        self.search.returnPressed.connect(self.searchNumber)
+        tools.addWidget(self.search)
+
+        self.resultsModel = QStandardItemModel()
+        self.resultsView = QListView()
+        self.resultsView.setModel(self.resultsModel)
+        self.resultsView.clicked[QModelIndex].connect(self.onResultClicked)
+        self.resultsView.keyPressEvent = self.keyPressEvent
+        tools.addWidget(self.resultsView)
         screen.addLayout(tools, 1)
         
         widget = QWidget()
@@ -339,6 +799,13 @@ class Main(QMainWindow):
             self.noLabeled()
         elif event.key() == Qt.Key_2 :
             self.allPhotos()
+        elif event.key() == Qt.Key_U :
+            self.nextUnlabeled()
+        elif event.key() == Qt.Key_F :
+            self.search.setFocus()
+        elif event.key() == Qt.Key_Escape :
+            self.clearSearch()
+            self.showStatus()
         elif event.key() == Qt.Key_Left :
             self.previusPhoto()
         elif event.key() == Qt.Key_Right :
@@ -347,6 +814,22 @@ class Main(QMainWindow):
             self.previusPhoto()
         elif event.key() == Qt.Key_D :
             self.nextPhoto()
+        elif event.key() == Qt.Key_V :
+            self.scaledView.toggle()
+        elif event.key() == Qt.Key_G :
+            self.showFilmstrip.toggle()
+        elif event.key() == Qt.Key_R :
+            self.findBursts.toggle()
+        elif event.key() == Qt.Key_C :
+            self.validate()
+        elif event.key() in (Qt.Key_Return, Qt.Key_Enter) :
+            self.acceptSuggestions()
+        elif event.key() in (Qt.Key_Delete, Qt.Key_Backspace) :
+            self.rejectSuggestions()
+        elif event.key() == Qt.Key_T :
+            self.timings.toggle()
+        elif event.key() == Qt.Key_B :
+            self.nextBatch()
         elif event.key() == Qt.Key_P :
             self.newPerson()
         elif event.key() == Qt.Key_Q :
@@ -358,24 +841,21 @@ class Main(QMainWindow):
         Allows us to open a folder with the lables' file and his photos to continue labelling.
         Open the file and load all the labels verifying what images are labeled.
         """
-        global fileLabels, directory
-
         try:
             self.statusBar().showMessage("Opening file...")
             name, ok = QFileDialog.getOpenFileName(self, 'Select file')
             
             if ok :
-                fileLabels = name
-                directory = os.path.dirname(fileLabels)
+                self.openLabels(name)
                 self.statusBar().showMessage("Ready...")
                 self.loadData()
             else :
-                fileLabels = None
-                directory = None
+                self.store.fileLabels = None
+                self.store.directory = None
                 self.statusBar().showMessage("No file!")
         
         except FileNotFoundError:
-            QMessageBox.question(self, 'Open file', "File " + fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
+            QMessageBox.question(self, 'Open file', "File " + self.store.fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
         except TypeError:
             QMessageBox.question(self, 'Open file', "No file", QMessageBox.Ok, QMessageBox.Ok)
 
@@ -385,185 +865,471 @@ class Main(QMainWindow):
         Allows us to create a new file for a folder with images to start labelling.
         Create the file and load the images to start labelling.
         """
-        global fileLabels, directory
-
         try:
             self.statusBar().showMessage("Creating file...")
             name, ok = QFileDialog.getSaveFileName(self, 'Create file')
         
             if ok :
-                fileLabels = name
-                directory = os.path.dirname(fileLabels)
-                file = open(name, 'w')
-                json.dump({}, file)
-                file.close()
+                self.openLabels(name)
+                self.store.create()
                 self.statusBar().showMessage("Ready...")
                 self.loadData()
             else :
-                fileLabels = None
-                directory = None
+                self.store.fileLabels = None
+                self.store.directory = None
                 self.statusBar().showMessage("No file!")
         
         except FileNotFoundError:
-            QMessageBox.question(self, 'New file', "File " + fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
+            QMessageBox.question(self, 'New file', "File " + self.store.fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
         except TypeError:
             QMessageBox.question(self, 'New file', "No file", QMessageBox.Ok, QMessageBox.Ok)
     
+    def openLabels(self, name):
+        """
+        Function to set the labels' file and its folder, closing the previous one.
+        """
+        self.closeStorage()
+        self.leases = None
+        self.setBatch(None)
+
+        if name.endswith(PROJECT) :
+            # Photos of several folders in time order, named folder/photo (see Project)
+            project = ProjectIndex(name)
+            self.store.open(project.fileLabels)
+            self.store.directory = project.directory
+            self.store.order = project.order
+            self.folderIndex = project
+        else :
+            self.store.open(name)
+            self.folderIndex = DirectoryIndex(self.store.fileLabels, self.store.directory)
+
+        self.metadata = MetadataIndex(self.store.fileLabels, self.store.directory)
+        self.suggestions = Suggestions(self.store.fileLabels)
+        self.filmstripModel.setPhotos(self.store, self.folderIndex.files)
+        self.cache.clear()
+        self.thumbnails.clear()
+        self.bursts = None
+        self.findBursts.setChecked(False)
+        self.watchFolder(self.watch.isChecked())
+
     def loadData(self):
         """
         Function to capture the Load data action.
         Allows us to refresh the folder to verify if there are new images or we delete any image
         applying the changes to the labels in the opened file.
+        The folder is only read if it changed since the last scan (see DirectoryIndex).
         """
-
-        global fileLabels, directory, data, pos, photos
-
         try:
             self.statusBar().showMessage("Loading data...")
 
-            if fileLabels and directory :
-                file = open(fileLabels, 'r')
-                data = json.load(file)
-                
-                images = set(data.keys())
-
-                cont = 0
-                first = True
-
-                for file in sorted(os.listdir(directory)) :
-                    if re.search('(.jpg|.jpeg|.png|.webp)$', file) :
-                        label = data.get(file, None)
-
-                        if label != None :
-                            images.remove(file)
-                            
-                            if first and len(label) > 0 :
-                                cont += 1
-                            else :
-                                first = False
-
-                        else :
-                            data[file] = []
-                            first = False
-                            
-                
-                for image in list(images) :
-                    data.pop(image)
-
-                photos = list(data.keys())
-                pos = cont if cont < len(photos) else 0
-                self.viewPhoto.setScene(Photo(photos[pos], parent=self))
-                img = QPixmap(directory + "/" + photos[pos])
-                self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d" % (photos[pos], img.width(), img.height(), pos+1, len(photos)) )
+            if self.store.fileLabels and self.store.directory :
+                with Trace.span('parse') :
+                    self.store.load()
+                    self.suggestions.load()
+
+                with Trace.span('scan') :
+                    self.folderIndex.scan()
+                    self.syncPhotos()
+                self.onlyUnlabeled = False
+                self.clearSearch()
+
+                self.store.pos = self.store.firstUnlabeled()
+
+                if self.leases :
+                    self.claimBatch()
+                else :
+                    self.showPhoto()
             
             else :
                 self.statusBar().showMessage("Ready...")
 
         except FileNotFoundError:
-            QMessageBox.question(self, 'Load data', "File " + fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
+            QMessageBox.question(self, 'Load data', "File " + self.store.fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
+        except OSError as e:
+            # The pending changes could not be written, the labels in memory are kept
+            QMessageBox.question(self, 'Load data', "The labels could not be saved: " + str(e), QMessageBox.Ok, QMessageBox.Ok)
         except TypeError:
             QMessageBox.question(self, 'Load data', "No file", QMessageBox.Ok, QMessageBox.Ok)
 
+    def syncPhotos(self):
+        """
+        Function to apply the photos of the directory index to the labels.
+        New photos are added without labels and the labels of deleted photos are removed.
+        """
+        self.store.sync(self.folderIndex.files.keys())
+        self.metadata.prune(self.store.labels.keys())
+
+        for name in self.folderIndex.changed :
+            self.cache.discard(self.store.directory + "/" + name)
+
+        self.folderIndex.save()
+        self.filmstripModel.setPhotos(self.store, self.folderIndex.files)
+
+        if self.findBursts.isChecked() :
+            self.hashBursts()
+
+    def watchFolder(self, checked):
+        """
+        Function to capture the Watch folder action.
+        Allows us to see the new photos of the cameras without loading the data again.
+        """
+        if self.watcher.directories() :
+            self.watcher.removePaths(self.watcher.directories())
+
+        if checked and self.folderIndex :
+            self.watcher.addPaths(self.folderIndex.directories())
+
+    def onFolderChanged(self, path):
+        """
+        Function to capture the changes of the watched folder.
+        The changes are applied after a while, a camera copies many photos at once.
+        """
+        self.folderTimer.start()
+
+    def rescanFolder(self):
+        """
+        Function to capture the Rescan folder action.
+        Allows us to see the photos overwritten in place, every photo of the folder is stat'ed again.
+        """
+        self.refreshFolder(full=True)
+
+    def refreshFolder(self, full=False):
+        """
+        Function to apply the new and deleted photos of the folder keeping the actual photo.
+
+        params:
+            - full: stat every photo of the folder (see DirectoryIndex.scan).
+        """
+        store = self.store
+
+        if not self.folderIndex or store.pos is None :
+            return
+
+        with Trace.span('scan') :
+            added, removed = self.folderIndex.scan(full)
+
+        if not added and not removed and not self.folderIndex.changed :
+            return
+
+        self.newPerson()
+        actual = store.current()
+        self.syncPhotos()
+
+        if self.lease :
+            self.setBatch(self.lease)
+
+        # The positions of the search results are not valid with the new photos
+        if self.results :
+            self.clearSearch()
+
+        if len(store.photos) == 0 :
+            store.pos = None
+            self.statusBar().showMessage("No photos")
+        elif actual in removed :
+            store.pos = min(store.pos, len(store.photos) - 1)
+            self.showPhoto()
+        elif actual in self.folderIndex.changed :
+            store.pos = store.positionOf(actual)
+            self.showPhoto()
+        else :
+            store.pos = store.positionOf(actual)
+            self.showStatus()
+
     def saveData(self):
         """
         Function to capture the Save data action.
         Allows us to save the labels in the selected file.
+        The file is written in background right away, the status bar shows when it is saved.
         """
-
-        global fileLabels, data, pos, photos, step, person, graphic
-
         try:
             self.statusBar().showMessage('Saving data...')
+            self.newPerson()
 
-            if person :
-                listLabels.appendRow(QStandardItem(str(len(data[photos[pos]])) + ") No number"))
-                data[photos[pos]].append(person)
-                step = PERSON
-                person = None
-                graphic = None
+            if self.store.storage :
+                with Trace.span('save') :
+                    self.store.save()
+                    self.metadata.save()
+                    self.folderIndex.save()
 
-            file = open(fileLabels, 'w')
-            json.dump(data, file)
-            img = QPixmap(directory + "/" + photos[pos])
-            self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d" % (photos[pos], img.width(), img.height(), pos+1, len(photos)) )
+            self.showStatus()
 
         except FileNotFoundError:
-            QMessageBox.question(self, 'Save data', "File " + fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
+            QMessageBox.question(self, 'Save data', "File " + self.store.fileLabels + " not found.", QMessageBox.Ok, QMessageBox.Ok)
         except TypeError:
             QMessageBox.question(self, 'Save data', "No file", QMessageBox.Ok, QMessageBox.Ok)
     
+    def showPhoto(self):
+        """
+        Function to show the photo at the actual position.
+        The neighbours of the photo are decoded in background while we label it.
+        """
+        store = self.store
+        old = self.viewPhoto.scene()
+
+        with Trace.span('showPhoto') :
+            self.viewPhoto.setScene(Photo(store.current(), parent=self))
+
+        neighbours = self.neighbours()
+        if neighbours is None :
+            self.cache.prefetch(store.directory, store.photos, store.pos)
+        else :
+            self.cache.prefetchNames(store.directory, [store.photos[pos] for pos in neighbours])
+        self.filmstrip.showPosition(store.pos)
+
+        if old :
+            old.close()
+
+        self.showStatus()
+
+    def showLatency(self):
+        """
+        Function to show the drag-to-paint latency of the rectangles in the status bar.
+        """
+        stats = self.viewPhoto.latencyStats()
+
+        if stats :
+            self.latencyLabel.setText("Drag p50 %.1fms p95 %.1fms (frame %dms)" % (stats['p50'], stats['p95'], stats['frame']))
+
+    def showSaveStatus(self):
+        """
+        Function to show the state of the writes of the labels in the status bar.
+        The labels are written in background (see Journal), this label tells us when they are on disk.
+        """
+        status = self.store.status()
+        text = ""
+
+        if status :
+            state, error = status
+            text = { PENDING: "Changes pending", SAVING: "Saving...", SAVED: "Saved" }.get(state, "")
+            if state == FAILED :
+                text = "Save failed: " + str(error)
+
+        if text != self.saveLabel.text() :
+            self.saveLabel.setText(text)
+
+    def toggleTimings(self, checked):
+        """
+        Function to capture the Timings action.
+        Shows the last time and the 95 percentile of the main operations in the status bar.
+        """
+        self.timingsLabel.setVisible(checked)
+
+        if checked :
+            self.showTimings()
+            self.timingsTimer.start()
+        else :
+            self.timingsTimer.stop()
+
+    def showTimings(self):
+        """
+        Function to show the timings of the main operations in the status bar.
+        """
+        stats = Trace.tracer.stats(TIMINGS)
+        self.timingsLabel.setText("  ".join("%s %.1fms (p95 %.1f)" % (name, stats[name]['last'], stats[name]['p95']) for name in stats))
+
+    def exportTrace(self):
+        """
+        Function to capture the Export trace action.
+        Allows us to save the timings of the session as a Chrome trace (chrome://tracing or Perfetto).
+        """
+        name, ok = QFileDialog.getSaveFileName(self, 'Export trace', self.store.directory, 'Trace (*.json)')
+
+        if ok :
+            Trace.tracer.export(name)
+            self.statusBar().showMessage("Exported " + name)
+
+    def showStatus(self):
+        """
+        Function to show the name, dimensions and position of the actual photo in the status bar.
+        The dimensions come from the metadata index kept by the scene, the photo is not decoded again.
+        """
+        store = self.store
+        scene = self.viewPhoto.scene()
+
+        # Without an opened photo there is nothing to show (Esc in the empty window)
+        if store.pos is None :
+            return
+
+        mode = " (no labeled)" if self.onlyUnlabeled else ""
+        mode = " (%s: %s - %s)" % (self.lease['annotator'], self.lease['first'], self.lease['last']) if self.lease else mode
+        mode = " (%s: %d photos)" % (self.resultsTitle, len(self.results)) if self.results else mode
+        mode = mode + " (%d suggested: Enter accepts, Delete rejects)" % (len(scene.suggested) // 2) if scene is not None and scene.suggested else mode
+        width, height = (scene.imgWidth, scene.imgHeight) if scene is not None else (0, 0)
+        self.filmstrip.viewport().update()
+        self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d labeled: %d/%d%s" % (store.current(), width, height, store.pos+1, len(store.photos), store.unlabeled.labelled(), store.unlabeled.total, mode) )
+
+    def importJson(self):
+        """
+        Function to capture the Import JSON action.
+        Allows us to replace the labels of the opened file with the labels of a JSON file.
+        """
+        if not self.store.storage :
+            QMessageBox.question(self, 'Import JSON', "No file", QMessageBox.Ok, QMessageBox.Ok)
+            return
+
+        name, ok = QFileDialog.getOpenFileName(self, 'Import JSON', self.store.directory, 'JSON (*.json)')
+
+        if ok :
+            try:
+                self.store.storage.importJson(name)
+                self.loadData()
+            except (FileNotFoundError, ValueError):
+                QMessageBox.question(self, 'Import JSON', "File " + name + " is not a labels' file.", QMessageBox.Ok, QMessageBox.Ok)
+
+    def exportJson(self):
+        """
+        Function to capture the Export JSON action.
+        Allows us to save the labels of the opened file (JSON or SQLite) as a JSON file.
+        """
+        self.newPerson()
+        name, ok = QFileDialog.getSaveFileName(self, 'Export JSON', self.store.directory, 'JSON (*.json)')
+
+        if ok :
+            writeAtomic(name, self.store.labels)
+            self.statusBar().showMessage("Exported " + name)
+
+    def autosave(self):
+        """
+        Function to save the labels when we change the photo.
+        The changes are already in the storage (the journal of a JSON file is written in background
+        and only compacted when it grows too much).
+        """
+        self.newPerson()
+        self.store.autosave()
+
+        if self.lease and time.time() - self.lease['time'] > LEASE_TIME / 4 :
+            # The batch expired and another annotator took it over, its photos are not ours anymore.
+            # A new batch is claimed after the action which saves (it may move to another photo)
+            if self.leases.renew(self.lease) is None :
+                self.setBatch(None)
+                QTimer.singleShot(0, self.lostBatch)
+
     def noLabeled(self):
         """
         Function to capture the No labeled action.
-        Allows us to show only the no labeled images (does not modify the labels or file labels).
+        Allows us to navigate only through the no labeled images (does not modify the labels or file labels).
+        The photos we label are skipped from then on (see UnlabeledIndex).
         """
-        global data, photos, pos
+        store = self.store
         self.statusBar().showMessage('Serching photos...')
-        self.saveData()
-        
-        aux = []
-        for image in photos:
-            if len(data[image]) == 0 :
-                aux.append(image)
+        self.autosave()
 
-        if len(aux) == 0 :
+        first = store.unlabeled.next(store.pos) if store.pos is not None else None
+
+        if first is None :
             QMessageBox.question(self, 'No labeled', "All photos are labeled", QMessageBox.Ok, QMessageBox.Ok)
             self.statusBar().showMessage('Ready...')
         else :
-            photos = aux
-            pos = 0
-            self.viewPhoto.setScene(Photo(photos[pos], parent=self))
-            img = QPixmap(directory + "/" + photos[pos])
-            self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d" % (photos[pos], img.width(), img.height(), pos+1, len(photos)) )
+            self.clearSearch()
+            self.onlyUnlabeled = True
+            store.pos = first
+            self.showPhoto()
     
     def allPhotos(self):
         """
         Function to capture the All photos action.
-        Allows us to show all photos at the actual folder again.
+        Allows us to navigate through all photos at the actual folder again, starting at the first no labeled one.
         """
-        global data, photos, pos
         self.statusBar().showMessage('Searching photos...')
-        self.saveData()
-        
-        photos = list(data.keys())
+        self.autosave()
+        self.onlyUnlabeled = False
+        self.clearSearch()
 
-        if len(photos) == 0 :
+        if len(self.store.photos) == 0 :
             QMessageBox.question(self, 'All photos', "No photos", QMessageBox.Ok, QMessageBox.Ok)
             self.statusBar().showMessage('Ready...')
         else :
-            cont = 0
-            for image in photos:
-                if len(data[image]) == 0 :
-                    pos = cont
-                    break
-                
-                cont += 1
-            
-            pos = cont if cont < len(photos) else 0
-            self.viewPhoto.setScene(Photo(photos[pos], parent=self))
-            img = QPixmap(directory + "/" + photos[pos])
-            self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d" % (photos[pos], img.width(), img.height(), pos+1, len(photos)) )        
+            self.store.pos = self.store.firstUnlabeled()
+            self.showPhoto()
+
+    def nextUnlabeled(self):
+        """
+        Function to capture the Next no labeled action.
+        Allows us to jump to the next photo without labels.
+        """
+        store = self.store
+
+        if store.pos is None :
+            return
+
+        self.autosave()
+        following = store.unlabeled.next(store.pos)
+
+        if following is None :
+            QMessageBox.question(self, 'Next no labeled', "All photos are labeled", QMessageBox.Ok, QMessageBox.Ok)
+        else :
+            store.pos = following
+            self.showPhoto()
+
+    def nextPosition(self, forward):
+        """
+        Function to obtain the position of the next or previous photo to show.
+        In no labeled mode only the photos without labels are visited, in search mode only the
+        photos with the searched number and in annotator mode only the photos of the batch.
+        """
+        store = self.store
+
+        if self.results :
+            return cycle(self.results, store.pos, forward)
+
+        if self.batch :
+            return cycle(self.batch, store.pos, forward)
+
+        if self.onlyUnlabeled :
+            following = store.unlabeled.next(store.pos) if forward else store.unlabeled.previous(store.pos)
+
+            if following is not None :
+                return following
+
+            self.onlyUnlabeled = False
+            QMessageBox.question(self, 'No labeled', "All photos are labeled", QMessageBox.Ok, QMessageBox.Ok)
+
+        return store.step(forward)
+
+    def neighbours(self):
+        """
+        Function to obtain the positions the next and previous photo actions go to from the actual
+        position, in the order of the mode (see nextPosition), the closest first.
+
+        return:
+            - list of positions, None if every photo is visited (the cache prefetches its neighbours).
+        """
+        store = self.store
+
+        if self.results :
+            step = lambda pos, forward: cycle(self.results, pos, forward)
+        elif self.batch :
+            step = lambda pos, forward: cycle(self.batch, pos, forward)
+        elif self.onlyUnlabeled :
+            step = lambda pos, forward: store.unlabeled.next(pos) if forward else store.unlabeled.previous(pos)
+        else :
+            return None
+
+        positions = []
+        following = { True: store.pos, False: store.pos }
+
+        for i in range(0, self.cache.depth) :
+            for forward in (True, False) :
+                pos = following[forward]
+                if pos is not None :
+                    pos = step(pos, forward)
+                    following[forward] = pos
+
+                if pos is not None and pos != store.pos and pos not in positions :
+                    positions.append(pos)
+
+        return positions
+
     def previusPhoto(self):
         """
         Function to capture the previus photo action.
         Allows us to change the photo to label, saving the labels in the file.
         """
-        global data, pos, photos, step, person, graphic
-        
         try:
-            if person :
-                listLabels.appendRow(QStandardItem(str(len(data[photos[pos]])) + ") No number"))
-                data[photos[pos]].append(person)
-                step = PERSON
-                person = None
-                graphic = None
+            self.autosave()
 
-            self.saveData()
-
-            pos = pos - 1 if pos > 0 else len(photos) - 1
-            self.viewPhoto.setScene(Photo(photos[pos], parent=self))
-            img = QPixmap(directory + "/" + photos[pos])
-            self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d" % (photos[pos], img.width(), img.height(), pos+1, len(photos)) )
+            self.store.pos = self.nextPosition(False)
+            self.showPhoto()
 
         except TypeError:
             QMessageBox.question(self, 'Previus photo', "No photos", QMessageBox.Ok, QMessageBox.Ok)
@@ -573,50 +1339,397 @@ class Main(QMainWindow):
         Function to capture the next photo action.
         Allows us to change the photo to label, saving the labels in the file.
         """
-        global data, pos, photos, step, person, graphic
-        
         try:
-            if person :
-                listLabels.appendRow(QStandardItem(str(len(data[photos[pos]])) + ") No number"))
-                data[photos[pos]].append(person)
-                step = PERSON
-                person = None
-                graphic = None
-            
-            self.saveData()
+            self.autosave()
 
-            pos = pos + 1 if pos < len(photos) - 1 else 0
-            self.viewPhoto.setScene(Photo(photos[pos], parent=self))
-            img = QPixmap(directory + "/" + photos[pos])
-            self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d" % (photos[pos], img.width(), img.height(), pos+1, len(photos)) )
+            previous = self.store.pos
+            self.store.pos = self.nextPosition(True)
+            self.showPhoto()
+            self.offerBurstLabels(previous)
 
         except TypeError:
             QMessageBox.question(self, 'Next photo', "No photos", QMessageBox.Ok, QMessageBox.Ok)
 
+    def searchNumber(self):
+        """
+        Function to capture the search of a dorsal number.
+        Shows the photos with the number in the results list and shows the first one, from then on
+        the next and previous photo actions only go through these photos until the search is cleared.
+        """
+        store = self.store
+
+        text = self.search.text().strip()
+        self.resultsModel.clear()
+        self.results = None
+
+        if not text or store.pos is None :
+            if store.pos is not None :
+                self.showStatus()
+            return
+
+        try:
+            number = int(text)
+        except ValueError:
+            QMessageBox.question(self, 'Search number', "Invalid number: " + text, QMessageBox.Ok, QMessageBox.Ok)
+            return
+
+        found = store.numbers.find(number)
+        if not found :
+            QMessageBox.question(self, 'Search number', "No photos with number " + text, QMessageBox.Ok, QMessageBox.Ok)
+            return
+
+        self.autosave()
+        self.onlyUnlabeled = False
+        self.results = sorted(store.positionOf(name) for name in found.keys())
+        self.resultsTitle = "number " + text
+
+        for i in self.results :
+            people = ", ".join(str(j) for j in found[store.photos[i]])
+            self.resultsModel.appendRow(QStandardItem("%s (%s)" % (store.photos[i], people)))
+
+        store.pos = self.results[0]
+        self.showPhoto()
+
+    def validate(self):
+        """
+        Function to capture the Validate action.
+        Checks all the labels (see Validate) and shows the photos with issues in the results list,
+        from then on the next and previous photo actions only go through these photos.
+        """
+        store = self.store
+
+        if store.pos is None :
+            return
+
+        try:
+            from Validate import loadBoxes, validate
+        except ImportError:
+            QMessageBox.question(self, 'Validate', "Validate needs numpy", QMessageBox.Ok, QMessageBox.Ok)
+            return
+
+        self.autosave()
+        self.clearSearch()
+
+        with Trace.span('validate') :
+            issues = validate(loadBoxes(store.items()), self.metadata.info)
+
+        if not issues :
+            QMessageBox.question(self, 'Validate', "No issues found", QMessageBox.Ok, QMessageBox.Ok)
+            self.showStatus()
+            return
+
+        found = collections.OrderedDict()
+        for issue in issues :
+            found.setdefault(issue['photo'], []).append("%d %s" % (issue['person'], issue['message']))
+
+        self.onlyUnlabeled = False
+        self.results = sorted(store.positionOf(name) for name in found.keys())
+        self.resultsTitle = "%d issues" % len(issues)
+
+        for pos in self.results :
+            messages = found[store.photos[pos]]
+            item = QStandardItem("%s: %s" % (store.photos[pos], "; ".join(messages)))
+            item.setToolTip("\n".join(messages))
+            self.resultsModel.appendRow(item)
+
+        store.pos = self.results[0]
+        self.showPhoto()
+
+    def clearSearch(self):
+        """
+        Function to leave the search mode.
+        """
+        self.results = None
+        self.resultsModel.clear()
+        self.search.clear()
+
+    def onResultClicked(self, index):
+        """
+        Function to capture the click event in a photo of the search results.
+        Allows us go to that photo.
+        """
+        self.autosave()
+        self.store.pos = self.results[index.row()]
+        self.showPhoto()
+
+    def annotatorMode(self):
+        """
+        Function to capture the Annotator action.
+        Allows several annotators to label the same folder: the labels go to a file of the annotator
+        (labels.name.json) and the photos are labelled in batches claimed by every annotator, nobody
+        labels the same photo twice. The files are merged with Shards.py.
+        """
+        if not self.store.fileLabels :
+            QMessageBox.question(self, 'Annotator', "No file", QMessageBox.Ok, QMessageBox.Ok)
+            return
+
+        name, ok = QInputDialog.getText(self, "Annotator", "Name:")
+        name = name.strip()
+
+        if ok and name :
+            try:
+                fileLabels = self.baseLabels if self.leases else self.store.fileLabels
+                self.openLabels(shardPath(fileLabels, name))
+
+                if not os.path.exists(self.store.fileLabels) :
+                    self.store.create()
+
+                self.baseLabels = fileLabels
+                self.leases = Leases(self.store.directory, name)
+                self.loadData()
+
+            except OSError as e:
+                QMessageBox.question(self, 'Annotator', str(e), QMessageBox.Ok, QMessageBox.Ok)
+
+    def setBatch(self, lease):
+        """
+        Function to set the batch of photos of the annotator.
+        """
+        store = self.store
+        self.lease = lease
+        self.batch = None
+
+        if lease :
+            self.batch = sorted(store.positionOf(name) for name in self.leases.photos(lease, store.names()))
+
+    def claimBatch(self):
+        """
+        Function to claim the next batch of photos and show its first photo without labels.
+        """
+        store = self.store
+        self.setBatch(self.leases.claim(store.names()))
+
+        if not self.batch :
+            QMessageBox.question(self, 'Next batch', "All photos are in a batch", QMessageBox.Ok, QMessageBox.Ok)
+        else :
+            store.pos = next((pos for pos in self.batch if len(store.people(store.photos[pos])) == 0), self.batch[0])
+
+        if store.photos :
+            self.showPhoto()
+
+    def lostBatch(self):
+        """
+        Function to claim a new batch when the batch of the annotator was taken over by another one.
+        """
+        QMessageBox.question(self, 'Next batch', "The batch expired and was taken by another annotator", QMessageBox.Ok, QMessageBox.Ok)
+        self.clearSearch()
+        self.claimBatch()
+
+    def nextBatch(self):
+        """
+        Function to capture the Next batch action.
+        Allows us to finish the batch of photos (nobody labels it again) and claim the next one.
+        """
+        if not self.leases :
+            return
+
+        self.autosave()
+
+        if self.lease :
+            self.leases.finish(self.lease)
+
+        self.clearSearch()
+        self.claimBatch()
+
+    def burstMode(self, checked):
+        """
+        Function to capture the Bursts action.
+        Allows us to reuse the labels in the bursts of the cameras: the photos are hashed in background
+        and going to the next photo of a burst offers to copy the labels of the previous one.
+        """
+        if not checked :
+            return
+
+        try:
+            from Bursts import BurstIndex
+        except ImportError:
+            QMessageBox.question(self, 'Bursts', "Bursts needs Pillow and numpy", QMessageBox.Ok, QMessageBox.Ok)
+            self.findBursts.setChecked(False)
+            return
+
+        if not self.store.fileLabels :
+            self.findBursts.setChecked(False)
+            return
+
+        if self.bursts is None :
+            self.bursts = BurstIndex(self.store.fileLabels, self.store.directory)
+
+        self.hashBursts()
+
+    def hashBursts(self):
+        """
+        Function to hash the new photos in background (a pool of processes), the bursts are
+        grouped when it finishes (see onBurstsHashed).
+        """
+        if self.bursts is None or self.burstThread is not None :
+            return
+
+        self.statusBar().showMessage("Hashing photos...")
+        self.burstThread = threading.Thread(target=self.bursts.update, args=(dict(self.folderIndex.files),), daemon=True)
+        self.burstThread.start()
+        self.burstTimer.start()
+
+    def onBurstsHashed(self):
+        """
+        Function to group the photos in bursts when the hashes are ready.
+        """
+        if self.burstThread is None or self.burstThread.is_alive() :
+            return
+
+        self.burstTimer.stop()
+        self.burstThread = None
+
+        if self.bursts is not None :
+            self.bursts.group(self.store.names())
+            self.statusBar().showMessage("%d bursts" % len(self.bursts.bursts()))
+
+    def offerBurstLabels(self, previous):
+        """
+        Function to offer the labels of the previous photo as a starting point when we go to the
+        next photo of a burst without labels.
+        """
+        store = self.store
+
+        if not self.findBursts.isChecked() or self.bursts is None or self.burstThread is not None :
+            return
+
+        if previous is None or not self.bursts.same(store.photos[previous], store.current()) :
+            return
+
+        people = store.people(store.photos[previous])
+        if len(people) == 0 or len(store.people()) > 0 :
+            return
+
+        copy = QMessageBox.question(self, 'Bursts', "Copy the %d labels of the previous photo?" % len(people), QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+
+        if copy == QMessageBox.Yes :
+            store.setPeople([Person.fromDict(person.toDict()) for person in people])
+            self.showPhoto()
+
     def newPerson(self):
         """
         Function to capture the New person action.
         Allows us add new label without number.
         """
-        global data, pos, photos, step, person, graphic
-        
-        if person :
-            listLabels.appendRow(QStandardItem(str(len(data[photos[pos]])) + ") No number"))
-            data[photos[pos]].append(person)
-            step = PERSON
-            person = None
-            graphic = None
+        scene = self.viewPhoto.scene()
+
+        if scene :
+            scene.commitPerson()
     
+    def toggleScaled(self, checked):
+        """
+        Function to capture the Scaled view action.
+        Allows us to change between the photo decoded at screen size (fitted in the view, zoom with
+        the mouse wheel) and the photo decoded at full resolution.
+        """
+        self.viewPhoto.scaled = checked
+        self.cache.setMaxSide(self.displaySize if checked else 0)
+
+        if self.store.photos and self.store.pos is not None :
+            self.newPerson()
+            self.showPhoto()
+        else :
+            self.viewPhoto.fit()
+
+    def cacheSettings(self):
+        """
+        Function to capture the Cache action.
+        Shows the counters of the image cache and allows us to change its memory and the prefetch depth.
+        """
+        stats = self.cache.stats()
+        message = "Hits: %d misses: %d (%.0f%%) images: %d memory: %dMB\n\nCache size (MB):" % (
+            stats['hits'], stats['misses'], stats['ratio'] * 100, stats['images'], stats['memory'] // (1024 * 1024))
+
+        size, ok = QInputDialog.getInt(self, "Cache", message, self.cache.size // (1024 * 1024), 0, 65536)
+        if ok :
+            depth, ok = QInputDialog.getInt(self, "Cache", "Prefetch depth:", self.cache.depth, 0, 100)
+            self.cache.resize(size=size, depth=depth if ok else None)
+
+    def acceptSuggestions(self):
+        """
+        Function to accept the boxes suggested for the actual photo, they are added as persons
+        without number.
+        """
+        store = self.store
+        scene = self.viewPhoto.scene()
+
+        if not scene or not scene.suggested :
+            return
+
+        self.newPerson()
+        people = [Person(box[0:4]) for box in self.suggestions.get(store.current())]
+        store.setPeople(list(store.people()) + people)
+        self.suggestions.resolve(store.current())
+        self.showPhoto()
+
+    def rejectSuggestions(self):
+        """
+        Function to discard the boxes suggested for the actual photo.
+        """
+        scene = self.viewPhoto.scene()
+
+        if not scene or not scene.suggested :
+            return
+
+        self.suggestions.resolve(self.store.current())
+        scene.removeSuggestions()
+        self.showStatus()
+
+    def toggleFilmstrip(self, checked):
+        """
+        Function to capture the Filmstrip action.
+        Shows or hides the thumbnails of the photos.
+        """
+        self.filmstrip.setVisible(checked)
+
+        if checked :
+            self.filmstrip.showPosition(self.store.pos)
+        else :
+            self.thumbnails.cancel()
+
+    def onFilmstripClicked(self, index):
+        """
+        Function to capture the click event in a thumbnail.
+        Allows us go to that photo.
+        """
+        self.autosave()
+        self.store.pos = index.row()
+        self.showPhoto()
+
     def onClicked(self, index):
         """
         Function to capture the click event in a label at the right panel.
         Allows us delete a label in a photo.
         """
-        listLabels.removeRow(index.row())
-        del data[photos[pos]][index.row()]
-        self.viewPhoto.setScene(Photo(photos[pos], parent=self))
-        img = QPixmap(directory + "/" + photos[pos])
-        self.statusBar().showMessage("Photo: %s size: %dx%d %d/%d" % (photos[pos], img.width(), img.height(), pos+1, len(photos)) )
+        self.store.removePerson(index.row())
+        self.viewPhoto.scene().removePerson(index.row())
+        self.showStatus()
+
+    def closeStorage(self):
+        """
+        Function to write the pending changes of the opened file before closing it.
+        """
+        if self.store.storage :
+            self.newPerson()
+            self.store.close()
+            self.metadata.save()
+            self.folderIndex.save()
+
+    def closeEvent(self, event):
+        """
+        Function to capture the close event, writing the pending changes in the labels' file.
+        If they can not be written the app is not closed.
+        """
+        try:
+            self.closeStorage()
+        except OSError as e:
+            QMessageBox.question(self, 'Save data', "The labels could not be saved: " + str(e), QMessageBox.Ok, QMessageBox.Ok)
+            event.ignore()
+            return
+
+        self.cache.shutdown()
+        self.thumbnails.shutdown()
+        super(Main, self).closeEvent(event)
 
 if __name__ == '__main__':
     app = QApplication([])
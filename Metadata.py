@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+Photo metadata index
+Author: Carlos Herrero
+"""
+
+from PyQt5.QtGui import QImageReader, QImageIOHandler
+
+import os
+import json
+
+from Journal import writeAtomic
+
+METADATA = ".meta"
+
+class MetadataIndex():
+    """
+    Class to obtain the dimensions, file size and modification time of the photos without decoding them.
+    The dimensions are read from the image header with QImageReader and kept in a sidecar file
+    next to the labels' file, keyed by the photo name and validated with its mtime and size.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - directory: folder of the photos.
+    """
+
+    def __init__(self, fileLabels, directory):
+        self.path = fileLabels + METADATA
+        self.directory = directory
+        self.dirty = False
+        self.info = {}
+
+        try:
+            with open(self.path, 'r') as file :
+                self.info = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.info = {}
+
+    def get(self, name):
+        """
+        Function to obtain the metadata of a photo.
+
+        return:
+            - dict with width, height, size (bytes) and mtime.
+        """
+        stat = os.stat(self.directory + "/" + name)
+        info = self.info.get(name, None)
+
+        if info is None or info['mtime'] != stat.st_mtime or info['size'] != stat.st_size :
+            width, height = self.readSize(self.directory + "/" + name)
+            info = { 'width': width, 'height': height, 'size': stat.st_size, 'mtime': stat.st_mtime }
+            self.info[name] = info
+            self.dirty = True
+
+        return info
+
+    def readSize(self, path):
+        """
+        Function to read the dimensions of an image from its header.
+        The EXIF orientation is applied, as the decoder of the image cache does.
+        """
+        reader = QImageReader(path)
+        size = reader.size()
+
+        if reader.transformation() & QImageIOHandler.TransformationRotate90 :
+            return size.height(), size.width()
+
+        return size.width(), size.height()
+
+    def prune(self, names):
+        """
+        Function to forget the photos that are not in the folder anymore.
+        """
+        for name in set(self.info.keys()) - set(names) :
+            del self.info[name]
+            self.dirty = True
+
+    def save(self):
+        """
+        Function to write the index in its sidecar file if there are changes.
+        """
+        if self.dirty :
+            writeAtomic(self.path, self.info)
+            self.dirty = False
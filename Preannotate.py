@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pre-annotation of the photos without labels with a person detector
+Author: Carlos Herrero
+
+Usage:
+    python Preannotate.py labels.json
+    python Preannotate.py labels.db --detector mydetectors:YoloDetector --workers 8 --min-score 0.5
+
+The HOG detector needs OpenCV (opencv-python).
+"""
+
+import os
+import json
+import time
+import argparse
+import importlib
+import itertools
+import multiprocessing
+
+from Storage import iterLabels
+from Journal import openAppend
+
+SUGGESTIONS = ".suggestions"
+BATCH = 256         # photos read from the labels' file while the workers detect the previous ones
+MIN_SCORE = 0.3
+
+class HogDetector():
+    """
+    Class to detect persons with the HOG people detector of OpenCV, it only needs the CPU.
+    The photos are decoded at a reduced size (JPEG decoders skip most of the work), the boxes
+    are returned in pixels of the original photo with its EXIF orientation applied.
+
+    A detector is any class with a detect(path) function returning the boxes of the persons as
+    [x1, y1, x2, y2, score], it is created once in every worker (see loadDetector).
+
+    params:
+        - reduce: 1, 2, 4 or 8, the photos are decoded at 1 / reduce of their size.
+    """
+
+    def __init__(self, reduce=2):
+        import cv2
+
+        self.cv2 = cv2
+        self.reduce = reduce
+        self.flags = { 1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8 }[reduce]
+        self.hog = cv2.HOGDescriptor()
+        self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+
+    def detect(self, path):
+        image = self.cv2.imread(path, self.flags)
+        if image is None :
+            raise OSError("Can not read " + path)
+
+        rects, weights = self.hog.detectMultiScale(image, winStride=(8, 8), padding=(8, 8), scale=1.05)
+        if len(rects) == 0 :
+            return []
+
+        r = self.reduce
+        return [[float(x * r), float(y * r), float((x + w) * r), float((y + h) * r), float(weight)]
+                for (x, y, w, h), weight in zip(rects, weights.ravel())]
+
+DETECTORS = { 'hog': HogDetector }
+
+def loadDetector(spec):
+    """
+    Function to obtain the class of a detector: a name of DETECTORS or module:Class.
+    """
+    if spec in DETECTORS :
+        return DETECTORS[spec]
+
+    module, name = spec.split(":")
+    return getattr(importlib.import_module(module), name)
+
+detector = None
+
+def initWorker(spec):
+    """
+    Function to create the detector of a worker of the pool, the models are loaded once per process.
+    """
+    global detector
+    detector = loadDetector(spec)()
+
+def detectTask(task):
+    """
+    Function to detect the persons of a photo, it runs in the workers of the pool.
+
+    params:
+        - task: (directory, name, minScore).
+
+    return:
+        - (name, boxes), boxes is None if the photo can not be read.
+    """
+    directory, name, minScore = task
+
+    try:
+        boxes = detector.detect(os.path.join(directory, name))
+    except (OSError, ValueError):
+        return name, None
+
+    return name, [box for box in boxes if box[4] >= minScore]
+
+class Suggestions():
+    """
+    Class with the boxes suggested by the pre-annotation, kept in a sidecar file next to the
+    labels' file (labels.json.suggestions) with a JSON line per photo: { photo, boxes }.
+    The lines are only appended, the last line of a photo wins. A suggestion accepted or
+    rejected in the app is resolved with a line without boxes, so it is not suggested again.
+
+    params:
+        - fileLabels: path of the labels' file.
+    """
+
+    def __init__(self, fileLabels):
+        self.path = fileLabels + SUGGESTIONS
+        self.boxes = {}
+        self.load()
+
+    def load(self):
+        """
+        Function to read the suggestions, a broken line (a stopped run) is ignored.
+        """
+        self.boxes = {}
+
+        try:
+            with open(self.path, 'r') as file :
+                for line in file :
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    self.boxes[entry['photo']] = entry['boxes']
+
+        except FileNotFoundError:
+            pass
+
+    def get(self, name):
+        """
+        Function to obtain the suggested boxes of a photo, [x1, y1, x2, y2, score].
+        """
+        return self.boxes.get(name, [])
+
+    def resolve(self, name):
+        """
+        Function to discard the suggestions of a photo once they are accepted or rejected.
+        """
+        if self.boxes.get(name, None) :
+            self.boxes[name] = []
+
+            with openAppend(self.path) as file :
+                file.write(json.dumps({ 'photo': name, 'boxes': [] }) + "\n")
+
+def preannotate(fileLabels, spec='hog', directory=None, workers=None, minScore=MIN_SCORE):
+    """
+    Function to suggest the persons of the photos without labels of a labels' file (JSON or SQLite).
+    The labels' file is streamed, the photos are detected in a pool of processes and the boxes are
+    appended to the suggestions' file. The photos already in it are skipped, so a stopped run
+    continues where it stopped.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - spec: detector, a name of DETECTORS or module:Class.
+        - directory: folder of the photos, the folder of the labels' file by default.
+        - workers: number of processes, the number of cores by default.
+        - minScore: minimum score of the suggested boxes.
+
+    return:
+        - photos: number of photos detected.
+        - boxes: number of boxes suggested.
+        - rate: photos per second and core.
+    """
+    directory = directory if directory else os.path.dirname(fileLabels)
+    workers = workers if workers else os.cpu_count()
+    done = Suggestions(fileLabels).boxes
+    names = (name for name, labels in iterLabels(fileLabels) if len(labels) == 0 and name not in done)
+    photos = 0
+    boxes = 0
+    start = time.perf_counter()
+
+    with openAppend(fileLabels + SUGGESTIONS) as file, multiprocessing.Pool(workers, initWorker, (spec,)) as pool :
+        while True :
+            batch = list(itertools.islice(names, BATCH))
+            if not batch :
+                break
+
+            for name, found in pool.imap_unordered(detectTask, [(directory, name, minScore) for name in batch], chunksize=4) :
+                if found is not None :
+                    file.write(json.dumps({ 'photo': name, 'boxes': found }) + "\n")
+                    photos += 1
+                    boxes += len(found)
+
+            file.flush()
+
+    elapsed = time.perf_counter() - start
+    return photos, boxes, photos / elapsed / workers if elapsed > 0 else 0.0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Suggest the persons of the photos without labels with a detector, the app shows them to accept or reject.")
+    parser.add_argument('labels', help="labels' file (JSON or SQLite)")
+    parser.add_argument('--detector', default='hog', help="detector: hog or module:Class")
+    parser.add_argument('--images', default=None, help="folder of the photos, the folder of the labels' file by default")
+    parser.add_argument('--workers', type=int, default=None, help="number of processes, the number of cores by default")
+    parser.add_argument('--min-score', type=float, default=MIN_SCORE, help="minimum score of the boxes")
+    args = parser.parse_args()
+
+    photos, boxes, rate = preannotate(args.labels, args.detector, args.images, args.workers, args.min_score)
+    print("Detected %d photos, %d boxes suggested, %.2f photos/s per core" % (photos, boxes, rate))
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+
+"""
+Projects with the photos of several cameras in time order
+Author: Carlos Herrero
+
+Usage:
+    python Project.py create event.project cam1 cam2 cam3 [--labels labels.json]
+    python Project.py show event.project [--count 20]
+
+A project file is JSON: { "labels": "labels.json", "folders": ["cam1", "cam2"] }, with the paths
+relative to the folder of the project. The photos are named folder/photo in the labels' file.
+"""
+
+import os
+import json
+import bisect
+import argparse
+
+from Journal import writeAtomic
+from DirectoryIndex import DirectoryIndex
+from ImageHeader import readTime
+
+PROJECT = ".project"
+TIMES = ".times"
+JUMP = 256          # positions from the nearest known one after which a photo is searched, not walked to
+
+class TimeIndex():
+    """
+    Class to obtain the capture time of the photos reading only their headers (see ImageHeader.readTime).
+    The times are kept in a sidecar file next to the labels' file, keyed by the photo name and
+    validated with its mtime. The photos without EXIF date take their mtime.
+
+    params:
+        - fileLabels: path of the labels' file.
+        - directory: folder of the project.
+    """
+
+    def __init__(self, fileLabels, directory):
+        self.path = fileLabels + TIMES
+        self.directory = directory
+        self.dirty = False
+        self.times = {}
+
+        try:
+            with open(self.path, 'r') as file :
+                self.times = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self.times = {}
+
+    def get(self, name, mtime):
+        """
+        Function to obtain the capture time of a photo.
+
+        params:
+            - mtime: modification time of the photo (see DirectoryIndex).
+        """
+        found = self.times.get(name, None)
+
+        if found is None or found[0] != mtime :
+            try:
+                captured = readTime(self.directory + "/" + name)
+            except OSError:
+                captured = None
+
+            found = [mtime, captured if captured is not None else mtime]
+            self.times[name] = found
+            self.dirty = True
+
+        return found[1]
+
+    def save(self):
+        """
+        Function to write the index in its sidecar file if there are changes.
+        """
+        if self.dirty :
+            writeAtomic(self.path, self.times)
+            self.dirty = False
+
+class Timeline():
+    """
+    Class with the photos of several cameras in the order of their capture time, built lazily.
+    The photos of a camera are in the order of their names (the cameras number them, and their times
+    grow with them), so the list is a merge of the cameras and a position is found without reading
+    every header:
+
+        - the position of a photo is the number of photos of every camera taken before it, found
+          with a binary search in every camera (see index).
+        - the photos around a known position are a merge of the cameras from that position, the
+          first and the last photos are the first and the last of some camera (see locate).
+        - a position far from the known ones (a jump of the filmstrip) is the photo of some camera
+          whose position is it, found with a binary search in every camera (see select).
+
+    Only the positions asked for (and the ones between them and a near known one) are read.
+    It works as the photos list of LabelStore: len, [i], iteration and index(name).
+
+    params:
+        - names: names of the photos, folder/photo.
+        - times: TimeIndex.
+        - files: dict with [mtime, size] of every photo (see DirectoryIndex).
+    """
+
+    def __init__(self, names, times, files):
+        cameras = {}
+        for name in sorted(names) :
+            cameras.setdefault(os.path.dirname(name), []).append(name)
+
+        self.cameras = cameras
+        self.total = sum(len(photos) for photos in cameras.values())
+        self.times = times
+        self.files = files
+        self.known = {}
+        self.position = {}
+        self.positions = []
+
+    def key(self, name):
+        """
+        Function to obtain the sort key of a photo, (capture time, name).
+        """
+        info = self.files.get(name, None)
+        return self.times.get(name, info[0] if info else 0.0), name
+
+    def count(self, photos, key):
+        """
+        Function to obtain the number of photos of a camera taken before a sort key (binary search).
+        """
+        low, high = 0, len(photos)
+
+        while low < high :
+            middle = (low + high) // 2
+            if self.key(photos[middle]) < key :
+                low = middle + 1
+            else :
+                high = middle
+
+        return low
+
+    def add(self, i, name):
+        if i not in self.known :
+            self.known[i] = name
+            self.position[name] = i
+            bisect.insort(self.positions, i)
+
+    def walk(self, start, i):
+        """
+        Function to merge the cameras from a known position to the position i, forwards or backwards.
+        """
+        name = self.known[start]
+        key = self.key(name)
+        forward = i > start
+        step = 1 if forward else -1
+        cursors = []
+
+        for photos in self.cameras.values() :
+            c = self.count(photos, key)
+            if forward :
+                cursors.append(c + 1 if c < len(photos) and photos[c] == name else c)
+            else :
+                cursors.append(c - 1)
+
+        cameras = list(self.cameras.values())
+        heads = [self.key(photos[c]) if 0 <= c < len(photos) else None for photos, c in zip(cameras, cursors)]
+
+        for pos in range(start + step, i + step, step) :
+            found = [k for k in range(0, len(heads)) if heads[k] is not None]
+            k = min(found, key=lambda k: heads[k]) if forward else max(found, key=lambda k: heads[k])
+            self.add(pos, heads[k][1])
+
+            cursors[k] += step
+            c = cursors[k]
+            heads[k] = self.key(cameras[k][c]) if 0 <= c < len(cameras[k]) else None
+
+    def locate(self, i):
+        """
+        Function to find the photo at the position i from the nearest known position.
+        """
+        if i in self.known :
+            return
+
+        j = bisect.bisect_left(self.positions, i)
+        below = self.positions[j - 1] if j > 0 else None
+        above = self.positions[j] if j < len(self.positions) else None
+
+        if min(i - (below if below is not None else -self.total), (above if above is not None else 2 * self.total) - i) > JUMP :
+            self.select(i)
+            return
+
+        if below is None and (above is None or i < above - i) :
+            self.add(0, min((self.key(photos[0]) for photos in self.cameras.values()))[1])
+            below = 0
+        elif above is None and (below is None or self.total - 1 - i < i - below) :
+            self.add(self.total - 1, max((self.key(photos[-1]) for photos in self.cameras.values()))[1])
+            above = self.total - 1
+
+        if below is not None and (above is None or i - below <= above - i) :
+            self.walk(below, i)
+        else :
+            self.walk(above, i)
+
+    def select(self, i):
+        """
+        Function to find the photo at the position i without walking to it.
+        The positions of the photos of a camera grow with their names, so the photo is found with a
+        binary search in the camera which has it (see index).
+        """
+        for photos in self.cameras.values() :
+            low, high = 0, len(photos)
+
+            while low < high :
+                middle = (low + high) // 2
+                key = self.key(photos[middle])
+                rank = sum(self.count(others, key) if others is not photos else middle for others in self.cameras.values())
+
+                if rank < i :
+                    low = middle + 1
+                elif rank > i :
+                    high = middle
+                else :
+                    self.add(i, photos[middle])
+                    return
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, i):
+        if i < 0 :
+            i += self.total
+        if i < 0 or i >= self.total :
+            raise IndexError(i)
+
+        self.locate(i)
+        return self.known[i]
+
+    def __iter__(self):
+        for i in range(0, self.total) :
+            yield self[i]
+
+    def index(self, name):
+        """
+        Function to obtain the position of a photo, None if it is not in the list.
+        """
+        if name in self.position :
+            return self.position[name]
+
+        photos = self.cameras.get(os.path.dirname(name), [])
+        c = bisect.bisect_left(photos, name)
+        if c == len(photos) or photos[c] != name :
+            return None
+
+        key = self.key(name)
+        i = sum(self.count(others, key) if others is not photos else c for others in self.cameras.values())
+        self.add(i, name)
+        return i
+
+    def following(self, pos, names, forward=True):
+        """
+        Function to obtain the position of the next (or previous) photo of a set after pos, going round
+        at the ends, without reading the photos in between: the first photo of the set after pos is
+        searched in every camera by name, only its time is read.
+
+        params:
+            - pos: position, None to start from the beginning (or the end).
+            - names: set of names of the photos.
+
+        return:
+            - position of the photo, None if no photo is in the set.
+        """
+        best = None
+
+        for start in ((pos,) if pos is not None else ()) + (None,) :
+            key = self.key(self[start]) if start is not None else None
+
+            for photos in self.cameras.values() :
+                if key is None :
+                    order = range(0, len(photos)) if forward else range(len(photos) - 1, -1, -1)
+                else :
+                    c = self.count(photos, key)
+                    order = range(c + 1 if c < len(photos) and photos[c] == key[1] else c, len(photos)) if forward else range(c - 1, -1, -1)
+
+                name = next((photos[j] for j in order if photos[j] in names), None)
+                if name is not None :
+                    other = self.key(name)
+                    if best is None or (other < best if forward else other > best) :
+                        best = other
+
+            if best is not None :
+                return self.index(best[1])
+
+        return None
+
+class ProjectIndex():
+    """
+    Class to keep the photos of the folders of a project, it works as the DirectoryIndex of a folder.
+    Every folder has its own DirectoryIndex (labels.json.0.index, labels.json.1.index...) and the
+    photos are named folder/photo. The navigation order is the capture time (see order).
+
+    params:
+        - project: path of the project file.
+    """
+
+    def __init__(self, project):
+        with open(project, 'r') as file :
+            info = json.load(file)
+
+        self.directory = os.path.dirname(os.path.abspath(project))
+        self.fileLabels = os.path.join(self.directory, info['labels'])
+        self.folders = info['folders']
+        self.indexes = [DirectoryIndex(self.fileLabels + "." + str(i), os.path.join(self.directory, self.folders[i]))
+                        for i in range(0, len(self.folders))]
+        self.times = TimeIndex(self.fileLabels, self.directory)
+        self.files = {}
+        self.changed = set()
+        self.merge()
+
+    def merge(self):
+        """
+        Function to join the photos of every folder with their folder in the name.
+        """
+        self.files = {}
+        for folder, index in zip(self.folders, self.indexes) :
+            for name, info in index.files.items() :
+                self.files[folder + "/" + name] = info
+
+    def names(self):
+        """
+        Function to obtain the sorted names of the photos in the index.
+        """
+        return sorted(self.files.keys())
+
+    def directories(self):
+        """
+        Function to obtain the folders of the photos.
+        """
+        return [index.directory for index in self.indexes]
+
+    def scan(self, full=False):
+        """
+        Function to update the index with the changes of the folders since the last scan.
+
+        params:
+            - full: read the folders even if their mtime has not changed (see DirectoryIndex.scan).
+
+        return:
+            - added: set with the names of the new photos.
+            - removed: set with the names of the deleted photos.
+        """
+        added = set()
+        removed = set()
+        self.changed = set()
+
+        for folder, index in zip(self.folders, self.indexes) :
+            new, old = index.scan(full)
+            added.update(folder + "/" + name for name in new)
+            removed.update(folder + "/" + name for name in old)
+            self.changed.update(folder + "/" + name for name in index.changed)
+
+        if added or removed or self.changed :
+            self.merge()
+
+        return added, removed
+
+    def order(self, names):
+        """
+        Function to obtain the photos in the order of their capture time, for LabelStore.order.
+        """
+        return Timeline(names, self.times, self.files)
+
+    def save(self):
+        """
+        Function to write the indexes of the folders and the capture times if there are changes.
+        """
+        for index in self.indexes :
+            index.save()
+
+        self.times.save()
+
+def createProject(project, folders, labels="labels.json"):
+    """
+    Function to create a project file and its empty labels' file.
+    """
+    directory = os.path.dirname(os.path.abspath(project))
+    folders = [os.path.relpath(os.path.abspath(folder), directory).replace(os.sep, "/") for folder in folders]
+
+    writeAtomic(project, { 'labels': labels, 'folders': folders })
+    if not os.path.exists(os.path.join(directory, labels)) :
+        writeAtomic(os.path.join(directory, labels), {})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create a project with the folders of several cameras or show its photos in time order.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help="create a project file")
+    create.add_argument('project')
+    create.add_argument('folders', nargs='+')
+    create.add_argument('--labels', default="labels.json", help="labels' file, relative to the project")
+
+    show = commands.add_parser('show', help="show the first photos in time order")
+    show.add_argument('project')
+    show.add_argument('--count', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'create' :
+        createProject(args.project, args.folders, args.labels)
+        print("Created " + args.project)
+    else :
+        index = ProjectIndex(args.project)
+        index.scan()
+        timeline = index.order(index.files.keys())
+
+        for i in range(0, min(args.count, len(timeline))) :
+            name = timeline[i]
+            print("%s  %s" % (name, index.times.get(name, index.files[name][0])))
+
+        index.save()
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multi-annotator shards, batch leases and merge
+Author: Carlos Herrero
+
+Usage:
+    python Shards.py merge labels.json labels.ana.json labels.bob.json --report conflicts.json
+    python Shards.py leases photos/
+"""
+
+import os
+import json
+import time
+import heapq
+import bisect
+import argparse
+from urllib.parse import quote
+
+from Storage import iterLabels
+
+LEASES = ".leases"
+BATCH_SIZE = 100            # photos of a batch
+LEASE_TIME = 2 * 3600       # seconds after which the batch of an annotator who does not renew it is free
+
+def shardPath(fileLabels, annotator):
+    """
+    Function to obtain the labels' file of an annotator: labels.json -> labels.annotator.json
+    """
+    base, ext = os.path.splitext(fileLabels)
+    return base + "." + annotator + (ext if ext else ".json")
+
+class Leases():
+    """
+    Class to share the photos of a folder between annotators in batches, nobody labels the same photo twice.
+    A batch is a range of consecutive photos in the order of the names, claimed with a lock file in the
+    folder of the photos (.leases/first photo.lock, the name quoted so folder/photo is one file) created
+    exclusively, so two annotators can not claim the same batch. The lock has the annotator, the range,
+    the time of the last renew and if it is done. The batch of an annotator who does not renew it
+    (a crashed app) is free after the lease time, it is taken over by only one annotator (see takeOver).
+
+    params:
+        - directory: folder of the photos.
+        - annotator: name of the annotator.
+        - size: photos of a batch.
+        - ttl: seconds without a renew after which a batch is free.
+    """
+
+    def __init__(self, directory, annotator, size=BATCH_SIZE, ttl=LEASE_TIME):
+        self.path = os.path.join(directory, LEASES)
+        self.annotator = annotator
+        self.size = size
+        self.ttl = ttl
+        os.makedirs(self.path, exist_ok=True)
+
+    def leases(self):
+        """
+        Function to read the leases of every annotator.
+
+        return:
+            - list of dicts with annotator, first, last, time and done, sorted by the first photo.
+        """
+        leases = []
+
+        with os.scandir(self.path) as entries :
+            for entry in entries :
+                if entry.name.endswith(".lock") :
+                    lease = self.read(entry.path)
+                    if lease :
+                        leases.append(lease)
+
+        return sorted(leases, key=lambda lease: lease['first'])
+
+    def read(self, path):
+        """
+        Function to read a lock file, None if it was removed or it is being written.
+        """
+        try:
+            with open(path, 'r') as file :
+                lease = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # The time written in the lock, a renew checks that nobody changed it
+        lease['file'] = path
+        lease['written'] = lease['time']
+        return lease
+
+    def write(self, lease):
+        """
+        Function to replace a lock file of this annotator (renew, done), only if it is still its lock.
+        The lock is renamed aside like in takeOver and checked: if another annotator took it over
+        (the annotator or the time changed) it is put back. The new lock is linked exclusively,
+        so a batch claimed by another annotator in the meantime is never overwritten.
+
+        return:
+            - False if the batch is not of this annotator anymore.
+        """
+        taken = lease['file'] + "." + self.annotator + ".renew"
+        tmp = lease['file'] + "." + self.annotator
+
+        try:
+            os.replace(lease['file'], taken)
+        except FileNotFoundError:
+            return False
+
+        found = self.read(taken)
+
+        if found is None or found['annotator'] != self.annotator or found['time'] != lease['written'] :
+            try:
+                os.link(taken, lease['file'])
+            except OSError:
+                pass
+
+            os.remove(taken)
+            return False
+
+        with open(tmp, 'w') as file :
+            json.dump({ key: lease[key] for key in ('annotator', 'first', 'last', 'time', 'done') }, file)
+
+        try:
+            os.link(tmp, lease['file'])
+            written = True
+        except FileExistsError:
+            written = False
+
+        os.remove(tmp)
+        os.remove(taken)
+
+        if written :
+            lease['written'] = lease['time']
+
+        return written
+
+    def expired(self, lease):
+        return not lease['done'] and time.time() - lease['time'] > self.ttl
+
+    def active(self):
+        """
+        Function to obtain the batch of this annotator which is not done, None if there is none.
+        """
+        for lease in self.leases() :
+            if lease['annotator'] == self.annotator and not lease['done'] :
+                return lease
+
+        return None
+
+    def claim(self, names):
+        """
+        Function to claim the next batch, continuing the batch of this annotator which is not done.
+        The batch is the first photos of the list not in a lease (or in an expired one).
+
+        params:
+            - names: sorted names of the photos of the folder.
+
+        return:
+            - the lease of the batch, None if all the photos are in a batch.
+        """
+        while True :
+            leases = self.leases()
+
+            for lease in leases :
+                if lease['annotator'] == self.annotator and not lease['done'] :
+                    if self.renew(lease) :
+                        return lease
+
+            for lease in leases :
+                if self.expired(lease) :
+                    lease = self.takeOver(lease)
+                    if lease :
+                        return lease
+
+            batch = self.free(names, [lease for lease in leases if not self.expired(lease)])
+            if not batch :
+                return None
+
+            lease = { 'annotator': self.annotator, 'first': batch[0], 'last': batch[-1], 'time': time.time(), 'done': False,
+                      'file': self.lockFile(batch[0]) }
+            if self.create(lease) :
+                return lease
+
+            # Another annotator claimed it first, look again
+
+    def lockFile(self, first):
+        """
+        Function to obtain the lock file of a batch, the photos of a project are named folder/photo.
+        """
+        return os.path.join(self.path, quote(first, safe='') + ".lock")
+
+    def create(self, lease):
+        """
+        Function to create a lock file exclusively, False if it already exists.
+        """
+        try:
+            fd = os.open(lease['file'], os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, 'w') as file :
+            json.dump({ key: lease[key] for key in ('annotator', 'first', 'last', 'time', 'done') }, file)
+
+        lease['written'] = lease['time']
+        return True
+
+    def takeOver(self, lease):
+        """
+        Function to take over an expired batch, only one of the annotators trying it at the same time gets it.
+        The lock is renamed to a file of this annotator, a rename of the same file succeeds only once.
+        If the renamed lock is not the expired one (it was taken over or renewed in the meantime) it is
+        put back, else the lock is created again exclusively for this annotator.
+
+        return:
+            - the lease of the batch, None if another annotator got it.
+        """
+        taken = lease['file'] + "." + self.annotator + ".takeover"
+
+        try:
+            os.replace(lease['file'], taken)
+        except FileNotFoundError:
+            return None
+
+        found = self.read(taken)
+
+        if found is None or found['annotator'] != lease['annotator'] or found['time'] != lease['time'] :
+            try:
+                os.link(taken, lease['file'])
+            except OSError:
+                pass
+
+            os.remove(taken)
+            return None
+
+        found.update(annotator=self.annotator, time=time.time(), file=lease['file'])
+        created = self.create(found)
+        os.remove(taken)
+
+        return found if created else None
+
+    def free(self, names, leases):
+        """
+        Function to obtain the first photos of the list which are not in a lease.
+        """
+        batch = []
+        ranges = [(lease['first'], lease['last']) for lease in leases]
+        firsts = [first for first, last in ranges]
+
+        for name in names :
+            j = bisect.bisect_right(firsts, name) - 1
+            if j >= 0 and ranges[j][0] <= name <= ranges[j][1] :
+                if batch :
+                    break
+                continue
+
+            batch.append(name)
+            if len(batch) == self.size :
+                break
+
+        return batch
+
+    def photos(self, lease, names):
+        """
+        Function to obtain the photos of a batch.
+
+        params:
+            - names: sorted names of the photos of the folder.
+        """
+        return names[bisect.bisect_left(names, lease['first']):bisect.bisect_right(names, lease['last'])]
+
+    def renew(self, lease):
+        """
+        Function to tell the other annotators that this batch is still being labelled.
+
+        return:
+            - the lease, None if the batch was taken over by another annotator (it expired).
+        """
+        lease['time'] = time.time()
+        return lease if self.write(lease) else None
+
+    def finish(self, lease):
+        """
+        Function to mark a batch as done, it is never claimed again.
+
+        return:
+            - the lease, None if the batch was taken over by another annotator.
+        """
+        lease['done'] = True
+        return self.renew(lease)
+
+def mergeShards(shards, output, report=None):
+    """
+    Function to merge the labels' files of the annotators in one labels' file.
+    The files are read streaming and merged by photo name (k-way merge), so only the labels of one
+    photo of every file are in memory. The labels of a photo are taken from the file which has them,
+    if several files have different labels for the same photo it is a conflict: the labels of the
+    first file are kept and the photo is written in the report.
+
+    params:
+        - shards: labels' files (JSON or SQLite), the first ones win the conflicts.
+        - output: merged labels' file (JSON).
+        - report: JSON file with the conflicts.
+
+    return:
+        - photos: number of photos of the merged file.
+        - conflicts: list of { photo, labels: { shard: labels } }.
+    """
+    streams = [ordered(shards[i], i) for i in range(0, len(shards))]
+    conflicts = []
+    photos = 0
+
+    tmp = output + ".tmp"
+    with open(tmp, 'w') as file :
+        file.write("{")
+        actual = None
+        found = []
+
+        for name, i, labels in heapq.merge(*streams, key=lambda entry: (entry[0], entry[1])) :
+            if name != actual :
+                if actual is not None :
+                    writeMerged(file, actual, found, shards, conflicts, photos == 0)
+                    photos += 1
+                actual = name
+                found = []
+
+            found.append((i, labels))
+
+        if actual is not None :
+            writeMerged(file, actual, found, shards, conflicts, photos == 0)
+            photos += 1
+
+        file.write("}")
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(tmp, output)
+
+    if report :
+        with open(report, 'w') as file :
+            json.dump(conflicts, file, indent=1)
+
+    return photos, conflicts
+
+def ordered(shard, i):
+    """
+    Function to read a labels' file checking that the photos are in order, as the merge needs.
+
+    yields:
+        - (name, i, labels) of every photo, i is the position of the file in the merge.
+    """
+    previous = None
+
+    for name, labels in iterLabels(shard) :
+        if previous is not None and name <= previous :
+            raise ValueError(shard + " is not sorted by photo, open it and save it with this version of the app")
+
+        previous = name
+        yield name, i, labels
+
+def writeMerged(file, name, found, shards, conflicts, first):
+    """
+    Function to write the labels of a photo in the merged file.
+
+    params:
+        - found: list of (shard, labels) with the labels of the photo in every shard where it is.
+        - first: it is the first photo of the file.
+    """
+    labelled = [(i, labels) for i, labels in found if len(labels) > 0]
+
+    if len(labelled) > 1 and any(labels != labelled[0][1] for i, labels in labelled[1:]) :
+        conflicts.append({ 'photo': name, 'labels': { shards[i]: labels for i, labels in labelled } })
+
+    labels = labelled[0][1] if labelled else []
+    file.write(("" if first else ", ") + json.dumps(name) + ": " + json.dumps(labels))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the labels' files of the annotators or show the leases of a folder.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    merge = commands.add_parser('merge', help="merge labels' files, the first ones win the conflicts")
+    merge.add_argument('output')
+    merge.add_argument('shards', nargs='+')
+    merge.add_argument('--report', default=None, help="JSON file with the conflicts")
+
+    leases = commands.add_parser('leases', help="show the batches of every annotator")
+    leases.add_argument('directory')
+    args = parser.parse_args()
+
+    if args.command == 'merge' :
+        photos, conflicts = mergeShards(args.shards, args.output, args.report)
+        print("Merged %d photos, %d conflicts" % (photos, len(conflicts)))
+        for conflict in conflicts :
+            print("    %s: %s" % (conflict['photo'], ", ".join(conflict['labels'].keys())))
+    else :
+        for lease in Leases(args.directory, None).leases() :
+            state = "done" if lease['done'] else "%.0f min ago" % ((time.time() - lease['time']) / 60)
+            print("%-16s %s - %s (%s)" % (lease['annotator'], lease['first'], lease['last'], state))
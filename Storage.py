@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+
+"""
+Storage backends for the labels
+Author: Carlos Herrero
+
+Usage:
+    python Storage.py import labels.json labels.db
+    python Storage.py export labels.db labels.json
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+
+from Journal import Journal, writeAtomic, SAVED
+from LazyLabels import Lazy, OffsetIndex
+
+SQLITE = ('.db', '.sqlite', '.sqlite3')
+CHUNK = 1024 * 1024     # characters of a JSON file read at once when it is streamed
+
+def openStorage(fileLabels, lazy=False):
+    """
+    Function to open the backend of a labels' file, chosen by its extension.
+
+    params:
+        - lazy: read the labels of a JSON file photo by photo when they are needed (see JsonStorage).
+    """
+    if os.path.splitext(fileLabels)[1].lower() in SQLITE :
+        return SqliteStorage(fileLabels)
+
+    return JsonStorage(fileLabels, lazy)
+
+def iterLabels(fileLabels):
+    """
+    Function to read the labels of a labels' file photo by photo, without loading the whole file.
+    The pending changes of the journal of a JSON file are applied, keeping the order of the names
+    if the file is sorted (the files written by the app are).
+
+    yields:
+        - (name, labels) of every photo, labels with the JSON structure.
+    """
+    if os.path.splitext(fileLabels)[1].lower() in SQLITE :
+        storage = SqliteStorage(fileLabels)
+        yield from storage.iterLabels()
+        storage.db.close()
+        return
+
+    pending = Journal(fileLabels).replay({})
+    names = sorted(pending.keys())
+    emitted = set()
+    i = 0
+
+    for name, labels in iterJson(fileLabels) :
+        if name in emitted :
+            continue
+
+        # The photos of the journal not in the file go in their place
+        while i < len(names) and names[i] < name :
+            if names[i] in pending :
+                emitted.add(names[i])
+                yield names[i], pending.pop(names[i])
+            i += 1
+
+        yield name, pending.pop(name, labels)
+
+    for name in names :
+        if name in pending :
+            yield name, pending.pop(name)
+
+def iterJson(path, chunk=CHUNK, offsets=False):
+    """
+    Function to read the members of a JSON object one by one.
+    The file is read in chunks and every member is decoded when it is complete, so only one
+    chunk and one member are in memory.
+
+    params:
+        - offsets: yield the position in bytes of every value in the file too.
+
+    yields:
+        - (key, value) or (key, value, start, end) of every member of the object.
+    """
+    decoder = json.JSONDecoder()
+
+    # With offsets every byte is read as one character, the keys are decoded again from their UTF-8 bytes
+    with open(path, 'r', encoding='latin-1' if offsets else None) as file :
+        buffer = ""
+        base = 0
+        i = 0
+        end = False
+        start = True
+
+        while True :
+            while i < len(buffer) and buffer[i].isspace() :
+                i += 1
+
+            # The key, ':' and value of a member can be split between chunks
+            more = i == len(buffer)
+
+            if more :
+                pass
+            elif start :
+                if buffer[i] != '{' :
+                    raise ValueError(path + " is not a labels' file")
+                i += 1
+                start = False
+            elif buffer[i] == '}' :
+                return
+            elif buffer[i] in ',:' :
+                i += 1
+            else :
+                try:
+                    key, j = decoder.raw_decode(buffer, i)
+                    raw = buffer[i:j]
+                    while j < len(buffer) and buffer[j] in ' \t\r\n:' :
+                        j += 1
+                    begin = j
+                    value, j = decoder.raw_decode(buffer, j)
+
+                    # A number at the end of the buffer could be incomplete, labels are lists
+                    more = not isinstance(value, list) and j == len(buffer) and not end
+                except json.JSONDecodeError:
+                    if end :
+                        raise
+                    more = True
+
+                if not more :
+                    if offsets :
+                        yield json.loads(raw.encode('latin-1')), value, base + begin, base + j
+                    else :
+                        yield key, value
+                    i = j
+
+            if more :
+                if end :
+                    raise ValueError("Unexpected end of " + path)
+
+                data = file.read(chunk)
+                buffer = buffer[i:] + data
+                base += i
+                i = 0
+                end = not data
+
+class JsonStorage():
+    """
+    Class to store the labels in a JSON file (the original format of the app).
+    The changes go to the journal of the file, which is compacted in the file when it grows or on exit.
+    The journal and the file are written by the writer thread of the journal.
+
+    In lazy mode the file is not parsed: the labels of every photo are a Lazy object read with
+    the offset index of the file when they are needed, and the compactions update the index.
+
+    params:
+        - fileLabels: path of the JSON file.
+        - lazy: read the labels photo by photo.
+    """
+
+    def __init__(self, fileLabels, lazy=False):
+        self.fileLabels = fileLabels
+        self.lazy = lazy
+        self.journal = Journal(fileLabels)
+
+    def create(self):
+        """
+        Function to create an empty labels' file.
+        """
+        self.journal.clear()
+        writeAtomic(self.fileLabels, {})
+
+    def load(self):
+        """
+        Function to read the labels of every photo.
+        The changes not written yet are written first, so they are in the file and the journal read,
+        the error of the write is raised and the labels in memory are kept.
+        """
+        # Before the offsets are read, a pending compaction rewrites the file
+        self.journal.flush(wait=True)
+
+        if self.lazy :
+            index = OffsetIndex(self.fileLabels).open()
+            self.journal.writer = index.write
+            return self.journal.replay({ name: Lazy(index, name) for name in index.entries.keys() })
+
+        with open(self.fileLabels, 'r') as file :
+            data = json.load(file)
+
+        return self.journal.replay(data)
+
+    def record(self, name, labels):
+        """
+        Function to save the new labels of a photo.
+        """
+        self.journal.record(name, labels)
+
+    def addPhotos(self, names):
+        """
+        Function to add photos without labels, they are written with the next compaction.
+        """
+        pass
+
+    def removePhotos(self, names):
+        """
+        Function to remove photos and their labels, they are removed with the next compaction.
+        """
+        pass
+
+    def importJson(self, path):
+        """
+        Function to replace the labels with the labels of another JSON file.
+        """
+        with open(path, 'r') as file :
+            data = json.load(file)
+
+        self.journal.clear()
+        writeAtomic(self.fileLabels, data)
+
+    def autosave(self, data):
+        """
+        Function to save the labels when we change the photo.
+        """
+        self.journal.compactIfNeeded(data)
+
+    def save(self, data):
+        """
+        Function to write all the labels in the file now, in background.
+        """
+        self.journal.compact(data)
+        self.journal.flush()
+
+    def status(self):
+        """
+        Function to obtain the state of the writes (see Journal) and the error of the last one.
+        """
+        return self.journal.status()
+
+    def close(self, data):
+        """
+        Function to write the pending changes and close the storage.
+        """
+        self.journal.close(data)
+
+class SqliteStorage():
+    """
+    Class to store the labels in a SQLite database.
+    Photos, persons and dorsal numbers are stored in their own tables, with indexes on the
+    labelled state of the photos and on the dorsal numbers. Every edit is one transaction.
+
+    params:
+        - fileLabels: path of the database.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS photos (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            labelled INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS persons (
+            id INTEGER PRIMARY KEY,
+            photo INTEGER NOT NULL REFERENCES photos(id) ON DELETE CASCADE,
+            idx INTEGER NOT NULL,
+            x1 REAL, y1 REAL, x2 REAL, y2 REAL
+        );
+        CREATE TABLE IF NOT EXISTS numbers (
+            person INTEGER PRIMARY KEY REFERENCES persons(id) ON DELETE CASCADE,
+            number INTEGER,
+            x1 REAL, y1 REAL, x2 REAL, y2 REAL
+        );
+        CREATE INDEX IF NOT EXISTS photos_labelled ON photos(labelled, name);
+        CREATE INDEX IF NOT EXISTS persons_photo ON persons(photo, idx);
+        CREATE INDEX IF NOT EXISTS numbers_number ON numbers(number);
+    """
+
+    def __init__(self, fileLabels):
+        self.fileLabels = fileLabels
+        self.db = sqlite3.connect(fileLabels)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def create(self):
+        """
+        Function to empty the database.
+        """
+        with self.db :
+            self.db.execute("DELETE FROM photos")
+
+    def load(self):
+        """
+        Function to read the labels of every photo, with the same structure as the JSON file.
+        """
+        data = {}
+        ids = {}
+
+        for id, name in self.db.execute("SELECT id, name FROM photos ORDER BY name") :
+            data[name] = []
+            ids[id] = data[name]
+
+        query = """
+            SELECT persons.photo, persons.x1, persons.y1, persons.x2, persons.y2,
+                   numbers.person, numbers.number, numbers.x1, numbers.y1, numbers.x2, numbers.y2
+            FROM persons LEFT JOIN numbers ON numbers.person = persons.id
+            ORDER BY persons.photo, persons.idx
+        """
+        for row in self.db.execute(query) :
+            ids[row[0]].append(self.person(row))
+
+        return data
+
+    def iterLabels(self):
+        """
+        Function to read the labels photo by photo, in the order of the names.
+
+        yields:
+            - (name, labels) of every photo, labels with the JSON structure.
+        """
+        query = """
+            SELECT photos.name, persons.x1, persons.y1, persons.x2, persons.y2,
+                   numbers.person, numbers.number, numbers.x1, numbers.y1, numbers.x2, numbers.y2,
+                   persons.id
+            FROM photos
+            LEFT JOIN persons ON persons.photo = photos.id
+            LEFT JOIN numbers ON numbers.person = persons.id
+            ORDER BY photos.name, persons.idx
+        """
+        name = None
+        labels = []
+
+        for row in self.db.execute(query) :
+            if row[0] != name :
+                if name is not None :
+                    yield name, labels
+                name = row[0]
+                labels = []
+
+            if row[11] is not None :
+                labels.append(self.person(row))
+
+        if name is not None :
+            yield name, labels
+
+    def person(self, row):
+        """
+        Function to create the JSON structure of a person from a row of the persons and numbers tables.
+        """
+        person = { 'position': list(row[1:5]) }
+
+        if row[5] is not None :
+            person['number'] = { 'position': list(row[7:11]) }
+            if row[6] is not None :
+                person['number']['number'] = row[6]
+
+        return person
+
+    def photoId(self, name):
+        """
+        Function to obtain the id of a photo, adding it if it is not in the database.
+        """
+        self.db.execute("INSERT OR IGNORE INTO photos (name) VALUES (?)", (name,))
+        return self.db.execute("SELECT id FROM photos WHERE name = ?", (name,)).fetchone()[0]
+
+    def insertLabels(self, id, labels):
+        """
+        Function to insert the labels of a photo, used inside a transaction.
+        """
+        self.db.execute("DELETE FROM persons WHERE photo = ?", (id,))
+
+        for i in range(0, len(labels)) :
+            person = labels[i]
+            cursor = self.db.execute("INSERT INTO persons (photo, idx, x1, y1, x2, y2) VALUES (?, ?, ?, ?, ?, ?)",
+                                     [id, i] + list(person['position']))
+
+            if person.get('number', None) :
+                number = person['number']
+                self.db.execute("INSERT INTO numbers (person, number, x1, y1, x2, y2) VALUES (?, ?, ?, ?, ?, ?)",
+                                [cursor.lastrowid, number.get('number', None)] + list(number['position']))
+
+        self.db.execute("UPDATE photos SET labelled = ? WHERE id = ?", (1 if len(labels) > 0 else 0, id))
+
+    def record(self, name, labels):
+        """
+        Function to save the new labels of a photo in one transaction.
+        """
+        with self.db :
+            self.insertLabels(self.photoId(name), labels)
+
+    def addPhotos(self, names):
+        """
+        Function to add photos without labels.
+        """
+        with self.db :
+            self.db.executemany("INSERT OR IGNORE INTO photos (name) VALUES (?)", [(name,) for name in names])
+
+    def removePhotos(self, names):
+        """
+        Function to remove photos and their labels.
+        """
+        with self.db :
+            self.db.executemany("DELETE FROM photos WHERE name = ?", [(name,) for name in names])
+
+    def unlabeled(self):
+        """
+        Function to obtain the sorted names of the photos without labels.
+        """
+        return [row[0] for row in self.db.execute("SELECT name FROM photos WHERE labelled = 0 ORDER BY name")]
+
+    def findNumber(self, number):
+        """
+        Function to obtain the photos where a dorsal number appears.
+
+        return:
+            - list of (photo name, person index).
+        """
+        query = """
+            SELECT photos.name, persons.idx FROM numbers
+            JOIN persons ON persons.id = numbers.person
+            JOIN photos ON photos.id = persons.photo
+            WHERE numbers.number = ?
+            ORDER BY photos.name, persons.idx
+        """
+        return self.db.execute(query, (number,)).fetchall()
+
+    def importJson(self, path):
+        """
+        Function to replace the content of the database with a JSON labels' file.
+        """
+        with open(path, 'r') as file :
+            data = json.load(file)
+
+        with self.db :
+            self.db.execute("DELETE FROM photos")
+            self.db.executemany("INSERT INTO photos (name) VALUES (?)", [(name,) for name in data.keys()])
+
+            for name, labels in data.items() :
+                if len(labels) > 0 :
+                    self.insertLabels(self.photoId(name), labels)
+
+    def exportJson(self, path):
+        """
+        Function to write the content of the database as a JSON labels' file.
+        """
+        writeAtomic(path, self.load())
+
+    def autosave(self, data):
+        """
+        Function to save the labels when we change the photo, every edit is already committed.
+        """
+        pass
+
+    def save(self, data):
+        """
+        Function to write all the labels, every edit is already committed.
+        """
+        self.db.commit()
+
+    def status(self):
+        """
+        Function to obtain the state of the writes, every edit is committed when it is made.
+        """
+        return SAVED, None
+
+    def close(self, data):
+        """
+        Function to close the database.
+        """
+        self.db.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import or export the labels of a SQLite database as JSON.")
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    args = parser.parse_args()
+
+    if args.action == 'import' :
+        SqliteStorage(args.destination).importJson(args.source)
+    else :
+        SqliteStorage(args.source).exportJson(args.destination)
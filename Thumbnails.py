@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""
+Thumbnails filmstrip with a persistent thumbnail cache
+Author: Carlos Herrero
+"""
+
+from PyQt5.QtWidgets import QListView, QAbstractItemView
+from PyQt5.QtGui import QImage, QPixmap, QColor, QBrush
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QAbstractListModel, QModelIndex, QSize, QStandardPaths, pyqtSignal
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import Trace
+from ImageCache import readImage, LoaderSignals
+
+THUMB_SIZE = 160        # longest side of the thumbnails in pixels
+THUMB_QUALITY = 85
+THUMB_MEMORY = 2000     # thumbnails kept in memory
+LABELLED = QColor(60, 170, 60, 110)
+
+def thumbDirectory():
+    """
+    Function to obtain the folder of the thumbnail cache of the user, shared by all the events.
+    """
+    directory = QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation)
+    directory = directory if directory else os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(directory, "labeler", "thumbnails")
+
+def thumbFile(directory, path, mtime):
+    """
+    Function to obtain the file of the thumbnail of a photo: sha1 of its path and mtime, so a
+    photo which is modified gets a new thumbnail and the old one is never read again.
+    """
+    key = hashlib.sha1((os.path.abspath(path) + "\n" + repr(mtime)).encode('utf-8')).hexdigest()
+    return os.path.join(directory, key[0:2], key + ".jpg")
+
+class ThumbnailLoader(QRunnable):
+    """
+    Class to obtain the thumbnail of a photo in a worker thread of the pool.
+    The thumbnail is read from the disk cache, if it is not there the photo is decoded at the
+    thumbnail size (JPEG decoders skip most of the work) and the thumbnail is written to the cache.
+
+    params:
+        - path: photo path.
+        - file: file of the thumbnail in the disk cache.
+        - size: longest side of the thumbnail.
+        - signals: LoaderSignals where the thumbnail is emitted.
+    """
+
+    def __init__(self, path, file, size, signals):
+        super(ThumbnailLoader, self).__init__()
+        self.path = path
+        self.file = file
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        with Trace.span('thumbnail') :
+            image = QImage(self.file)
+
+            if image.isNull() :
+                image = readImage(self.path, self.size)
+
+                if not image.isNull() :
+                    # Written to a temporary file and renamed, other apps can read the cache at the same time
+                    tmp = self.file + "." + str(os.getpid()) + ".tmp"
+                    try:
+                        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+                        if image.save(tmp, 'JPEG', THUMB_QUALITY) :
+                            os.replace(tmp, self.file)
+                    except OSError:
+                        pass
+
+        self.signals.loaded.emit(self.path, self.size, image)
+
+class ThumbnailCache(QObject):
+    """
+    Class to obtain the thumbnails of the photos without blocking the interface.
+    The thumbnails are loaded in a QThreadPool, kept in a LRU cache in memory and in a disk cache
+    (see thumbFile), so an event is decoded only the first time it is opened. The last requested
+    thumbnails are loaded first, and the requests not started are discarded with cancel.
+
+    params:
+        - directory: folder of the disk cache.
+        - size: longest side of the thumbnails.
+        - memory: number of thumbnails kept in memory.
+        - parent: QObject parent.
+    """
+    ready = pyqtSignal(str)
+
+    def __init__(self, directory=None, size=THUMB_SIZE, memory=THUMB_MEMORY, parent=None):
+        super(ThumbnailCache, self).__init__(parent)
+        self.directory = directory if directory else thumbDirectory()
+        self.size = size
+        self.memory = memory
+        self.priority = 0
+
+        self.pixmaps = OrderedDict()
+        self.pending = set()
+
+        # The signals are a child created after the pool, they are deleted once the pool has waited for its workers
+        self.pool = QThreadPool(self)
+        self.signals = LoaderSignals(self)
+        self.signals.loaded.connect(self.onLoaded)
+
+    def thumbnail(self, path, mtime):
+        """
+        Function to obtain the thumbnail of a photo, None if it is being loaded.
+        The ready signal is emitted with the path of the photo when it is loaded.
+        """
+        pixmap = self.pixmaps.get(path, None)
+
+        if pixmap is not None :
+            self.pixmaps.move_to_end(path)
+            return pixmap
+
+        if path not in self.pending :
+            self.pending.add(path)
+            self.priority += 1
+            self.pool.start(ThumbnailLoader(path, thumbFile(self.directory, path, mtime), self.size, self.signals), self.priority)
+
+        return None
+
+    def cancel(self):
+        """
+        Function to discard the thumbnails requested which are not being loaded yet (they are
+        not visible after a scroll, the visible ones are requested again when they are drawn).
+        """
+        self.pool.clear()
+        self.pending.clear()
+
+    def onLoaded(self, path, size, image):
+        """
+        Function to capture the thumbnails loaded by the workers.
+        """
+        self.pending.discard(path)
+
+        if image.isNull() or size != self.size :
+            return
+
+        self.pixmaps[path] = QPixmap.fromImage(image)
+        while len(self.pixmaps) > self.memory :
+            self.pixmaps.popitem(last=False)
+
+        self.ready.emit(path)
+
+    def clear(self):
+        """
+        Function to empty the memory cache, the disk cache is kept.
+        """
+        self.cancel()
+        self.pixmaps.clear()
+
+    def shutdown(self):
+        """
+        Function to stop the loaders before the app is closed, the running ones are waited.
+        """
+        self.cancel()
+        self.pool.waitForDone()
+
+class FilmstripModel(QAbstractListModel):
+    """
+    Class with the photos of the store for the filmstrip: the thumbnail, the name and the
+    background coloured if the photo has labels. The view asks only for the visible rows, so
+    only the visible thumbnails are loaded.
+
+    params:
+        - thumbnails: ThumbnailCache.
+        - parent: QObject parent.
+    """
+
+    def __init__(self, thumbnails, parent=None):
+        super(FilmstripModel, self).__init__(parent)
+        self.thumbnails = thumbnails
+        self.thumbnails.ready.connect(self.onReady)
+        self.store = None
+        self.files = {}
+
+    def setPhotos(self, store, files):
+        """
+        Function to show the photos of a store.
+
+        params:
+            - store: LabelStore.
+            - files: dict with [mtime, size] of every photo (see DirectoryIndex).
+        """
+        self.beginResetModel()
+        self.thumbnails.cancel()
+        self.store = store
+        self.files = files
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid() or self.store is None :
+            return 0
+
+        return len(self.store.photos)
+
+    def data(self, index, role=Qt.DisplayRole):
+        store = self.store
+        if not index.isValid() or index.row() >= len(store.photos) :
+            return None
+
+        # The view asks only for the visible rows, a lazy list (see Project.Timeline) locates them
+        # without reading the photos before them
+        name = store.photos[index.row()]
+
+        if role == Qt.DisplayRole or role == Qt.ToolTipRole :
+            return name
+        elif role == Qt.DecorationRole :
+            info = self.files.get(name, None)
+            return self.thumbnails.thumbnail(store.directory + "/" + name, info[0] if info else None)
+        elif role == Qt.BackgroundRole :
+            return QBrush(LABELLED) if len(store.labels.get(name, ())) > 0 else None
+
+        return None
+
+    def onReady(self, path):
+        """
+        Function to draw a thumbnail when it is loaded.
+        """
+        if self.store is None or self.store.directory is None :
+            return
+
+        row = self.store.positionOf(path[len(self.store.directory) + 1:])
+        if row is not None :
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+class Filmstrip(QListView):
+    """
+    Class to show the thumbnails of the photos in a grid.
+    All the items have the same size, so the view places them without asking the model and
+    scrolling through thousands of photos draws only the visible ones.
+
+    params:
+        - size: longest side of the thumbnails.
+        - parent: QWidget parent.
+    """
+
+    def __init__(self, size=THUMB_SIZE, parent=None):
+        super(Filmstrip, self).__init__(parent)
+        self.setViewMode(QListView.IconMode)
+        self.setMovement(QListView.Static)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(True)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setIconSize(QSize(size, size))
+        self.setGridSize(QSize(size + 12, size + 28))
+        self.setTextElideMode(Qt.ElideMiddle)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+
+        # The thumbnails requested before a scroll are not visible any more
+        self.verticalScrollBar().valueChanged.connect(self.onScroll)
+
+    def onScroll(self, value):
+        if self.model() :
+            self.model().thumbnails.cancel()
+
+    def showPosition(self, pos):
+        """
+        Function to select the photo at a position and scroll to it.
+        """
+        if self.model() is None or pos is None :
+            return
+
+        index = self.model().index(pos)
+        self.setCurrentIndex(index)
+        self.scrollTo(index)
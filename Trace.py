@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing of the hot paths of the app
+Author: Carlos Herrero
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import collections
+
+TRACE_SIZE = 20000      # events kept in the ring buffer
+
+class Tracer():
+    """
+    Class to record the duration of the main operations in a ring buffer.
+    Every event is (name, start, duration, thread) in seconds of time.perf_counter, the oldest
+    events are discarded. Appending to a deque is thread safe, the background decodes and
+    compactions are recorded too.
+
+    params:
+        - size: number of events kept.
+    """
+
+    def __init__(self, size=TRACE_SIZE):
+        self.events = collections.deque(maxlen=size)
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Function to time the block of a with statement.
+        """
+        if not self.enabled :
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append((name, start, time.perf_counter() - start, threading.get_ident()))
+
+    def stats(self, names=None):
+        """
+        Function to obtain the last, median, 95 percentile and maximum duration in ms of every operation.
+
+        params:
+            - names: operations to summarize, all by default.
+
+        return:
+            - dict with the stats of every operation with events, in the order of names.
+        """
+        durations = {}
+        for name, start, duration, thread in list(self.events) :
+            if names is None or name in names :
+                durations.setdefault(name, []).append(duration * 1000)
+
+        result = {}
+        for name in (names if names is not None else sorted(durations.keys())) :
+            if name in durations :
+                samples = sorted(durations[name])
+                result[name] = {
+                    'n': len(samples),
+                    'last': durations[name][-1],
+                    'p50': samples[len(samples) // 2],
+                    'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                    'max': samples[-1],
+                }
+
+        return result
+
+    def export(self, path):
+        """
+        Function to write the events as a Chrome trace (chrome://tracing, Perfetto).
+        """
+        pid = os.getpid()
+        events = [{ 'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': thread }
+                  for name, start, duration, thread in list(self.events)]
+
+        with open(path, 'w') as file :
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, file)
+
+    def clear(self):
+        """
+        Function to discard the events.
+        """
+        self.events.clear()
+
+tracer = Tracer()
+
+def span(name):
+    """
+    Function to time a block with the tracer of the app:
+
+        with Trace.span('decode') :
+            ...
+    """
+    return tracer.span(name)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+Quality checks of the labels
+Author: Carlos Herrero
+
+Usage:
+    python Validate.py labels.json [--report issues.json]
+
+Needs numpy.
+"""
+
+import json
+import argparse
+
+import numpy
+
+from Storage import iterLabels
+
+MIN_SIDE = 4            # boxes with a side smaller than this (pixels) are empty
+OVERLAP = 0.8           # persons of a photo with a bigger IoU are the same person
+OUTLIER = 5.0           # robust z-score of the size and aspect outliers
+PRESS_MARGIN = 20       # the clicks are clamped this far from the right and bottom edges (see Photo.pressPerson)
+METADATA = ".meta"      # sidecar of the dimensions of the photos (see Metadata, it needs Qt)
+
+CHECKS = {
+    'empty': "zero-size box (click without drag)",
+    'outside': "dorsal outside its person",
+    'overlap': "persons overlapping (IoU %.2f with person %d)",
+    'size': "size outlier",
+    'aspect': "aspect outlier",
+    'number': "number %d repeated in the photo",
+    'edge': "box clamped to the edge",
+}
+
+class Boxes():
+    """
+    Class with all the boxes of a labels' file in numpy arrays, one row per person.
+
+    params:
+        - names: name of every photo, the photo column is a position in this list.
+        - photo: photo of every person. (int64)
+        - person: index of every person in its photo. (int64)
+        - box: (x1, y1, x2, y2) of every person. (float64, n x 4)
+        - dorsal: (x1, y1, x2, y2) of the dorsal of every person, NaN if it has not. (float64, n x 4)
+        - number: dorsal number of every person, -1 if it has not. (int64)
+    """
+
+    def __init__(self, names, photo, person, box, dorsal, number):
+        self.names = names
+        self.photo = photo
+        self.person = person
+        self.box = box
+        self.dorsal = dorsal
+        self.number = number
+
+def loadBoxes(items):
+    """
+    Function to read the boxes of every photo in numpy arrays.
+    The corners of the boxes are sorted, x1 <= x2 and y1 <= y2.
+
+    params:
+        - items: iterable of (name, labels) with the JSON structure, in the order of the names.
+
+    return:
+        - Boxes.
+    """
+    names = []
+    photo = []
+    person = []
+    box = []
+    dorsal = []
+    number = []
+    none = [numpy.nan] * 4
+
+    for name, labels in items :
+        for i in range(0, len(labels)) :
+            found = labels[i].get('number', None)
+            photo.append(len(names))
+            person.append(i)
+            box.extend(labels[i]['position'])
+            dorsal.extend(found['position'] if found else none)
+            number.append(found['number'] if found and found.get('number', None) is not None else -1)
+
+        names.append(name)
+
+    box = numpy.array(box, dtype=numpy.float64).reshape(-1, 4)
+    dorsal = numpy.array(dorsal, dtype=numpy.float64).reshape(-1, 4)
+
+    return Boxes(names, numpy.array(photo, dtype=numpy.int64), numpy.array(person, dtype=numpy.int64),
+                 sortCorners(box), sortCorners(dorsal), numpy.array(number, dtype=numpy.int64))
+
+def sortCorners(box):
+    return numpy.concatenate([numpy.minimum(box[:, 0:2], box[:, 2:4]), numpy.maximum(box[:, 0:2], box[:, 2:4])], axis=1)
+
+def outliers(box, valid, limit):
+    """
+    Function to find the boxes with an unusual size or aspect, with the robust z-score
+    (median and median absolute deviation) of the logarithm of the area and of the aspect.
+
+    return:
+        - size: boolean array of the size outliers.
+        - aspect: boolean array of the aspect outliers.
+    """
+    width = box[:, 2] - box[:, 0]
+    height = box[:, 3] - box[:, 1]
+    result = []
+
+    with numpy.errstate(divide='ignore', invalid='ignore') :
+        for values in (numpy.log(width * height), numpy.log(height / width)) :
+            found = numpy.zeros(len(box), dtype=bool)
+
+            if valid.sum() > 2 :
+                median = numpy.median(values[valid])
+                deviation = numpy.median(numpy.abs(values[valid] - median))
+
+                if deviation > 0 :
+                    found[valid] = numpy.abs(0.6745 * (values[valid] - median) / deviation) > limit
+
+            result.append(found)
+
+    return result
+
+def validate(boxes, sizes=None, minSide=MIN_SIDE, overlap=OVERLAP, outlier=OUTLIER):
+    """
+    Function to run all the checks of the labels at once over the arrays of the boxes.
+
+    params:
+        - boxes: Boxes.
+        - sizes: dict with the width and height of the photos (see MetadataIndex), to check the
+          boxes clamped to the edges. The photos not in the dict are not checked.
+
+    return:
+        - list of issues { photo, person, check, message } sorted by photo and person.
+    """
+    box, dorsal, photo = boxes.box, boxes.dorsal, boxes.photo
+    issues = []
+
+    def report(check, mask, details=None):
+        for j in numpy.flatnonzero(mask) :
+            message = CHECKS[check] % details(j) if details else CHECKS[check]
+            issues.append((int(photo[j]), int(boxes.person[j]), check, message))
+
+    hasDorsal = ~numpy.isnan(dorsal[:, 0])
+    side = numpy.minimum(box[:, 2] - box[:, 0], box[:, 3] - box[:, 1])
+    dorsalSide = numpy.minimum(dorsal[:, 2] - dorsal[:, 0], dorsal[:, 3] - dorsal[:, 1])
+    empty = (side < minSide) | (hasDorsal & (dorsalSide < minSide))
+    report('empty', empty)
+
+    inside = (dorsal[:, 0] >= box[:, 0]) & (dorsal[:, 1] >= box[:, 1]) & (dorsal[:, 2] <= box[:, 2]) & (dorsal[:, 3] <= box[:, 3])
+    report('outside', hasDorsal & ~inside & ~empty)
+
+    # The persons of a photo are consecutive rows, the pairs at distance d are compared together
+    best = numpy.zeros(len(box))
+    other = numpy.zeros(len(box), dtype=numpy.int64)
+    most = int(numpy.bincount(photo).max()) if len(photo) > 0 else 0
+    area = (box[:, 2] - box[:, 0]) * (box[:, 3] - box[:, 1])
+
+    for d in range(1, most) :
+        i = numpy.flatnonzero(photo[:-d] == photo[d:])
+        j = i + d
+        width = numpy.clip(numpy.minimum(box[i, 2], box[j, 2]) - numpy.maximum(box[i, 0], box[j, 0]), 0, None)
+        height = numpy.clip(numpy.minimum(box[i, 3], box[j, 3]) - numpy.maximum(box[i, 1], box[j, 1]), 0, None)
+        intersection = width * height
+
+        with numpy.errstate(divide='ignore', invalid='ignore') :
+            iou = numpy.nan_to_num(intersection / (area[i] + area[j] - intersection))
+
+        update = iou > best[j]
+        best[j[update]] = iou[update]
+        other[j[update]] = boxes.person[i[update]]
+
+    report('overlap', best > overlap, lambda j: (best[j], other[j]))
+
+    size, aspect = outliers(box, ~empty, outlier)
+    dorsalSize, dorsalAspect = outliers(dorsal, hasDorsal & ~empty, outlier)
+    report('size', (size | dorsalSize) & ~empty)
+    report('aspect', (aspect | dorsalAspect) & ~empty)
+
+    # Repeated numbers are consecutive once sorted by photo and number
+    order = numpy.lexsort((boxes.number, photo))
+    repeated = numpy.zeros(len(box), dtype=bool)
+    equal = (photo[order][1:] == photo[order][:-1]) & (boxes.number[order][1:] == boxes.number[order][:-1]) & (boxes.number[order][1:] >= 0)
+    repeated[order[1:][equal]] = True
+    repeated[order[:-1][equal]] = True
+    report('number', repeated, lambda j: (boxes.number[j],))
+
+    if sizes :
+        dims = numpy.array([[sizes[name]['width'], sizes[name]['height']] if name in sizes else [numpy.nan, numpy.nan] for name in boxes.names],
+                           dtype=numpy.float64).reshape(-1, 2)[photo]
+
+        with numpy.errstate(invalid='ignore') :
+            edge = numpy.zeros(len(box), dtype=bool)
+            for corners in (box, dorsal) :
+                edge |= (corners[:, 0] == dims[:, 0] - PRESS_MARGIN) | (corners[:, 1] == dims[:, 1] - PRESS_MARGIN)
+                edge |= (corners[:, 2] == dims[:, 0] - 1) | (corners[:, 3] == dims[:, 1] - 1)
+
+        report('edge', edge)
+
+    issues.sort(key=lambda issue: (issue[0], issue[1]))
+    return [{ 'photo': boxes.names[i], 'person': person, 'check': check, 'message': message } for i, person, check, message in issues]
+
+def validateFile(fileLabels, sizes=None):
+    """
+    Function to check the labels of a labels' file (JSON or SQLite), read streaming.
+    The dimensions of the photos are taken from the metadata index of the app if it exists.
+    """
+    if sizes is None :
+        try:
+            with open(fileLabels + METADATA, 'r') as file :
+                sizes = json.load(file)
+        except (FileNotFoundError, ValueError):
+            sizes = None
+
+    return validate(loadBoxes(iterLabels(fileLabels)), sizes)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the labels: empty boxes, dorsals outside their person, overlaps, outliers, repeated numbers and boxes clamped to the edges.")
+    parser.add_argument('labels', help="labels' file (JSON or SQLite)")
+    parser.add_argument('--report', default=None, help="JSON file with the issues")
+    args = parser.parse_args()
+
+    issues = validateFile(args.labels)
+
+    counts = {}
+    for issue in issues :
+        counts[issue['check']] = counts.get(issue['check'], 0) + 1
+
+    print("%d issues in %d photos" % (len(issues), len(set(issue['photo'] for issue in issues))))
+    for check in CHECKS.keys() :
+        if check in counts :
+            print("    %-8s %d" % (check, counts[check]))
+
+    if args.report :
+        with open(args.report, 'w') as file :
+            json.dump(issues, file, indent=1)